@@ -11,6 +11,7 @@ from transformers import StoppingCriteriaList
 
 from minigpt4.common.config import Config
 from minigpt4.common.dist_utils import get_rank
+from minigpt4.common.logger import startup_timer
 from minigpt4.common.registry import registry
 from minigpt4.conversation.conversation import Chat, CONV_VISION_Vicuna0, CONV_VISION_LLama2, StoppingCriteriaSub
 
@@ -62,7 +63,10 @@ cfg = Config(args)
 model_config = cfg.model_cfg
 model_config.device_8bit = args.gpu_id
 model_cls = registry.get_model_class(model_config.arch)
-model = model_cls.from_config(model_config).to('cuda:{}'.format(args.gpu_id))
+model = model_cls.from_config(model_config)
+with startup_timer.phase("to_device"):
+    model = model.to('cuda:{}'.format(args.gpu_id))
+print('Model loading time: ' + startup_timer.summary())
 
 CONV_VISION = conv_dict[model_config.model_type]
 
@@ -16,6 +16,7 @@ import torchvision.transforms as T
 import torch.backends.cudnn as cudnn
 
 from minigpt4.common.config import Config
+from minigpt4.common.logger import startup_timer
 
 from minigpt4.common.registry import registry
 from minigpt4.conversation.conversation import Conversation, SeparatorStyle, Chat
@@ -60,7 +61,10 @@ device = 'cuda:{}'.format(args.gpu_id)
 model_config = cfg.model_cfg
 model_config.device_8bit = args.gpu_id
 model_cls = registry.get_model_class(model_config.arch)
-model = model_cls.from_config(model_config).to(device)
+model = model_cls.from_config(model_config)
+with startup_timer.phase("to_device"):
+    model = model.to(device)
+print('Model loading time: ' + startup_timer.summary())
 bounding_box_size = 100
 
 vis_processor_cfg = cfg.datasets_cfg.cc_sbu_align.vis_processor.train
@@ -10,7 +10,7 @@ from tqdm import tqdm
 import torch
 from torch.utils.data import DataLoader
 from minigpt4.common.config import Config
-from minigpt4.common.eval_utils import prepare_texts, init_model, eval_parser, computeIoU
+from minigpt4.common.eval_utils import prepare_texts, prepare_prefix, init_model, eval_parser, computeIoU
 from minigpt4.conversation.conversation import CONV_VISION_minigptv2
 
 from minigpt4.datasets.datasets.coco_caption import RefCOCOEvalData
@@ -39,6 +39,7 @@ conv_temp.system = ""
 
 # 
 model.eval()
+prefix_cache = model.build_prefix_cache(prepare_prefix(conv_temp))  # shared by all the prompts
 save_path = cfg.run_cfg.save_path
 
 
@@ -61,7 +62,7 @@ for dataset in args.dataset:
 
         for images, questions, img_ids in tqdm(eval_dataloader):
             texts = prepare_texts(questions, conv_temp)  # warp the texts with conversation template
-            answers = model.generate(images, texts, max_new_tokens=max_new_tokens, do_sample=False)
+            answers = model.generate(images, texts, prefix_cache=prefix_cache, max_new_tokens=max_new_tokens, do_sample=False)
             for answer, img_id, question in zip(answers, img_ids, questions):
                 answer = answer.replace("<unk>","").replace(" ","").strip()
                 pattern = r'\{<\d{1,3}><\d{1,3}><\d{1,3}><\d{1,3}>\}'
@@ -76,7 +77,7 @@ for dataset in args.dataset:
                 eval_dataloader = DataLoader(data, batch_size=batch_size, shuffle=False)
                 for images, questions, img_ids in tqdm(eval_dataloader):
                     texts = prepare_texts(questions, conv_temp)  # warp the texts with conversation template
-                    answers = model.generate(images, texts, max_new_tokens=max_new_tokens, do_sample=False)
+                    answers = model.generate(images, texts, prefix_cache=prefix_cache, max_new_tokens=max_new_tokens, do_sample=False)
                     for answer, img_id, question in zip(answers, img_ids, questions):
                         answer = answer.replace("<unk>","").replace(" ","").strip()
                         pattern = r'\{<\d{1,3}><\d{1,3}><\d{1,3}><\d{1,3}>\}'
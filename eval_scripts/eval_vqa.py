@@ -16,7 +16,7 @@ from minigpt4.datasets.datasets.vqa_datasets import OKVQAEvalData,VizWizEvalData
 from minigpt4.common.vqa_tools.VQA.PythonHelperTools.vqaTools.vqa import VQA
 from minigpt4.common.vqa_tools.VQA.PythonEvaluationTools.vqaEvaluation.vqaEval import VQAEval
 
-from minigpt4.common.eval_utils import prepare_texts, init_model, eval_parser
+from minigpt4.common.eval_utils import prepare_texts, prepare_prefix, init_model, eval_parser
 from minigpt4.conversation.conversation import CONV_VISION_minigptv2
 from minigpt4.common.config import Config
 
@@ -35,6 +35,7 @@ model, vis_processor = init_model(args)
 conv_temp = CONV_VISION_minigptv2.copy()
 conv_temp.system = ""
 model.eval()
+prefix_cache = model.build_prefix_cache(prepare_prefix(conv_temp))  # shared by all the prompts
 save_path = cfg.run_cfg.save_path
 
 
@@ -56,7 +57,7 @@ if 'okvqa' in args.dataset:
 
     for images, questions, question_ids, img_ids in eval_dataloader:
         texts = prepare_texts(questions, conv_temp)  # warp the texts with conversation template
-        answers = model.generate(images, texts, max_new_tokens=max_new_tokens, do_sample=False)
+        answers = model.generate(images, texts, prefix_cache=prefix_cache, max_new_tokens=max_new_tokens, do_sample=False)
 
         for answer, question_id, question, img_id in zip(answers, question_ids, questions, img_ids):
             result = dict()
@@ -95,7 +96,7 @@ if 'vizwiz' in args.dataset:
     for images, texts, gt_answers in tqdm(eval_dataloader):
         texts = prepare_texts(texts, conv_temp)  # warp the texts with conversation template
         with torch.no_grad():
-            answers = model.generate(images, texts, max_new_tokens=max_new_tokens, do_sample=False,repetition_penalty=1.0)
+            answers = model.generate(images, texts, prefix_cache=prefix_cache, max_new_tokens=max_new_tokens, do_sample=False,repetition_penalty=1.0)
 
         for answer, gt_answer in zip(answers, gt_answers):
             result = dict()
@@ -158,7 +159,7 @@ if 'gqa' in args.dataset:
     minigpt4_predict = []
     for images, texts, labels in tqdm(eval_dataloader):
         texts = prepare_texts(texts, conv_temp)  # warp the texts with conversation template
-        answers = model.generate(images, texts, max_new_tokens=max_new_tokens, do_sample=False)
+        answers = model.generate(images, texts, prefix_cache=prefix_cache, max_new_tokens=max_new_tokens, do_sample=False)
 
         for answer, label in zip(answers, labels):
             result = dict()
@@ -190,7 +191,7 @@ if 'vsr' in args.dataset:
 
     for images, texts, labels in tqdm(eval_dataloader):
         texts = prepare_texts(texts, conv_temp)  # warp the texts with conversation template
-        answers = model.generate(images, texts, max_new_tokens=max_new_tokens, do_sample=False)
+        answers = model.generate(images, texts, prefix_cache=prefix_cache, max_new_tokens=max_new_tokens, do_sample=False)
 
         for answer, label in zip(answers, labels):
             result = dict()
@@ -228,7 +229,7 @@ if 'hm' in args.dataset:
     for images, texts, labels in tqdm(eval_dataloader):
         texts = prepare_texts(texts, conv_temp)  # warp the texts with conversation template
         
-        answers = model.generate(images, texts, max_new_tokens=max_new_tokens, do_sample=False)
+        answers = model.generate(images, texts, prefix_cache=prefix_cache, max_new_tokens=max_new_tokens, do_sample=False)
 
         for answer, label in zip(answers, labels):
             result = dict()
@@ -0,0 +1,109 @@
+"""
+Pre-encode the images of the training datasets with the frozen part of the model (ViT, and the
+Q-Former for MiniGPT-4) and write the features to a sharded memory-mapped store per dataset,
+keyed by image file path.
+
+Add `feature_store: <out-dir>/<dataset name>` to a dataset config to train on these features, and
+`precomputed_image_feats: True` to the model config to drop the vision encoder. The features are
+those of the train vis_processor of the dataset, evaluation keeps encoding the images.
+"""
+
+import argparse
+import logging
+import os
+
+import torch
+from torch.utils.data import DataLoader, Dataset, IterableDataset
+from tqdm import tqdm
+
+from minigpt4.common.config import Config
+from minigpt4.common.registry import registry
+from minigpt4.datasets.datasets.feature_store import FeatureStoreWriter, RecordImageKeys, processor_meta
+
+# imports modules for registration
+from minigpt4.datasets.builders import *
+from minigpt4.models import *
+from minigpt4.processors import *
+from minigpt4.runners import *
+from minigpt4.tasks import *
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Feature extraction")
+    parser.add_argument("--cfg-path", required=True, help="path to the training configuration file.")
+    parser.add_argument("--out-dir", required=True, help="directory of the feature stores.")
+    parser.add_argument("--gpu-id", type=int, default=0, help="specify the gpu to load the model.")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--num-workers", type=int, default=8)
+    parser.add_argument("--shard-size", type=int, default=4096, help="number of features per shard.")
+    parser.add_argument(
+        "--options",
+        nargs="+",
+        help="override some settings in the used config, the key-value pair "
+        "in xxx=yyy format will be merged into config file (deprecate), "
+        "change to --cfg-options instead.",
+    )
+    args = parser.parse_args()
+    return args
+
+
+class KeyedImages(Dataset):
+    """The (key, original size, processed image) of the samples of a dataset."""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.dataset.vis_processor = RecordImageKeys(dataset.vis_processor)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        return self.dataset[index]["image"]
+
+
+def collate(batch):
+    keys, orig_sizes, images = zip(*batch)
+    return list(keys), list(orig_sizes), torch.stack(images)
+
+
+@torch.no_grad()
+def main():
+    args = parse_args()
+    cfg = Config(args)
+    logging.basicConfig(level=logging.INFO)
+
+    model_config = cfg.model_cfg
+    model_config.device_8bit = args.gpu_id
+    model_cls = registry.get_model_class(model_config.arch)
+    model = model_cls.from_config(model_config).to('cuda:{}'.format(args.gpu_id)).eval()
+    meta = {
+        "arch": model_config.arch,
+        "image_size": model_config.get("image_size"),
+        "ckpt": model_config.get("ckpt", ""),
+    }
+
+    for name in cfg.datasets_cfg:
+        dataset = registry.get_builder_class(name)(cfg.datasets_cfg[name]).build_datasets()['train']
+        if isinstance(dataset, IterableDataset):
+            logging.warning("Skip {}: only map-style datasets can be pre-encoded.".format(name))
+            continue
+
+        assert not getattr(dataset.vis_processor, "device_preprocess", False), \
+            "{}: features are extracted with the host-side vis_processor.".format(name)
+        writer = FeatureStoreWriter(os.path.join(args.out_dir, name), shard_size=args.shard_size,
+                                    meta=dict(meta, **processor_meta(dataset.vis_processor)))
+        loader = DataLoader(KeyedImages(dataset), batch_size=args.batch_size, num_workers=args.num_workers,
+                            collate_fn=collate)
+        for keys, orig_sizes, images in tqdm(loader, desc=name):
+            todo = [i for i, key in enumerate(keys) if key not in writer]
+            if not todo:
+                continue
+            image_feats = model.encode_frozen(images[todo].to(model.device))
+            for i, feats in zip(todo, image_feats):
+                writer.add(keys[i], feats, orig_sizes[i])
+        writer.close()
+        logging.info("{}: {} features written to {}".format(name, len(writer.index), writer.path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import hashlib
+import logging
+import os
+import random
+import threading
+
+import numpy as np
+import torch
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+
+from minigpt4.common.dist_utils import prepare_once
+
+
+def to_cpu(obj):
+    """Copy every tensor of a (nested) checkpoint object to the cpu, so it can be saved while training goes on."""
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    elif isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def get_rng_state():
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state(state["cuda"])
+
+
+def load_model_state(path, checkpoint=None):
+    """
+    The model weights of a checkpoint: a .safetensors file, which is memory-mapped, or a .pth
+    checkpoint (`checkpoint` if it is already loaded) holding them or naming its .safetensors file.
+    """
+    if path.endswith(".safetensors"):
+        return load_file(path, device="cpu")
+    if checkpoint is None:
+        checkpoint = torch.load(path, map_location="cpu")
+    if "model_file" in checkpoint:
+        model_path = os.path.join(os.path.dirname(path), checkpoint["model_file"])
+        if "step" in checkpoint:
+            with safe_open(model_path, framework="pt") as f:
+                step = (f.metadata() or {}).get("step")
+            assert step == checkpoint["step"], "{} is from step {}, {} from step {}.".format(
+                model_path, step, path, checkpoint["step"])
+        return load_file(model_path, device="cpu")
+    return checkpoint["model"] if "model" in checkpoint else checkpoint
+
+
+def save_safetensors(state_dict, path):
+    """Save a flat dict of tensors (tensors sharing storage are copied) atomically."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    save_file({k: v.detach().clone().contiguous() for k, v in state_dict.items()}, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_cached_safetensors(path, cache_dir):
+    """
+    The model weights of the .pth checkpoint `path`, converted once per node to a .safetensors
+    file in `cache_dir` (see prepare_once) and memory-mapped from there, instead of unpickled into
+    memory.
+    """
+    if path.endswith(".safetensors"):
+        return load_file(path, device="cpu")
+    stamp = "{}:{}:{}".format(os.path.abspath(path), os.path.getsize(path), os.path.getmtime(path))
+    cache_path = os.path.join(cache_dir, hashlib.sha1(stamp.encode("utf-8")).hexdigest() + ".safetensors")
+
+    def convert():
+        logging.info("Converting {} to {}.".format(path, cache_path))
+        save_safetensors(load_model_state(path), cache_path)
+
+    prepare_once(lambda: os.path.isfile(cache_path), convert)
+    return load_file(cache_path, device="cpu")
+
+
+class AsyncCheckpointWriter:
+    """
+    Save checkpoints in a background thread. The checkpoint is first copied to the cpu, so the
+    training loop only blocks for that copy (and for the previous save if it is still running,
+    so at most one copy is in flight). Files are written in order, each to a temporary path
+    then renamed, so a preempted save leaves the previous checkpoint intact.
+    """
+
+    def __init__(self):
+        self._thread = None
+        self._error = None  # raised by wait() when the background save failed
+
+    def save(self, files, remove=(), metadata=None):
+        """
+        Write `files` ({path: obj}, a .safetensors path takes a flat dict of tensors, stored with
+        the str dict `metadata`) in order, then delete the paths in `remove`, unless a write failed.
+        """
+        self.wait()
+        files = {path: to_cpu(obj) for path, obj in files.items()}
+        self._thread = threading.Thread(target=self._save, args=(files, remove, metadata), daemon=True)
+        self._thread.start()
+
+    def wait(self):
+        """Wait for the running save, and raise its error if it failed."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _save(self, files, remove, metadata):
+        try:
+            for path, obj in files.items():
+                tmp_path = "{}.tmp".format(path)
+                try:
+                    if path.endswith(".safetensors"):
+                        save_file({k: v.contiguous() for k, v in obj.items()}, tmp_path, metadata=metadata)
+                    else:
+                        torch.save(obj, tmp_path)
+                    os.replace(tmp_path, path)
+                finally:
+                    if os.path.isfile(tmp_path):
+                        os.remove(tmp_path)
+                logging.info("Saved checkpoint to {}.".format(path))
+            for path in remove:
+                if os.path.isfile(path):
+                    os.remove(path)
+        except Exception as e:
+            logging.error("Saving the checkpoint failed: {}".format(e))
+            self._error = e
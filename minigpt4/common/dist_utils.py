@@ -54,6 +54,35 @@ def is_main_process():
     return get_rank() == 0
 
 
+def get_local_rank():
+    if not is_dist_avail_and_initialized():
+        return 0
+    if "LOCAL_RANK" in os.environ:
+        return int(os.environ["LOCAL_RANK"])
+    # slurm, see init_distributed_mode
+    return get_rank() % max(torch.cuda.device_count(), 1)
+
+
+def is_local_main_process():
+    return get_local_rank() == 0
+
+
+def prepare_once(is_ready, prepare):
+    """
+    Run `prepare()` to create a cached file unless `is_ready()`. The local main process of every
+    node does it, as the cache may not be on a filesystem shared by the nodes, while the other
+    processes wait. A process which still does not find it ready then prepares it itself.
+    """
+    if is_local_main_process() and not is_ready():
+        prepare()
+
+    if is_dist_avail_and_initialized():
+        dist.barrier()
+
+    if not is_ready():
+        prepare()
+
+
 def init_distributed_mode(args):
     if args.distributed is False:
         print("Not using distributed mode")
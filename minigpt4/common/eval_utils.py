@@ -4,6 +4,7 @@ from nltk.translate.bleu_score import sentence_bleu
 
 from minigpt4.common.registry import registry
 from minigpt4.common.config import Config
+from minigpt4.common.logger import startup_timer
 
 # imports modules for registration
 from minigpt4.datasets.builders import *
@@ -43,6 +44,11 @@ def prepare_texts(texts, conv_temp):
     return texts
 
 
+def prepare_prefix(conv_temp):
+    # the text before the image that every prompt of prepare_texts starts with
+    return prepare_texts([''], conv_temp)[0].split('<ImageHere>')[0]
+
+
 def init_model(args):
     print('Initialization Model')
     cfg = Config(args)
@@ -52,12 +58,17 @@ def init_model(args):
 
     model_config = cfg.model_cfg
     model_cls = registry.get_model_class(model_config.arch)
-    model = model_cls.from_config(model_config).to('cuda:0')
+    model = model_cls.from_config(model_config)
+    with startup_timer.phase("to_device"):
+        model = model.to('cuda:0')
+    print('Model loading time: ' + startup_timer.summary())
 
 #     import pudb; pudb.set_trace()
     key = list(cfg.datasets_cfg.keys())[0]
     vis_processor_cfg = cfg.datasets_cfg.get(key).vis_processor.train
     vis_processor = registry.get_processor_class(vis_processor_cfg.name).from_config(vis_processor_cfg)
+    # the eval scripts call vis_processor on single images, without the batch_transform of the runner
+    vis_processor.device_preprocess = False
     print('Initialization Finished')
     return model, vis_processor
 
@@ -5,10 +5,11 @@
  For full license text, see the LICENSE_Lavis file in the repo root or https://opensource.org/licenses/BSD-3-Clause
 """
 
+import contextlib
 import datetime
 import logging
 import time
-from collections import defaultdict, deque
+from collections import OrderedDict, defaultdict, deque
 
 import torch
 import torch.distributed as dist
@@ -79,6 +80,36 @@ class SmoothedValue(object):
         )
 
 
+class DeviceMetrics(object):
+    """
+    Accumulate per-step scalar metrics without synchronizing with the device: tensor values are
+    summed where they live and only copied to the host, all at once, by flush(), which returns
+    the averages over the steps since the previous flush.
+    """
+
+    def __init__(self):
+        self.sums = {}
+        self.counts = {}
+
+    def update(self, **kwargs):
+        for k, v in kwargs.items():
+            if isinstance(v, torch.Tensor):
+                v = v.detach().float().reshape(())
+            self.sums[k] = self.sums[k] + v if k in self.sums else v
+            self.counts[k] = self.counts.get(k, 0) + 1
+
+    def flush(self):
+        """Return {name: (average, number of steps)} and reset."""
+        tensor_names = [k for k, v in self.sums.items() if isinstance(v, torch.Tensor)]
+        sums = dict(self.sums)
+        if tensor_names:
+            values = torch.stack([sums[k].to(sums[tensor_names[0]].device) for k in tensor_names]).tolist()
+            sums.update(zip(tensor_names, values))
+        averages = {k: (sums[k] / self.counts[k], self.counts[k]) for k in sums}
+        self.sums, self.counts = {}, {}
+        return averages
+
+
 class MetricLogger(object):
     def __init__(self, delimiter="\t"):
         self.meters = defaultdict(SmoothedValue)
@@ -91,6 +122,11 @@ class MetricLogger(object):
             assert isinstance(v, (float, int))
             self.meters[k].update(v)
 
+    def update_averages(self, averages):
+        """Update the meters with the {name: (average, number of steps)} of DeviceMetrics.flush."""
+        for k, (v, n) in averages.items():
+            self.meters[k].update(v, n=n)
+
     def __getattr__(self, attr):
         if attr in self.meters:
             return self.meters[attr]
@@ -181,6 +217,35 @@ class MetricLogger(object):
         )
 
 
+class PhaseTimer(object):
+    """
+    Wall-clock time of the named phases of a job, e.g. the steps of building a model:
+
+        with startup_timer.phase("llama"):
+            ...
+        logging.info(startup_timer.summary())
+    """
+
+    def __init__(self):
+        self.times = OrderedDict()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.times[name] = self.times.get(name, 0.0) + time.time() - start
+
+    def summary(self):
+        phases = ["{}: {:.1f}s".format(name, t) for name, t in self.times.items()]
+        return "  ".join(phases + ["total: {:.1f}s".format(sum(self.times.values()))])
+
+
+# the phases of building the model, see MiniGPTBase
+startup_timer = PhaseTimer()
+
+
 class AttrDict(dict):
     def __init__(self, *args, **kwargs):
         super(AttrDict, self).__init__(*args, **kwargs)
@@ -1,17 +1,25 @@
 import argparse
+import asyncio
+import concurrent.futures
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from threading import Thread
 from PIL import Image
 
 import torch
 from transformers import AutoTokenizer, AutoModelForCausalLM, LlamaTokenizer
 from transformers import StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+from transformers.generation.streamers import BaseStreamer
 
 import dataclasses
 from enum import auto, Enum
 from typing import List, Tuple, Any
 
 from minigpt4.common.registry import registry
+from minigpt4.models.embedding_cache import image_file_id
+from minigpt4.models.generation_utils import llama_step, sample_next_tokens, past_length, slice_past
 
 
 class SeparatorStyle(Enum):
@@ -34,6 +42,8 @@ class Conversation:
 
     skip_next: bool = False
     conv_id: Any = None
+    # LLaMA past_key_values of the previous turn, see Chat.answer
+    kv_cache: Any = None
 
     def get_prompt(self):
         if self.sep_style == SeparatorStyle.SINGLE:
@@ -93,6 +103,29 @@ class Conversation:
         }
 
 
+@dataclasses.dataclass
+class PrefixKVCache:
+    """past_key_values kept between two turns of a conversation."""
+    # tokens covered by past_key_values, positions of the i-th image are marked with -(i + 1)
+    token_ids: List[int]
+    images: List[Any]
+    past_key_values: Any
+
+    def common_prefix_len(self, token_ids, images):
+        num_same_images = 0
+        for cached_image, image in zip(self.images, images):
+            if not (cached_image is image or torch.equal(cached_image, image)):
+                break
+            num_same_images += 1
+
+        prefix_len = 0
+        for cached_id, token_id in zip(self.token_ids, token_ids):
+            if cached_id != token_id or -cached_id > num_same_images:
+                break
+            prefix_len += 1
+        return prefix_len
+
+
 class StoppingCriteriaSub(StoppingCriteria):
 
     def __init__(self, stops=[], encounters=1):
@@ -107,6 +140,64 @@ class StoppingCriteriaSub(StoppingCriteria):
         return False
 
 
+class CancelCriteria(StoppingCriteria):
+    """Stop the generation once the event is set, e.g. when the client is gone."""
+
+    def __init__(self, cancel_event):
+        super().__init__()
+        self.cancel_event = cancel_event
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor):
+        return self.cancel_event.is_set()
+
+
+class AsyncQueueStreamer(BaseStreamer):
+    """
+    Streamer that pushes the text of every new token to an asyncio.Queue from the generation thread.
+    put() blocks while the queue is full, so a slow consumer slows down the decoding instead of
+    buffering the whole answer. None marks the end of the stream.
+    """
+
+    def __init__(self, tokenizer, loop, queue, cancel_event, **decode_kwargs):
+        self.tokenizer = tokenizer
+        self.loop = loop
+        self.queue = queue
+        self.cancel_event = cancel_event
+        self.decode_kwargs = decode_kwargs
+        self.token_cache = []
+        self.print_len = 0
+
+    def put(self, value):
+        if len(value.shape) > 1:
+            value = value[0]
+        self.token_cache.extend(value.tolist())
+        text = self.tokenizer.decode(self.token_cache, **self.decode_kwargs)
+        if text.endswith("\ufffd"):  # wait for the rest of a multi-token character
+            return
+        printable_text = text[self.print_len:]
+        self.print_len = len(text)
+        if printable_text:
+            self._push(printable_text)
+
+    def end(self):
+        text = self.tokenizer.decode(self.token_cache, **self.decode_kwargs)
+        if text[self.print_len:]:
+            self._push(text[self.print_len:])
+        self.token_cache = []
+        self.print_len = 0
+        self._push(None)
+
+    def _push(self, item):
+        future = asyncio.run_coroutine_threadsafe(self.queue.put(item), self.loop)
+        while True:
+            try:
+                return future.result(timeout=0.1)
+            except concurrent.futures.TimeoutError:
+                if self.cancel_event.is_set():
+                    future.cancel()
+                    return
+
+
 CONV_VISION_Vicuna0 = Conversation(
     system="Give the following image: <Img>ImageContent</Img>. "
            "You will be able to see the image once I provide it to you. Please answer my questions.",
@@ -137,10 +228,18 @@ CONV_VISION_minigptv2 = Conversation(
 )
 
 class Chat:
-    def __init__(self, model, vis_processor, device='cuda:0', stopping_criteria=None):
+    def __init__(self, model, vis_processor, device='cuda:0', stopping_criteria=None, reuse_kv_cache=True,
+                 max_workers=2):
         self.device = device
         self.model = model
         self.vis_processor = vis_processor
+        if getattr(vis_processor, "device_preprocess", False):
+            # only the training dataloaders apply batch_transform to the decoded images
+            vis_processor.device_preprocess = False
+        # keep the past_key_values of the last turn in conv.kv_cache and only prefill the new tokens
+        self.reuse_kv_cache = reuse_kv_cache
+        # bounded pool running the generations of astream_answer
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
 
         if stopping_criteria is not None:
             self.stopping_criteria = stopping_criteria
@@ -183,8 +282,13 @@ class Chat:
         return generation_kwargs
 
     def answer(self, conv, img_list, **kargs):
-        generation_dict = self.answer_prepare(conv, img_list, **kargs)
-        output_token = self.model_generate(**generation_dict)[0]
+        if self.reuse_kv_cache and kargs.get('num_beams', 1) == 1:
+            generation_dict = self.cached_answer_prepare(conv, img_list, **kargs)
+            output_token = self.cached_generate(**generation_dict)[0]
+        else:
+            conv.kv_cache = None
+            generation_dict = self.answer_prepare(conv, img_list, **kargs)
+            output_token = self.model_generate(**generation_dict)[0]
         output_text = self.model.llama_tokenizer.decode(output_token, skip_special_tokens=True)
 
         output_text = output_text.split('###')[0]  # remove the stop sign '###'
@@ -194,23 +298,161 @@ class Chat:
         return output_text, output_token.cpu().numpy()
 
     def stream_answer(self, conv, img_list, **kargs):
-        generation_kwargs = self.answer_prepare(conv, img_list, **kargs)
         streamer = TextIteratorStreamer(self.model.llama_tokenizer, skip_special_tokens=True)
+        target, generation_kwargs = self.generation_target(conv, img_list, **kargs)
         generation_kwargs['streamer'] = streamer
-        thread = Thread(target=self.model_generate, kwargs=generation_kwargs)
+        thread = Thread(target=target, kwargs=generation_kwargs)
         thread.start()
         return streamer
 
+    async def astream_answer(self, conv, img_list, timeout=None, max_queue_size=8, **kargs):
+        """
+        Asyncio version of stream_answer. Yields a dict per new piece of text with the keys
+        "text", "time_to_first_token" and "inter_token_latency" (seconds).
+
+        The generation runs on the bounded self.executor and stops at the next token when the
+        generator is closed (e.g. the client disconnected) or when `timeout` seconds have passed,
+        in which case asyncio.TimeoutError is raised.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=max_queue_size)
+        cancel_event = threading.Event()
+
+        target, generation_kwargs = self.generation_target(conv, img_list, **kargs)
+        generation_kwargs['stopping_criteria'] = StoppingCriteriaList(
+            list(generation_kwargs['stopping_criteria']) + [CancelCriteria(cancel_event)])
+        generation_kwargs['streamer'] = AsyncQueueStreamer(
+            self.model.llama_tokenizer, loop, queue, cancel_event, skip_special_tokens=True)
+
+        start = time.perf_counter()
+        deadline = None if timeout is None else start + timeout
+        generation = loop.run_in_executor(self.executor, partial(target, **generation_kwargs))
+        output_text = ''
+        time_to_first_token = None
+        last = start
+        try:
+            while True:
+                get = asyncio.ensure_future(queue.get())
+                waiting = {get} if generation.done() else {get, generation}
+                remaining = None if deadline is None else max(0., deadline - time.perf_counter())
+                done, _ = await asyncio.wait(waiting, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                if get not in done:
+                    get.cancel()
+                    if generation in done and generation.exception() is not None:
+                        raise generation.exception()
+                    if not done:
+                        raise asyncio.TimeoutError()
+                    continue  # the generation finished, the end of the stream is in the queue
+
+                text = get.result()
+                if text is None:
+                    break
+                now = time.perf_counter()
+                if time_to_first_token is None:
+                    time_to_first_token = now - start
+                output_text += text
+                yield {
+                    'text': text,
+                    'time_to_first_token': time_to_first_token,
+                    'inter_token_latency': now - last,
+                }
+                last = now
+        finally:
+            cancel_event.set()
+            output_text = output_text.split('###')[0]  # remove the stop sign '###'
+            conv.messages[-1][1] = output_text.split('Assistant:')[-1].strip()
+
+    def generation_target(self, conv, img_list, **kargs):
+        if self.reuse_kv_cache and kargs.get('num_beams', 1) == 1:
+            return self.cached_generate, self.cached_answer_prepare(conv, img_list, **kargs)
+        conv.kv_cache = None
+        return self.model_generate, self.answer_prepare(conv, img_list, **kargs)
+
+    def cached_answer_prepare(self, conv, img_list, **kargs):
+        generation_kwargs = self.answer_prepare(conv, img_list, **kargs)
+        embs = generation_kwargs['inputs_embeds']
+        token_ids = self.context_token_ids(conv.get_prompt(), img_list)
+
+        cache, conv.kv_cache = conv.kv_cache, None
+        past_key_values = None
+        if len(token_ids) != embs.shape[1]:
+            # the history is truncated by max_length and no longer starts like the cached one
+            token_ids = None
+        elif cache is not None:
+            # prefill at least the last position to get the logits of the first new token
+            reuse_len = min(cache.common_prefix_len(token_ids, img_list), len(token_ids) - 1)
+            if reuse_len > 0:
+                past_key_values = slice_past(cache.past_key_values, reuse_len)
+
+        generation_kwargs.update(
+            conv=conv, img_list=list(img_list), token_ids=token_ids, past_key_values=past_key_values)
+        return generation_kwargs
+
+    def context_token_ids(self, prompt, img_list):
+        """Token ids of get_context_emb(prompt, img_list), image positions are marked with -(i + 1)."""
+        prompt_segs = prompt.split('<ImageHere>')
+        token_ids = []
+        for i, seg in enumerate(prompt_segs):
+            token_ids += self.model.llama_tokenizer(seg, add_special_tokens=i == 0).input_ids
+            if i < len(img_list):
+                token_ids += [-(i + 1)] * img_list[i].shape[1]
+        return token_ids
+
+    @torch.no_grad()
+    def cached_generate(self, conv, img_list, token_ids, inputs_embeds, past_key_values, max_new_tokens,
+                        stopping_criteria, do_sample, min_length, top_p, repetition_penalty, temperature,
+                        streamer=None, **kwargs):
+        """
+        The generation of model_generate, decoding step by step on top of past_key_values. It
+        stops at eos or when stopping_criteria fires, and samples with the same top_k/top_p.
+        """
+        eos_token_id = self.model.llama_tokenizer.eos_token_id
+        past_len = 0 if past_key_values is None else past_length(past_key_values)
+        embs = inputs_embeds[:, past_len:]
+        output_token = torch.zeros([1, 0], dtype=torch.long, device=inputs_embeds.device)
+        for _ in range(max_new_tokens):
+            logits, past_key_values = llama_step(self.model, embs, past_key_values=past_key_values)
+            next_token = sample_next_tokens(
+                logits,
+                output_token,
+                do_sample=do_sample,
+                temperature=temperature,
+                top_p=top_p,
+                repetition_penalty=repetition_penalty,
+                min_new_tokens=min_length,
+                eos_token_id=eos_token_id,
+            )
+            output_token = torch.cat([output_token, next_token[:, None]], dim=1)
+            if streamer is not None:
+                streamer.put(next_token.cpu())
+            if next_token.item() == eos_token_id or stopping_criteria(output_token, None):
+                break
+            embs = self.model.embed_tokens(next_token[:, None])
+        if streamer is not None:
+            streamer.end()
+
+        if token_ids is not None:
+            # past_key_values covers the prompt and all generated tokens but the last one
+            conv.kv_cache = PrefixKVCache(
+                token_ids=token_ids + output_token[0, :-1].tolist(),
+                images=img_list,
+                past_key_values=past_key_values,
+            )
+        return output_token
+
     def model_generate(self, *args, **kwargs):
         # for 8 bit and 16 bit compatibility
         with self.model.maybe_autocast():
             output = self.model.llama_model.generate(*args, **kwargs)
         return output
 
+    @torch.no_grad()
     def encode_img(self, img_list):
         image = img_list[0]
         img_list.pop(0)
+        image_ids = None
         if isinstance(image, str):  # is a image path
+            image_ids = [image_file_id(image)]
             raw_image = Image.open(image).convert('RGB')
             image = self.vis_processor(raw_image).unsqueeze(0).to(self.device)
         elif isinstance(image, Image.Image):
@@ -221,7 +463,7 @@ class Chat:
                 image = image.unsqueeze(0)
             image = image.to(self.device)
 
-        image_emb, _ = self.model.encode_img(image)
+        image_emb, _ = self.model.encode_img_cached(image, image_ids=image_ids)
         img_list.append(image_emb)
 
     def upload_img(self, image, conv, img_list):
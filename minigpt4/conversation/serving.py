@@ -0,0 +1,358 @@
+"""
+Continuous-batching inference on top of MiniGPTBase.
+
+The engine keeps a fixed number of decoding slots, each with its own region of a
+preallocated KV cache. At every decoding step, waiting requests are prefilled into free
+slots, one token is decoded for all running sequences together, and sequences that hit
+a stop sequence or their token budget release their slot immediately, so short answers
+no longer wait for the longest one in the batch.
+"""
+
+import base64
+import io
+import json
+import logging
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import torch
+from PIL import Image
+
+from minigpt4.models.generation_utils import llama_step, sample_next_tokens, ends_with_stop
+
+
+class GenerationRequest:
+    """A prompt submitted to the ContinuousBatchingEngine. Use wait() to get the answer."""
+
+    def __init__(
+        self,
+        prompt,
+        images=None,
+        max_new_tokens=300,
+        do_sample=False,
+        temperature=1.0,
+        top_p=0.9,
+        repetition_penalty=1.0,
+        min_new_tokens=1,
+        token_callback=None,
+    ):
+        self.prompt = prompt
+        self.images = images
+        self.max_new_tokens = max_new_tokens
+        self.do_sample = do_sample
+        self.temperature = temperature
+        self.top_p = top_p
+        self.repetition_penalty = repetition_penalty
+        self.min_new_tokens = min_new_tokens
+        self.token_callback = token_callback
+
+        self.output_ids = []
+        self.text = None
+        self.error = None
+        self._done = threading.Event()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise TimeoutError("Generation did not finish in {} seconds.".format(timeout))
+        if self.error is not None:
+            raise self.error
+        return self.text
+
+
+class ContinuousBatchingEngine:
+    """
+    Continuous-batching scheduler for MiniGPT-4 / MiniGPT-v2.
+
+    Args:
+        model (MiniGPTBase): the model, already on its device and in eval mode.
+        max_batch_size (int): number of sequences decoded together.
+        max_seq_len (int): KV cache capacity per sequence (prompt + answer).
+        stop_words_ids (list[list[int]]): token sequences that end an answer.
+    """
+
+    def __init__(self, model, max_batch_size=8, max_seq_len=2048, stop_words_ids=([2],)):
+        self.model = model
+        self.tokenizer = model.llama_tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_seq_len = max_seq_len
+        self.stop_words_ids = [list(stop) for stop in stop_words_ids]
+
+        self.pending = queue.Queue()
+        self.slots = [None] * max_batch_size
+        self.slot_lens = [0] * max_batch_size
+        self.last_tokens = [0] * max_batch_size
+
+        # one [max_batch_size, heads, max_seq_len, head_dim] tensor per layer, allocated at the first prefill
+        self.key_cache = None
+        self.value_cache = None
+
+        self._thread = None
+        self._stop = threading.Event()
+
+    def submit(self, prompt, images=None, **generation_kwargs):
+        """
+        Queue a prompt. `images` is a processed image tensor ([3, H, W] or [N, 3, H, W]) with one
+        image per <ImageHere> placeholder of the prompt.
+        """
+        request = GenerationRequest(prompt, images=images, **generation_kwargs)
+        self.pending.put(request)
+        return request
+
+    def generate(self, prompt, images=None, timeout=None, **generation_kwargs):
+        request = self.submit(prompt, images=images, **generation_kwargs)
+        if self._thread is None:
+            self.run_until_idle()
+        return request.wait(timeout)
+
+    def start(self):
+        """Run the scheduler in a background thread."""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def run_until_idle(self):
+        """Drive the scheduler in the calling thread until every queued request is finished."""
+        while self.num_active() or not self.pending.empty():
+            self.step()
+
+    def num_active(self):
+        return sum(request is not None for request in self.slots)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            if not self.num_active():
+                try:
+                    request = self.pending.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                self._start_request(self.slots.index(None), request)
+            self.step()
+
+    @torch.no_grad()
+    def step(self):
+        """Admit waiting requests into free slots, then decode one token for every running sequence."""
+        while None in self.slots and not self.pending.empty():
+            try:
+                request = self.pending.get_nowait()
+            except queue.Empty:
+                break
+            self._start_request(self.slots.index(None), request)
+
+        if self.num_active():
+            try:
+                self._decode_step()
+            except Exception as e:
+                logging.exception("Decoding step failed.")
+                for slot, request in enumerate(self.slots):
+                    if request is not None:
+                        request.error = e
+                        self._finish(slot)
+
+    def _start_request(self, slot, request):
+        try:
+            self._prefill(slot, request)
+        except Exception as e:
+            logging.exception("Prefill failed.")
+            request.error = e
+            self.slots[slot] = request
+            self._finish(slot)
+
+    def _prompt_embs(self, request):
+        if request.images is None:
+            tokens = self.tokenizer(request.prompt, return_tensors="pt").input_ids.to(self.model.device)
+            return self.model.embed_tokens(tokens)
+
+        images = request.images
+        if images.dim() == 3:
+            images = images.unsqueeze(0)
+        img_embeds, _ = self.model.encode_img_cached(images.to(self.model.device))
+        return self.model.get_context_emb(request.prompt, [emb[None] for emb in img_embeds])
+
+    @torch.no_grad()
+    def _prefill(self, slot, request):
+        embs = self._prompt_embs(request)
+
+        max_prompt_len = self.max_seq_len - request.max_new_tokens
+        assert max_prompt_len > 0, "max_new_tokens must be smaller than max_seq_len."
+        if embs.shape[1] > max_prompt_len:
+            logging.warning('The prompt exceeds the max length. '
+                            'The model will not see the contexts outside the range.')
+            embs = embs[:, -max_prompt_len:]
+
+        logits, past = llama_step(self.model, embs)
+        if self.key_cache is None:
+            self._allocate(past)
+
+        prompt_len = embs.shape[1]
+        for layer, (k, v) in enumerate(past):
+            self.key_cache[layer][slot, :, :prompt_len] = k[0]
+            self.value_cache[layer][slot, :, :prompt_len] = v[0]
+
+        self.slots[slot] = request
+        self.slot_lens[slot] = prompt_len
+        self._append_tokens([slot], logits)
+
+    def _allocate(self, past):
+        k = past[0][0]
+        shape = (self.max_batch_size, k.shape[1], self.max_seq_len, k.shape[3])
+        self.key_cache = [torch.zeros(shape, dtype=k.dtype, device=k.device) for _ in past]
+        self.value_cache = [torch.zeros(shape, dtype=k.dtype, device=k.device) for _ in past]
+
+    def _decode_step(self):
+        active = [slot for slot, request in enumerate(self.slots) if request is not None]
+        # run the slots up to the last active one; free slots in between are masked out
+        num_rows = active[-1] + 1
+        max_len = max(self.slot_lens[slot] for slot in active)
+        device = self.key_cache[0].device
+
+        lens = torch.tensor(self.slot_lens[:num_rows], device=device)
+        tokens = torch.tensor(self.last_tokens[:num_rows], device=device)[:, None]
+        attention_mask = torch.cat([
+            (torch.arange(max_len, device=device)[None] < lens[:, None]).long(),
+            torch.ones([num_rows, 1], dtype=torch.long, device=device),
+        ], dim=1)
+        past = tuple(
+            (k[:num_rows, :, :max_len], v[:num_rows, :, :max_len])
+            for k, v in zip(self.key_cache, self.value_cache)
+        )
+
+        logits, new_past = llama_step(
+            self.model,
+            self.model.embed_tokens(tokens),
+            attention_mask=attention_mask,
+            position_ids=lens[:, None],
+            past_key_values=past,
+        )
+
+        # write the key/value of the new token at each sequence's own length
+        rows = torch.tensor(active, device=device)
+        cols = lens[rows]
+        for layer, (k, v) in enumerate(new_past):
+            self.key_cache[layer][rows, :, cols] = k[rows, :, -1]
+            self.value_cache[layer][rows, :, cols] = v[rows, :, -1]
+        for slot in active:
+            self.slot_lens[slot] += 1
+
+        self._append_tokens(active, logits[rows])
+
+    def _append_tokens(self, slots, logits):
+        next_tokens = []
+        for row, slot in enumerate(slots):
+            request = self.slots[slot]
+            generated = None
+            if request.output_ids:
+                generated = torch.tensor([request.output_ids], device=logits.device)
+            next_tokens.append(sample_next_tokens(
+                logits[row:row + 1],
+                generated,
+                do_sample=request.do_sample,
+                temperature=request.temperature,
+                top_p=request.top_p,
+                repetition_penalty=request.repetition_penalty,
+                min_new_tokens=request.min_new_tokens,
+                eos_token_id=self.tokenizer.eos_token_id,
+            ))
+        next_tokens = torch.cat(next_tokens).tolist()
+
+        for slot, token in zip(slots, next_tokens):
+            request = self.slots[slot]
+            request.output_ids.append(token)
+            if request.token_callback is not None:
+                request.token_callback(request, token)
+
+            if token == self.tokenizer.eos_token_id \
+                    or ends_with_stop(request.output_ids, self.stop_words_ids) \
+                    or len(request.output_ids) >= request.max_new_tokens \
+                    or self.slot_lens[slot] >= self.max_seq_len:
+                self._finish(slot)
+            else:
+                self.last_tokens[slot] = token
+
+    def _finish(self, slot):
+        request = self.slots[slot]
+        if request.error is None:
+            output_ids = request.output_ids
+            for stop in self.stop_words_ids:
+                if len(stop) and output_ids[-len(stop):] == stop:
+                    output_ids = output_ids[:-len(stop)]
+                    break
+            output_text = self.tokenizer.decode(output_ids, skip_special_tokens=True)
+            output_text = output_text.split('###')[0]  # remove the stop sign '###'
+            output_text = output_text.split('Assistant:')[-1].strip()
+            request.text = output_text
+
+        self.slots[slot] = None
+        self.slot_lens[slot] = 0
+        request._done.set()
+
+
+GENERATION_KEYS = ("max_new_tokens", "do_sample", "temperature", "top_p", "repetition_penalty", "min_new_tokens")
+
+
+def make_http_server(engine, vis_processor, conv_template, host="127.0.0.1", port=8000, timeout=600):
+    """
+    Build a local HTTP endpoint around a started engine.
+
+    POST /generate with a JSON body {"question": str, "image": <base64 encoded image file>, ...}
+    (plus optional generation keys) returns {"answer": str}.
+    """
+    if getattr(vis_processor, "device_preprocess", False):
+        # only the training dataloaders apply batch_transform to the decoded images
+        vis_processor.device_preprocess = False
+
+    class GenerateHandler(BaseHTTPRequestHandler):
+
+        def do_POST(self):
+            if self.path != "/generate":
+                self._respond(404, {"error": "unknown path {}".format(self.path)})
+                return
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                question = payload["question"]
+
+                image = None
+                if payload.get("image"):
+                    raw_image = Image.open(io.BytesIO(base64.b64decode(payload["image"]))).convert("RGB")
+                    image = vis_processor(raw_image)
+                    question = "<Img><ImageHere></Img> {}".format(question)
+
+                conv = conv_template.copy()
+                conv.append_message(conv.roles[0], question)
+                conv.append_message(conv.roles[1], None)
+
+                generation_kwargs = {k: payload[k] for k in GENERATION_KEYS if k in payload}
+                request = engine.submit(conv.get_prompt(), images=image, **generation_kwargs)
+                answer = request.wait(timeout)
+            except (KeyError, ValueError) as e:
+                self._respond(400, {"error": str(e)})
+                return
+            except Exception as e:
+                self._respond(500, {"error": str(e)})
+                return
+            self._respond(200, {"answer": answer})
+
+        def _respond(self, code, body):
+            body = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.info("%s - %s" % (self.address_string(), format % args))
+
+    return ThreadingHTTPServer((host, port), GenerateHandler)
@@ -0,0 +1,219 @@
+import bisect
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+from minigpt4.common.dist_utils import prepare_once
+from minigpt4.common.registry import registry
+
+
+# bumped when the conversion changes, so that stores converted before are converted again
+STORE_VERSION = 2
+
+
+def _is_int(value):
+    return isinstance(value, int) and not isinstance(value, bool) and -2 ** 63 <= value < 2 ** 63
+
+
+def _is_float(value):
+    return isinstance(value, float)
+
+
+def _save(path, array):
+    tmp_path = "{}.{}.tmp.npy".format(path, os.getpid())
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
+
+
+def _save_arena(path, strings):
+    """Save a list of strings as one utf-8 byte arena plus offsets."""
+    encoded = [s.encode("utf-8") for s in strings]
+    _save(path + ".offsets.npy", np.cumsum([0] + [len(s) for s in encoded], dtype=np.int64))
+    _save(path + ".bytes.npy", np.frombuffer(b"".join(encoded), dtype=np.uint8))
+
+
+class AnnotationStore:
+    """
+    Read-only list of the records of a JSON annotation file, stored column by column in
+    memory-mapped .npy files: integer and float fields as arrays, string fields as a utf-8 byte
+    arena with offsets, and nested fields as json strings in an arena. Fields missing in some
+    records are kept together in a json column.
+
+    Reading a record only touches the pages of its bytes, and the pages are shared by all the
+    processes mapping the store, so dataloader workers do not each copy the annotations.
+
+    The store is converted once per node from the JSON file (see prepare_once), next to it in
+    `<ann_path>.store/` (or in the cache root if that is not writable), and converted again when
+    the JSON file changes.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, "meta.json")) as f:
+            meta = json.load(f)
+        self.columns = meta["columns"]  # [[name, kind]]
+        self.num_records = meta["num_records"]
+
+        self._arrays = {}
+        for i, (name, kind) in enumerate(self.columns):
+            prefix = os.path.join(store_dir, "col{}".format(i))
+            if kind in ("int", "float"):
+                self._arrays[name] = np.load(prefix + ".npy", mmap_mode="r")
+            else:
+                self._arrays[name] = (np.load(prefix + ".offsets.npy", mmap_mode="r"),
+                                      np.load(prefix + ".bytes.npy", mmap_mode="r"))
+
+    @classmethod
+    def open(cls, ann_path):
+        stamp = [os.path.getsize(ann_path), os.path.getmtime(ann_path)]
+        store_dir = ann_path + ".store"
+        if not os.access(os.path.dirname(os.path.abspath(ann_path)), os.W_OK):
+            digest = hashlib.sha1(os.path.abspath(ann_path).encode("utf-8")).hexdigest()
+            store_dir = os.path.join(registry.get_path("cache_root"), "annotation_store", digest)
+
+        def convert():
+            logging.info("Converting {} to a columnar annotation store in {}.".format(ann_path, store_dir))
+            with open(ann_path, "r") as f:
+                records = json.load(f)
+            if isinstance(records, dict):
+                records = records["annotations"]
+            cls.convert(records, store_dir, stamp)
+
+        prepare_once(lambda: cls._is_current(store_dir, stamp), convert)
+        return cls(store_dir)
+
+    @staticmethod
+    def _is_current(store_dir, stamp):
+        meta_path = os.path.join(store_dir, "meta.json")
+        if not os.path.isfile(meta_path):
+            return False
+        with open(meta_path) as f:
+            meta = json.load(f)
+        return meta["source"] == stamp and meta.get("version") == STORE_VERSION
+
+    @staticmethod
+    def convert(records, store_dir, stamp=None):
+        os.makedirs(store_dir, exist_ok=True)
+        names = []
+        for record in records:
+            for name in record:
+                if name not in names:
+                    names.append(name)
+        common = [name for name in names if all(name in record for record in records)]
+
+        columns = []
+        for i, name in enumerate(common):
+            prefix = os.path.join(store_dir, "col{}".format(i))
+            values = [record[name] for record in records]
+            if values and all(_is_int(v) for v in values):
+                kind = "int"
+                _save(prefix + ".npy", np.array(values, dtype=np.int64))
+            elif values and all(_is_float(v) for v in values):
+                # a column mixing ints and floats goes to json, which keeps the type of every value
+                kind = "float"
+                _save(prefix + ".npy", np.array(values, dtype=np.float64))
+            elif all(isinstance(v, str) for v in values):
+                kind = "str"
+                _save_arena(prefix, values)
+            else:
+                kind = "json"
+                _save_arena(prefix, [json.dumps(v) for v in values])
+            columns.append([name, kind])
+
+        rest = [name for name in names if name not in common]
+        if rest:
+            prefix = os.path.join(store_dir, "col{}".format(len(columns)))
+            _save_arena(prefix, [json.dumps({k: record[k] for k in rest if k in record}) for record in records])
+            columns.append([None, "rest"])
+
+        # meta.json is written last and marks the store as complete
+        tmp_path = os.path.join(store_dir, "meta.{}.tmp".format(os.getpid()))
+        with open(tmp_path, "w") as f:
+            json.dump({"columns": columns, "num_records": len(records), "source": stamp,
+                       "version": STORE_VERSION}, f)
+        os.replace(tmp_path, os.path.join(store_dir, "meta.json"))
+
+    def __len__(self):
+        return self.num_records
+
+    def _string(self, name, index):
+        offsets, arena = self._arrays[name]
+        return bytes(arena[offsets[index]:offsets[index + 1]]).decode("utf-8")
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.num_records
+        if not 0 <= index < self.num_records:
+            raise IndexError(index)
+
+        record = {}
+        for name, kind in self.columns:
+            if kind == "int":
+                record[name] = int(self._arrays[name][index])
+            elif kind == "float":
+                record[name] = float(self._arrays[name][index])
+            elif kind == "str":
+                record[name] = self._string(name, index)
+            elif kind == "json":
+                record[name] = json.loads(self._string(name, index))
+            else:
+                record.update(json.loads(self._string(name, index)))
+        return record
+
+    def __iter__(self):
+        for i in range(self.num_records):
+            yield self[i]
+
+
+class AnnotationList:
+    """
+    List-like concatenation of annotation stores, with the index selection of the dataset filters
+    (`select`) and the "instance_id" of BaseDataset computed on access instead of stored.
+    """
+
+    def __init__(self, stores, rows=None, instance_id_key=None):
+        self.stores = stores
+        self.ends = np.cumsum([len(store) for store in stores], dtype=np.int64).tolist()
+        self.rows = rows  # positions in the concatenated stores, None for all of them
+        self.instance_id_key = instance_id_key
+
+    @classmethod
+    def open(cls, ann_paths):
+        return cls([AnnotationStore.open(ann_path) for ann_path in ann_paths])
+
+    def __len__(self):
+        if self.rows is not None:
+            return len(self.rows)
+        return self.ends[-1] if self.ends else 0
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+
+        position = int(self.rows[index]) if self.rows is not None else index
+        store_idx = bisect.bisect_right(self.ends, position)
+        start = self.ends[store_idx - 1] if store_idx > 0 else 0
+        record = self.stores[store_idx][position - start]
+        if self.instance_id_key is not None:
+            record[self.instance_id_key] = str(position)
+        return record
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def select(self, indices):
+        """A view on the records at `indices`."""
+        indices = np.asarray(indices, dtype=np.int64)
+        rows = self.rows[indices] if self.rows is not None else indices
+        return AnnotationList(self.stores, rows, self.instance_id_key)
+
+
+def load_annotations(ann_path):
+    """The records of a JSON annotation file, as an AnnotationList."""
+    return AnnotationList.open([ann_path])
@@ -14,6 +14,7 @@ import torch
 from PIL import Image
 
 from minigpt4.datasets.datasets.vqa_datasets import VQADataset  #, VQAEvalDataset
+from minigpt4.datasets.datasets.image_io import load_image
 
 
 class __DisplMixin:
@@ -42,17 +43,17 @@ class AOKVQADataset(VQADataset, __DisplMixin):
         ]
 
         exist_annotation = []
-        for ann in self.annotation:
+        for idx, ann in enumerate(self.annotation):
             image_path = os.path.join(self.vis_root, ann["image"].split('/')[-1])
             if os.path.exists(image_path):
-                exist_annotation.append(ann)
-        self.annotation = exist_annotation
+                exist_annotation.append(idx)
+        self.annotation = self.annotation.select(exist_annotation)
 
     def get_data(self, index):
         ann = self.annotation[index]
 
         image_path = os.path.join(self.vis_root, ann["image"].split('/')[-1])
-        image = Image.open(image_path).convert("RGB")
+        image = load_image(image_path, self.vis_processor)[0]
 
         image = self.vis_processor(image)
         question = self.text_processor(ann["question"])
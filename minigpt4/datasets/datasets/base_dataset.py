@@ -11,6 +11,8 @@ from typing import Iterable
 from torch.utils.data import Dataset, ConcatDataset
 from torch.utils.data.dataloader import default_collate
 
+from minigpt4.datasets.datasets.annotation_store import AnnotationList
+
 
 
 
@@ -24,17 +26,9 @@ class BaseDataset(Dataset):
         """
         self.vis_root = vis_root
 
-        self.annotation = []
-        # print("ann paths", ann_paths)
-        for ann_path in ann_paths:
-            # print("ann_path", ann_path)
-            ann = json.load(open(ann_path, "r"))
-            if isinstance(ann, dict):
-                self.annotation.extend(json.load(open(ann_path, "r"))['annotations'])
-                # self.annotation.extend(json.load(open(ann_path, "r")))
-            else:
-                self.annotation.extend(json.load(open(ann_path, "r")))
-    
+        # memory-mapped and shared by the dataloader workers, see AnnotationStore
+        self.annotation = AnnotationList.open(ann_paths)
+
         self.vis_processor = vis_processor
         self.text_processor = text_processor
 
@@ -51,6 +45,9 @@ class BaseDataset(Dataset):
         self.text_processor = text_processor
 
     def _add_instance_ids(self, key="instance_id"):
+        if isinstance(self.annotation, AnnotationList):
+            self.annotation.instance_id_key = key
+            return
         for idx, ann in enumerate(self.annotation):
             ann[key] = str(idx)
 
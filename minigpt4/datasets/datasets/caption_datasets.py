@@ -10,6 +10,7 @@ from collections import OrderedDict
 
 from minigpt4.datasets.datasets.base_dataset import BaseDataset
 from PIL import Image
+from minigpt4.datasets.datasets.image_io import load_image
 import random
 
 
@@ -49,7 +50,7 @@ class CaptionDataset(BaseDataset, __DisplMixin):
 
         img_file = '{:0>12}.jpg'.format(ann["image_id"])
         image_path = os.path.join(self.vis_root, img_file)
-        image = Image.open(image_path).convert("RGB")
+        image = load_image(image_path, self.vis_processor)[0]
 
         image = self.vis_processor(image)
         caption = self.text_processor(ann["caption"])
@@ -75,10 +76,10 @@ class COCOCaptionDataset(BaseDataset, __DisplMixin):
 
         self.filter_anntation = []
         
-        for ann in self.annotation:
+        for idx, ann in enumerate(self.annotation):
             if "train" in ann["image"]:
-                self.filter_anntation.append(ann)
-        self.annotation = self.filter_anntation
+                self.filter_anntation.append(idx)
+        self.annotation = self.annotation.select(self.filter_anntation)
 
         for ann in self.annotation:
             img_id = ann["image_id"]
@@ -112,7 +113,7 @@ class COCOCaptionDataset(BaseDataset, __DisplMixin):
 
         img_file = ann["image"].split("/")[-1]
         image_path = os.path.join(self.vis_root, img_file)
-        image = Image.open(image_path).convert("RGB")
+        image = load_image(image_path, self.vis_processor)[0]
 
         image = self.vis_processor(image)
         caption = self.text_processor(ann["caption"])
@@ -3,6 +3,7 @@ from PIL import Image
 import webdataset as wds
 from minigpt4.datasets.datasets.base_dataset import BaseDataset
 from minigpt4.datasets.datasets.caption_datasets import CaptionDataset
+from minigpt4.datasets.datasets.image_io import load_image
 
 
 class CCSBUDataset(BaseDataset):
@@ -35,7 +36,7 @@ class CCSBUAlignDataset(CaptionDataset):
 
         img_file = '{}.jpg'.format(ann["image_id"])
         image_path = os.path.join(self.vis_root, img_file)
-        image = Image.open(image_path).convert("RGB")
+        image = load_image(image_path, self.vis_processor)[0]
 
         image = self.vis_processor(image)
         caption = ann["caption"]
@@ -14,8 +14,10 @@ from matplotlib.patches import Polygon, Rectangle
 from torch.utils.data import Dataset
 import webdataset as wds
 
+from minigpt4.common.dist_utils import prepare_once
 from minigpt4.datasets.datasets.base_dataset import BaseDataset
 from minigpt4.datasets.datasets.caption_datasets import CaptionDataset
+from minigpt4.datasets.datasets.image_io import load_image
 
 
 class ReferCOCODataset(Dataset):
@@ -29,7 +31,7 @@ class ReferCOCODataset(Dataset):
         self.vis_processor = vis_processor
         self.text_processor = text_processor
 
-        self.refer = REFER(ann_path, vis_root, dataset, splitBy)
+        self.refer = ReferIndex.load(ann_path, vis_root, dataset, splitBy)
         self.ref_ids = self.refer.getRefIds(split="train")
 
         self.instruction_pool = [
@@ -52,10 +54,8 @@ class ReferCOCODataset(Dataset):
 
         image_file = 'COCO_train2014_{:0>12}.jpg'.format(ref["image_id"])
         image_path = os.path.join(self.vis_root, image_file)
-        image = Image.open(image_path).convert("RGB")
-        image_orig_size = image.size
+        image, image_orig_size = load_image(image_path, self.vis_processor)
         image = self.vis_processor(image)
-        image_new_size = [image.shape[1], image.shape[2]]
 
         image_new_size = [100,100]
 
@@ -174,7 +174,7 @@ class REFER:
         Anns, Imgs, Cats, imgToAnns = {}, {}, {}, {}
         for ann in self.data['annotations']:
             Anns[ann['id']] = ann
-            imgToAnns[ann['image_id']] = imgToAnns.get(ann['image_id'], []) + [ann]
+            imgToAnns.setdefault(ann['image_id'], []).append(ann)
         for img in self.data['images']:
             Imgs[img['id']] = img
         for cat in self.data['categories']:
@@ -192,8 +192,8 @@ class REFER:
 
             # add mapping related to ref
             Refs[ref_id] = ref
-            imgToRefs[image_id] = imgToRefs.get(image_id, []) + [ref]
-            catToRefs[category_id] = catToRefs.get(category_id, []) + [ref]
+            imgToRefs.setdefault(image_id, []).append(ref)
+            catToRefs.setdefault(category_id, []).append(ref)
             refToAnn[ref_id] = Anns[ann_id]
             annToRef[ann_id] = ref
 
@@ -346,3 +346,137 @@ class REFER:
             bbox = self.getRefBox(ref['ref_id'])
             box_plot = Rectangle((bbox[0], bbox[1]), bbox[2], bbox[3], fill=False, edgecolor='green', linewidth=3)
             ax.add_patch(box_plot)
+
+
+def _in_split(split_name, split):
+    # same split semantics as REFER.getRefIds
+    if split in ['testA', 'testB', 'testC']:
+        return split[-1] in split_name  # we also consider testAB, testBC, ...
+    elif split in ['testAB', 'testBC', 'testAC']:
+        return split_name == split
+    elif split == 'test':
+        return 'test' in split_name
+    elif split == 'train' or split == 'val':
+        return split_name == split
+    raise ValueError('No such split [%s]' % split)
+
+
+class ReferIndex:
+    """
+    The part of a REFER dataset the referring datasets read, as flat numpy arrays: per ref its id,
+    image id, category id, split and box, and its sentences as utf-8 bytes with offsets.
+
+    It is built once per node with REFER (see prepare_once) and cached as .npy files in
+    `<ann_dir>/refer_index(<splitBy>)/` next to the annotations. The files are memory-mapped, so the datasets sharing annotations (e.g.
+    refcoco and invrefcoco) and all the dataloader workers share their pages instead of each holding
+    the parsed instances.json. The cache is rebuilt when the annotation files change.
+    """
+
+    FIELDS = ['ref_ids', 'ref_order', 'image_ids', 'cat_ids', 'splits', 'boxes',
+              'sent_offsets', 'sent_byte_offsets', 'sent_bytes']
+    _loaded = {}  # index_dir -> ReferIndex, shared by the datasets of a process
+
+    def __init__(self, index_dir):
+        with open(os.path.join(index_dir, 'meta.json')) as f:
+            self.split_names = json.load(f)['split_names']
+        for name in self.FIELDS:
+            setattr(self, name, np.load(os.path.join(index_dir, name + '.npy'), mmap_mode='r'))
+
+    @classmethod
+    def load(cls, data_root, vis_root, dataset='refcoco', splitBy='unc'):
+        ann_dir = os.path.join(data_root, dataset.split('inv')[-1])
+        index_dir = os.path.abspath(os.path.join(ann_dir, 'refer_index(' + splitBy + ')'))
+        if index_dir not in cls._loaded:
+            sources = [os.path.join(ann_dir, 'refs(' + splitBy + ').p'), os.path.join(ann_dir, 'instances.json')]
+            stamp = [[path, os.path.getsize(path), os.path.getmtime(path)] for path in sources]
+            prepare_once(lambda: cls._is_valid(index_dir, stamp),
+                         lambda: cls.build(REFER(data_root, vis_root, dataset, splitBy), index_dir, stamp))
+            cls._loaded[index_dir] = cls(index_dir)
+        return cls._loaded[index_dir]
+
+    @classmethod
+    def _is_valid(cls, index_dir, stamp):
+        meta_path = os.path.join(index_dir, 'meta.json')
+        if not os.path.isfile(meta_path):
+            return False
+        with open(meta_path) as f:
+            return json.load(f)['sources'] == stamp
+
+    @classmethod
+    def build(cls, refer, index_dir, stamp):
+        print('caching refer index to %s...' % index_dir)
+        refs = refer.data['refs']
+        split_names = sorted(set(ref['split'] for ref in refs))
+        split_codes = {name: code for code, name in enumerate(split_names)}
+        sents = [sent['raw'].encode('utf-8') for ref in refs for sent in ref['sentences']]
+        ref_ids = np.array([ref['ref_id'] for ref in refs], dtype=np.int64)
+
+        arrays = {
+            'ref_ids': ref_ids,
+            'ref_order': np.argsort(ref_ids, kind='stable'),
+            'image_ids': np.array([ref['image_id'] for ref in refs], dtype=np.int64),
+            'cat_ids': np.array([ref['category_id'] for ref in refs], dtype=np.int64),
+            'splits': np.array([split_codes[ref['split']] for ref in refs], dtype=np.int16),
+            'boxes': np.array([refer.refToAnn[ref['ref_id']]['bbox'] for ref in refs], dtype=np.float64).reshape(-1, 4),
+            'sent_offsets': np.cumsum([0] + [len(ref['sentences']) for ref in refs], dtype=np.int64),
+            'sent_byte_offsets': np.cumsum([0] + [len(sent) for sent in sents], dtype=np.int64),
+            'sent_bytes': np.frombuffer(b''.join(sents), dtype=np.uint8),
+        }
+
+        # every file is replaced atomically and meta.json, written last, marks the cache as complete,
+        # so the builds of several nodes sharing the annotations are safe
+        os.makedirs(index_dir, exist_ok=True)
+        for name, array in arrays.items():
+            tmp_path = os.path.join(index_dir, '%s.%d.tmp.npy' % (name, os.getpid()))
+            np.save(tmp_path, array)
+            os.replace(tmp_path, os.path.join(index_dir, name + '.npy'))
+        tmp_path = os.path.join(index_dir, 'meta.%d.tmp' % os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'split_names': split_names, 'sources': stamp}, f)
+        os.replace(tmp_path, os.path.join(index_dir, 'meta.json'))
+
+    def __len__(self):
+        return len(self.ref_ids)
+
+    def _position(self, ref_id):
+        i = np.searchsorted(self.ref_ids, ref_id, sorter=self.ref_order)
+        assert i < len(self.ref_ids) and self.ref_ids[self.ref_order[i]] == ref_id, 'No ref %s' % ref_id
+        return self.ref_order[i]
+
+    def getRefIds(self, image_ids=[], cat_ids=[], ref_ids=[], split=''):
+        image_ids = image_ids if type(image_ids) == list else [image_ids]
+        cat_ids = cat_ids if type(cat_ids) == list else [cat_ids]
+        ref_ids = ref_ids if type(ref_ids) == list else [ref_ids]
+
+        mask = np.ones(len(self.ref_ids), dtype=bool)
+        if image_ids:
+            mask &= np.isin(self.image_ids, image_ids)
+        if cat_ids:
+            mask &= np.isin(self.cat_ids, cat_ids)
+        if ref_ids:
+            mask &= np.isin(self.ref_ids, ref_ids)
+        if split:
+            codes = [code for code, name in enumerate(self.split_names) if _in_split(name, split)]
+            mask &= np.isin(self.splits, codes)
+        return self.ref_ids[mask].tolist()
+
+    def loadRefs(self, ref_ids=[]):
+        ref_ids = ref_ids if type(ref_ids) == list else [ref_ids]
+        refs = []
+        for ref_id in ref_ids:
+            i = self._position(ref_id)
+            sentences = []
+            for j in range(self.sent_offsets[i], self.sent_offsets[i + 1]):
+                raw = bytes(self.sent_bytes[self.sent_byte_offsets[j]:self.sent_byte_offsets[j + 1]])
+                sentences.append({'raw': raw.decode('utf-8')})
+            refs.append({
+                'ref_id': int(self.ref_ids[i]),
+                'image_id': int(self.image_ids[i]),
+                'category_id': int(self.cat_ids[i]),
+                'split': self.split_names[self.splits[i]],
+                'sentences': sentences,
+            })
+        return refs
+
+    def getRefBox(self, ref_id):
+        return self.boxes[self._position(ref_id)].tolist()  # [x, y, w, h]
@@ -5,11 +5,19 @@
  For full license text, see the LICENSE_Lavis file in the repo root or https://opensource.org/licenses/BSD-3-Clause
 """
 
+import json
+import logging
+import os
+import threading
 import time
 import random
+from collections import deque
+from queue import Full, Queue
+
 import torch
-from minigpt4.datasets.data_utils import move_to_cuda
-from torch.utils.data import DataLoader
+from minigpt4.datasets.data_utils import apply_to_sample
+from torch.utils.data import BatchSampler, DataLoader, Sampler
+from torch.utils.data.dataloader import default_collate
 
 
 class MultiIterLoader:
@@ -19,9 +27,16 @@ class MultiIterLoader:
     Args:
         loaders (List[Loader]): List of Iterator loaders.
         ratios (List[float]): List of ratios to sample from each loader. If None, all loaders are sampled uniformly.
+        seed (int): Seed of the initial phase of the schedule.
+
+    The loader of each step follows a deterministic smooth schedule instead of random draws: at
+    every step each loader earns its ratio as credit, and the loader with the most credit is
+    taken and pays one step. Over any window of steps each loader stays within about one batch of
+    its ratio, and the schedule is the same on every rank, so all ranks draw from the same dataset
+    at each step. The schedule and the wrapped loaders are saved by state_dict.
     """
 
-    def __init__(self, loaders, ratios=None):
+    def __init__(self, loaders, ratios=None, seed=0):
         # assert all loaders has __next__ method
         for loader in loaders:
             assert hasattr(
@@ -32,16 +47,48 @@ class MultiIterLoader:
             ratios = [1.0] * len(loaders)
         else:
             assert len(ratios) == len(loaders)
-            ratios = [float(ratio) / sum(ratios) for ratio in ratios]
+        ratios = [float(ratio) / sum(ratios) for ratio in ratios]
 
         self.loaders = loaders
         self.ratios = ratios
 
+        rng = random.Random(seed)
+        self.credits = [rng.random() for _ in loaders]
+        self.counts = [0] * len(loaders)
+
     def __next__(self):
-        # random sample from each loader by ratio
-        loader_idx = random.choices(range(len(self.loaders)), self.ratios, k=1)[0]
+        for i, ratio in enumerate(self.ratios):
+            self.credits[i] += ratio
+        loader_idx = max(range(len(self.loaders)), key=lambda i: self.credits[i])
+        self.credits[loader_idx] -= 1.0
+        self.counts[loader_idx] += 1
         return next(self.loaders[loader_idx])
 
+    def mixture_metrics(self):
+        num_steps = max(sum(self.counts), 1)
+        return {
+            "ratios": [round(ratio, 4) for ratio in self.ratios],
+            "realized_ratios": [round(count / num_steps, 4) for count in self.counts],
+        }
+
+    def prefetch_metrics(self):
+        return [loader.prefetch_metrics() for loader in self.loaders if hasattr(loader, "prefetch_metrics")]
+
+    def state_dict(self):
+        return {
+            "credits": list(self.credits),
+            "counts": list(self.counts),
+            "loaders": [loader.state_dict() if hasattr(loader, "state_dict") else None for loader in self.loaders],
+        }
+
+    def load_state_dict(self, state_dict):
+        assert len(state_dict["loaders"]) == len(self.loaders), "The datasets of the checkpoint differ."
+        self.credits = list(state_dict["credits"])
+        self.counts = list(state_dict["counts"])
+        for loader, loader_state in zip(self.loaders, state_dict["loaders"]):
+            if loader_state is not None and hasattr(loader, "load_state_dict"):
+                loader.load_state_dict(loader_state)
+
 
 class PrefetchLoader(object):
     """
@@ -49,79 +96,265 @@ class PrefetchLoader(object):
 
     overlap compute and cuda data transfer
     (copied and then modified from nvidia apex)
+
+    Up to `depth` batches ahead are copied to the gpu from pinned memory on a side stream. Without
+    cuda, a thread prefetches `depth` batches instead, so the same code path runs on cpu machines.
+    metrics() reports the average number of prefetched batches when a batch is taken and the
+    average time the training loop waited for it.
     """
 
-    def __init__(self, loader):
+    def __init__(self, loader, image_transform=None, depth=1):
         self.loader = loader
-        self.stream = torch.cuda.Stream()
+        self.depth = max(1, depth)
+        self.use_cuda = torch.cuda.is_available()
+        self.stream = torch.cuda.Stream() if self.use_cuda else None
+        # applied on the prefetch stream to the list of images collated by RawImageCollater
+        self.image_transform = image_transform
+        self.reset_metrics()
 
     def __iter__(self):
-        loader_it = iter(self.loader)
-        self.preload(loader_it)
-        batch = self.next(loader_it)
-        while batch is not None:
-            is_tuple = isinstance(batch, tuple)
-            if is_tuple:
-                task, batch = batch
-
-            if is_tuple:
-                yield task, batch
-            else:
-                yield batch
-            batch = self.next(loader_it)
+        if self.use_cuda:
+            return self._cuda_iter()
+        return self._thread_iter()
 
     def __len__(self):
         return len(self.loader)
 
-    def preload(self, it):
-        try:
-            self.batch = next(it)
-        except StopIteration:
-            self.batch = None
-            return
-        # if record_stream() doesn't work, another option is to make sure
-        # device inputs are created on the main stream.
-        # self.next_input_gpu = torch.empty_like(self.next_input,
-        #                                        device='cuda')
-        # self.next_target_gpu = torch.empty_like(self.next_target,
-        #                                         device='cuda')
-        # Need to make sure the memory allocated for next_* is not still in use
-        # by the main stream at the time we start copying to next_*:
-        # self.stream.wait_stream(torch.cuda.current_stream())
-        with torch.cuda.stream(self.stream):
-            self.batch = move_to_cuda(self.batch)
-            # more code for the alternative if record_stream() doesn't work:
-            # copy_ will record the use of the pinned source tensor in this
-            # side stream.
-            # self.next_input_gpu.copy_(self.next_input, non_blocking=True)
-            # self.next_target_gpu.copy_(self.next_target, non_blocking=True)
-            # self.next_input = self.next_input_gpu
-            # self.next_target = self.next_target_gpu
-
-    def next(self, it):
-        torch.cuda.current_stream().wait_stream(self.stream)
-        batch = self.batch
-        if batch is not None:
-            record_cuda_stream(batch)
-        self.preload(it)
+    def reset_metrics(self):
+        self._num_batches = 0
+        self._queue_depth = 0
+        self._stall_time = 0.0
+
+    def metrics(self):
+        num_batches = max(self._num_batches, 1)
+        return {
+            "prefetch_queue_depth": self._queue_depth / num_batches,
+            "prefetch_stall_time": self._stall_time / num_batches,
+        }
+
+    def _transform(self, batch):
+        if self.image_transform is not None and isinstance(batch, dict) and isinstance(batch.get("image"), list):
+            batch["image"] = self.image_transform(batch["image"])
         return batch
 
+    def _cuda_iter(self):
+        loader_it = iter(self.loader)
+        queue = deque()
+        exhausted = False
+        while True:
+            start = time.time()
+            # the current batch and `depth` batches ahead
+            while not exhausted and len(queue) <= self.depth:
+                try:
+                    queue.append(self._copy_to_cuda(next(loader_it)))
+                except StopIteration:
+                    exhausted = True
+            if not queue:
+                return
+
+            batch, tensors, copied = queue.popleft()
+            stream = torch.cuda.current_stream()
+            stream.wait_event(copied)
+            # the tensors were allocated on the side stream
+            for tensor in tensors:
+                tensor.record_stream(stream)
+
+            self._num_batches += 1
+            self._queue_depth += len(queue)
+            self._stall_time += time.time() - start
+            yield batch
+
+    def _copy_to_cuda(self, batch):
+        tensors = []
+
+        def _copy(tensor):
+            if not tensor.is_pinned():
+                tensor = tensor.pin_memory()
+            tensor = tensor.cuda(non_blocking=True)
+            tensors.append(tensor)
+            return tensor
+
+        with torch.cuda.stream(self.stream):
+            batch = apply_to_sample(_copy, batch)
+            batch = self._transform(batch)
+            if isinstance(batch, dict) and torch.is_tensor(batch.get("image")):
+                tensors.append(batch["image"])
+            copied = torch.cuda.Event()
+            copied.record(self.stream)
+        return batch, tensors, copied
+
+    def _thread_iter(self):
+        queue = Queue(maxsize=self.depth)
+        stop = threading.Event()
+
+        def _put(item):
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    continue
+            return False
+
+        def _produce():
+            try:
+                for batch in self.loader:
+                    if not _put((self._transform(batch), None)):
+                        return
+                _put((_END, None))
+            except Exception as e:
+                _put((_END, e))
+
+        thread = threading.Thread(target=_produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = time.time()
+                queue_depth = queue.qsize()
+                batch, error = queue.get()
+                if error is not None:
+                    raise error
+                if batch is _END:
+                    return
+                self._num_batches += 1
+                self._queue_depth += queue_depth
+                self._stall_time += time.time() - start
+                yield batch
+        finally:
+            stop.set()
+
     def __getattr__(self, name):
         method = self.loader.__getattribute__(name)
         return method
 
 
-def record_cuda_stream(batch):
-    if isinstance(batch, torch.Tensor):
-        batch.record_stream(torch.cuda.current_stream())
-    elif isinstance(batch, list) or isinstance(batch, tuple):
-        for t in batch:
-            record_cuda_stream(t)
-    elif isinstance(batch, dict):
-        for t in batch.values():
-            record_cuda_stream(t)
-    else:
-        pass
+_END = object()
+
+
+class RawImageCollater:
+    """
+    Collate samples whose "image" is a decoded uint8 tensor of its own size (device_preprocess of
+    the BLIP-2 image processors): the images are kept as a list, the rest is collated by collate_fn.
+    """
+
+    def __init__(self, collate_fn=None):
+        self.collate_fn = collate_fn or default_collate
+
+    def __call__(self, samples):
+        images = [sample.pop("image") for sample in samples]
+        batch = self.collate_fn(samples)
+        batch["image"] = images
+        return batch
+
+
+class ApproxLengthMixin:
+    """
+    Datasets implementing `sample_texts(index)`, the texts of a sample read from its annotation
+    only, get `approx_length(index)` for get_sample_lengths.
+    """
+
+    def sample_texts(self, index):
+        raise NotImplementedError
+
+    def approx_length(self, index):
+        """Approximate token length of a sample: its number of words."""
+        return sum(len(text.split()) for text in self.sample_texts(index))
+
+
+def get_sample_lengths(dataset, cache_dir):
+    """
+    Approximate length of every sample of a dataset implementing `approx_length(index)`, cached in
+    `cache_dir` as json. The cache is recomputed when the dataset size or a few probed lengths differ.
+    """
+    name = "{}_{}_{}.json".format(getattr(dataset, "name", "dataset"), type(dataset).__name__, len(dataset))
+    cache_path = os.path.join(cache_dir, name)
+    probe = list(range(0, len(dataset), max(1, len(dataset) // 16)))
+    probe_lengths = [dataset.approx_length(i) for i in probe]
+
+    if os.path.isfile(cache_path):
+        with open(cache_path) as f:
+            lengths = json.load(f)
+        if len(lengths) == len(dataset) and [lengths[i] for i in probe] == probe_lengths:
+            return lengths
+        logging.info("Stale sample length cache {}, recomputing.".format(cache_path))
+
+    lengths = [dataset.approx_length(i) for i in range(len(dataset))]
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = "{}.{}.tmp".format(cache_path, os.getpid())
+    with open(tmp_path, "w") as f:
+        json.dump(lengths, f)
+    os.replace(tmp_path, cache_path)  # atomic, every rank may write it
+    logging.info("Sample lengths of {} cached to {}.".format(getattr(dataset, "name", "dataset"), cache_path))
+    return lengths
+
+
+class LengthGroupedBatchSampler(Sampler):
+    """
+    A distributed batch sampler putting samples of similar length into the same batch.
+
+    Every epoch, the indices are shuffled with `seed + epoch` (the same permutation on every rank)
+    and cut into groups of `group_size` global batches of batch_size * num_replicas samples. Each
+    group is sorted by length and split into global batches, whose order is shuffled again. Rank r
+    takes the r-th slice of every global batch. The data seen in an epoch is the same as with random
+    shuffling; the last incomplete global batch is dropped.
+
+    Set `start_batch` (see IterLoader.load_state_dict) to resume in the middle of an epoch.
+    """
+
+    def __init__(self, lengths, batch_size, num_replicas=1, rank=0, group_size=50, seed=0):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.group_size = group_size
+        self.seed = seed
+        self.epoch = 0
+        self.start_batch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.lengths) // (self.batch_size * self.num_replicas)
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        indices = torch.randperm(len(self.lengths), generator=g).tolist()
+
+        global_batch_size = self.batch_size * self.num_replicas
+        group_len = global_batch_size * self.group_size
+        batches = []
+        for start in range(0, len(indices), group_len):
+            group = sorted(indices[start:start + group_len], key=lambda i: self.lengths[i], reverse=True)
+            batches.extend(group[i:i + global_batch_size]
+                           for i in range(0, len(group) - global_batch_size + 1, global_batch_size))
+        order = torch.randperm(len(batches), generator=g).tolist()
+
+        start_batch, self.start_batch = self.start_batch, 0
+        for batch_idx in order[start_batch:]:
+            yield batches[batch_idx][self.rank * self.batch_size:(self.rank + 1) * self.batch_size]
+
+
+class ResumableBatchSampler(BatchSampler):
+    """
+    A BatchSampler that forwards set_epoch to its sampler and can start an epoch at batch
+    `start_batch` (see IterLoader.load_state_dict); the skipped batches only cost their indices.
+    """
+
+    def __init__(self, sampler, batch_size, drop_last):
+        super().__init__(sampler, batch_size, drop_last)
+        self.start_batch = 0
+
+    def set_epoch(self, epoch):
+        if hasattr(self.sampler, "set_epoch"):
+            self.sampler.set_epoch(epoch)
+
+    def __iter__(self):
+        start_batch, self.start_batch = self.start_batch, 0
+        for batch_idx, batch in enumerate(super().__iter__()):
+            if batch_idx >= start_batch:
+                yield batch
 
 
 class IterLoader:
@@ -137,24 +370,58 @@ class IterLoader:
         self.iter_loader = iter(self._dataloader)
         self._use_distributed = use_distributed
         self._epoch = 0
+        self._iters = 0  # batches consumed in the current epoch
 
     @property
     def epoch(self) -> int:
         return self._epoch
 
+    def _set_sampler_epoch(self, epoch):
+        batch_sampler = getattr(self._dataloader, "batch_sampler", None)
+        if hasattr(batch_sampler, "set_epoch"):
+            # ResumableBatchSampler, LengthGroupedBatchSampler: reshuffled every epoch also without
+            # distributed training
+            batch_sampler.set_epoch(epoch)
+        elif hasattr(self._dataloader.sampler, "set_epoch") and self._use_distributed:
+            self._dataloader.sampler.set_epoch(epoch)
+
     def __next__(self):
         try:
             data = next(self.iter_loader)
         except StopIteration:
             self._epoch += 1
-            if hasattr(self._dataloader.sampler, "set_epoch") and self._use_distributed:
-                self._dataloader.sampler.set_epoch(self._epoch)
+            self._iters = 0
+            self._set_sampler_epoch(self._epoch)
             time.sleep(2)  # Prevent possible deadlock during epoch transition
             self.iter_loader = iter(self._dataloader)
             data = next(self.iter_loader)
 
+        self._iters += 1
         return data
 
+    def prefetch_metrics(self):
+        if hasattr(self._dataloader, "metrics"):
+            return self._dataloader.metrics()
+        return {}
+
+    def state_dict(self):
+        return {"epoch": self._epoch, "iters": self._iters}
+
+    def load_state_dict(self, state_dict):
+        """
+        Restart from the epoch of the state. Consumed batches are skipped if the batch sampler
+        supports it (ResumableBatchSampler, LengthGroupedBatchSampler), otherwise the epoch
+        restarts from its beginning.
+        """
+        self._epoch = state_dict["epoch"]
+        self._iters = 0
+        self._set_sampler_epoch(self._epoch)
+        batch_sampler = getattr(self._dataloader, "batch_sampler", None)
+        if hasattr(batch_sampler, "start_batch"):
+            batch_sampler.start_batch = state_dict["iters"]
+            self._iters = state_dict["iters"]
+        self.iter_loader = iter(self._dataloader)
+
     def __iter__(self):
         return self
 
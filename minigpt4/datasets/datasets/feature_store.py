@@ -0,0 +1,164 @@
+import json
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from minigpt4.datasets.datasets.image_io import load_image
+
+
+def image_key(path):
+    """Key of an image in a feature store: its file path, which does not depend on the annotation order."""
+    return os.path.normpath(path)
+
+
+def processor_meta(processor):
+    """Identify the vis_processor the features are computed with."""
+    return {"vis_processor": type(processor).__name__, "image_size": getattr(processor, "image_size", None)}
+
+
+class RecordImageKeys:
+    """
+    vis_processor wrapper for the extraction: the processed image is returned with the key and
+    the original size of its file, as (key, (width, height), image).
+    """
+
+    def __init__(self, processor):
+        self.processor = processor
+        self.image_size = getattr(processor, "image_size", None)
+
+    def load_image(self, path):
+        # see image_io.load_image
+        image, orig_size = load_image(path, self.processor)
+        return (image_key(path), orig_size, image), orig_size
+
+    def __call__(self, item):
+        key, orig_size, image = item
+        return key, orig_size, self.processor(image)
+
+
+class FeatureLookup:
+    """
+    vis_processor of a dataset trained on precomputed features. image_io.load_image returns the
+    stored features of the image file, and its original size, without opening the file; calling
+    it then passes the features through.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def load_image(self, path):
+        key = image_key(path)
+        return self.store[key], self.store.orig_size(key)
+
+    def __call__(self, feats):
+        return feats
+
+
+class FeatureStoreWriter:
+    """
+    Write precomputed image features to `<path>/shard_xxxxx.npy` files of `shard_size` rows,
+    with `<path>/index.json` mapping every key to its (shard, row, width, height).
+    """
+
+    def __init__(self, path, shard_size=4096, meta=None):
+        self.path = path
+        self.shard_size = shard_size
+        self.meta = meta or {}
+        os.makedirs(path, exist_ok=True)
+
+        self.index = {}
+        self.num_shards = 0
+        self._rows = []
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def add(self, key, feats, orig_size):
+        if key in self.index:
+            return
+        self.index[key] = (self.num_shards, len(self._rows)) + tuple(orig_size)
+        self._rows.append(feats.detach().cpu().numpy())
+        if len(self._rows) == self.shard_size:
+            self._flush()
+
+    def close(self):
+        if self._rows:
+            self._flush()
+        meta = dict(self.meta, num_shards=self.num_shards, num_features=len(self.index), key="image_path")
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        with open(os.path.join(self.path, "index.json"), "w") as f:
+            json.dump(self.index, f)
+
+    def _flush(self):
+        shard_path = os.path.join(self.path, "shard_{:05d}.npy".format(self.num_shards))
+        np.save(shard_path, np.stack(self._rows))
+        self._rows = []
+        self.num_shards += 1
+
+
+class FeatureStore:
+    """Read-only view of a directory written by FeatureStoreWriter. Shards are memory-mapped on first use."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "index.json")) as f:
+            self.index = json.load(f)
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self._shards = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def orig_size(self, key):
+        return tuple(self.index[key][2:])
+
+    def __getitem__(self, key):
+        shard, row = self.index[key][:2]
+        if shard not in self._shards:
+            shard_path = os.path.join(self.path, "shard_{:05d}.npy".format(shard))
+            self._shards[shard] = np.load(shard_path, mmap_mode="r")
+        return torch.from_numpy(np.array(self._shards[shard][row]))
+
+
+class PrecomputedFeatureDataset(Dataset):
+    """
+    Wrap a map-style dataset so that its samples carry the precomputed features of their image
+    under "image_feats" instead of the processed "image". The wrapped dataset's vis_processor is
+    replaced by a FeatureLookup, so its image files are not opened at all.
+
+    The features are those of the vis_processor of the extraction (the train one, see
+    extract_features.py), so only the train split is wrapped; the store must match the
+    dataset's vis_processor.
+    """
+
+    def __init__(self, dataset, feature_path):
+        self.dataset = dataset
+        self.store = FeatureStore(feature_path)
+        assert self.store.meta.get("key") == "image_path", \
+            "{} is keyed by sample index, run extract_features.py again.".format(feature_path)
+        expected = processor_meta(dataset.vis_processor)
+        stored = {k: self.store.meta.get(k) for k in expected}
+        assert stored == expected, \
+            "The features of {} are computed with {}, the dataset uses {}.".format(feature_path, stored, expected)
+        self.dataset.vis_processor = FeatureLookup(self.store)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        sample = self.dataset[index]
+        sample["image_feats"] = sample.pop("image")
+        return sample
+
+    def __getattr__(self, name):
+        # name, sample_ratio, collater, ... of the wrapped dataset
+        if name == "dataset":
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
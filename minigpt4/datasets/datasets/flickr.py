@@ -14,8 +14,10 @@ from matplotlib.patches import Polygon, Rectangle
 from torch.utils.data import Dataset
 import webdataset as wds
 
+from minigpt4.datasets.datasets.annotation_store import load_annotations
 from minigpt4.datasets.datasets.base_dataset import BaseDataset
 from minigpt4.datasets.datasets.caption_datasets import CaptionDataset
+from minigpt4.datasets.datasets.image_io import load_image
 
 
 class GroundedDetailDataset(Dataset):
@@ -36,8 +38,7 @@ class GroundedDetailDataset(Dataset):
             '[grounding] give a thorough description of what you see in this image',
         ]
 
-        with open(ann_path, 'r') as f:
-            self.ann = json.load(f)
+        self.ann = load_annotations(ann_path)
 
     def __len__(self):
         return len(self.ann)
@@ -48,7 +49,7 @@ class GroundedDetailDataset(Dataset):
         # image_file = 'COCO_train2014_{}.jpg'.format(info['image_id'])
         image_file = '{}.jpg'.format(info['image_id'])
         image_path = os.path.join(self.vis_root, image_file)
-        image = Image.open(image_path).convert("RGB")
+        image = load_image(image_path, self.vis_processor)[0]
         image = self.vis_processor(image)
 
         answer = info['grounded_caption']
@@ -80,8 +81,7 @@ class CaptionToObjectDataset(Dataset):
             '[detection] {}',
         ]
 
-        with open(ann_path, 'r') as f:
-            self.ann = json.load(f)
+        self.ann = load_annotations(ann_path)
 
     def __len__(self):
         return len(self.ann)
@@ -91,7 +91,7 @@ class CaptionToObjectDataset(Dataset):
 
         image_file = '{}.jpg'.format(info['image_id'])
         image_path = os.path.join(self.vis_root, image_file)
-        image = Image.open(image_path).convert("RGB")
+        image = load_image(image_path, self.vis_processor)[0]
         image = self.vis_processor(image)
 
         input = info["caption"]
@@ -129,8 +129,7 @@ class PhraseToObjectDataset(Dataset):
             '[detection] {}',
         ]
 
-        with open(ann_path, 'r') as f:
-            self.ann = json.load(f)
+        self.ann = load_annotations(ann_path)
 
     def __len__(self):
         return len(self.ann)
@@ -139,7 +138,7 @@ class PhraseToObjectDataset(Dataset):
         info = self.ann[index]
         image_file = '{}.jpg'.format(info['image_id'])
         image_path = os.path.join(self.vis_root, image_file)
-        image = Image.open(image_path).convert("RGB")
+        image = load_image(image_path, self.vis_processor)[0]
         image = self.vis_processor(image)
 
         input = info["phrase"]
@@ -11,6 +11,7 @@ import json
 from PIL import Image
 
 from minigpt4.datasets.datasets.vqa_datasets import VQADataset
+from minigpt4.datasets.datasets.image_io import load_image
 
 from collections import OrderedDict
 import random
@@ -42,7 +43,7 @@ class GQADataset(VQADataset, __DisplMixin):
         ann = self.annotation[index]
 
         image_path = os.path.join(self.vis_root, ann["image"])
-        image = Image.open(image_path).convert("RGB")
+        image = load_image(image_path, self.vis_processor)[0]
 
         image = self.vis_processor(image)
         question = self.text_processor(ann["question"])
@@ -0,0 +1,62 @@
+import io
+from collections import OrderedDict
+
+from PIL import Image
+
+
+class ImageCache:
+    """A bounded LRU cache of decoded images, for images shared by several samples (0 disables it)."""
+
+    def __init__(self, max_size=0):
+        self.max_size = max_size
+        self._images = OrderedDict()
+
+    def get(self, key):
+        if key not in self._images:
+            return None
+        self._images.move_to_end(key)
+        return self._images[key]
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        self._images[key] = value
+        self._images.move_to_end(key)
+        while len(self._images) > self.max_size:
+            self._images.popitem(last=False)
+
+
+# per process, so every dataloader worker has its own; sized by run_cfg.image_cache_size
+image_cache = ImageCache()
+
+
+def load_image(path, processor=None):
+    """
+    Open an image as RGB and return it with its original (width, height).
+
+    The file is read in a single call. A JPEG larger than the image_size of the processor is
+    decoded at a reduced scale (DCT scaling by 1/2, 1/4 or 1/8, see PIL's Image.draft) that keeps
+    both sides at least image_size; the processor then resizes it as before. Cached images are
+    shared, they must not be modified in place.
+
+    A processor with its own load_image (see feature_store.py) replaces the decoding.
+    """
+    if hasattr(processor, "load_image"):
+        return processor.load_image(path)
+
+    target_size = getattr(processor, "image_size", None)
+    key = (path, target_size)
+    cached = image_cache.get(key)
+    if cached is not None:
+        return cached
+
+    with open(path, "rb") as f:
+        data = f.read()
+    image = Image.open(io.BytesIO(data))
+    orig_size = image.size
+    if target_size and image.format == "JPEG":
+        image.draft("RGB", (target_size, target_size))
+    image = image.convert("RGB")
+
+    image_cache.put(key, (image, orig_size))
+    return image, orig_size
@@ -12,8 +12,11 @@ from matplotlib.patches import Polygon, Rectangle
 from torch.utils.data import Dataset
 import webdataset as wds
 
+from minigpt4.datasets.datasets.annotation_store import load_annotations
 from minigpt4.datasets.datasets.base_dataset import BaseDataset
 from minigpt4.datasets.datasets.caption_datasets import CaptionDataset
+from minigpt4.datasets.datasets.dataloader_utils import ApproxLengthMixin
+from minigpt4.datasets.datasets.image_io import load_image
 
 class LlavaDetailDataset(Dataset):
     def __init__(self, vis_processor, text_processor, vis_root, ann_path):
@@ -26,8 +29,7 @@ class LlavaDetailDataset(Dataset):
         self.vis_processor = vis_processor
         self.text_processor = text_processor
 
-        with open(ann_path, 'r') as f:
-            self.ann = json.load(f)
+        self.ann = load_annotations(ann_path)
 
     def __len__(self):
         return len(self.ann)
@@ -37,7 +39,7 @@ class LlavaDetailDataset(Dataset):
 
         image_file = 'COCO_train2014_{}.jpg'.format(info['id'])
         image_path = os.path.join(self.vis_root, image_file)
-        image = Image.open(image_path).convert("RGB")
+        image = load_image(image_path, self.vis_processor)[0]
         image = self.vis_processor(image)
 
         answer = info['conversations'][1]['value']
@@ -63,8 +65,7 @@ class LlavaReasonDataset(Dataset):
         self.vis_processor = vis_processor
         self.text_processor = text_processor
 
-        with open(ann_path, 'r') as f:
-            self.ann = json.load(f)
+        self.ann = load_annotations(ann_path)
 
     def __len__(self):
         return len(self.ann)
@@ -74,7 +75,7 @@ class LlavaReasonDataset(Dataset):
 
         image_file = 'COCO_train2014_{}.jpg'.format(info['id'])
         image_path = os.path.join(self.vis_root, image_file)
-        image = Image.open(image_path).convert("RGB")
+        image = load_image(image_path, self.vis_processor)[0]
         image = self.vis_processor(image)
 
         answer = info['conversations'][1]['value']
@@ -92,7 +93,7 @@ class LlavaReasonDataset(Dataset):
 
 
 
-class LlavaConversationDataset(Dataset):
+class LlavaConversationDataset(ApproxLengthMixin, Dataset):
     def __init__(self, vis_processor, text_processor, vis_root, ann_path):
         """
         vis_root (string): Root directory of images (e.g. coco/images/)
@@ -106,20 +107,22 @@ class LlavaConversationDataset(Dataset):
         self.ann=[]
 
     
-        with open(ann_path, 'r') as f:
-            self.ann = json.load(f)
+        self.ann = load_annotations(ann_path)
 
         self.connect_sym = "!@#"
 
     def __len__(self):
         return len(self.ann)
 
+    def sample_texts(self, index):
+        return [item["value"] for item in self.ann[index]["conversations"]]
+
     def __getitem__(self, index):
         info = self.ann[index]
 
         image_file = 'COCO_train2014_{}.jpg'.format(info['id'])
         image_path = os.path.join(self.vis_root, image_file)
-        image = Image.open(image_path).convert("RGB")
+        image = load_image(image_path, self.vis_processor)[0]
         image = self.vis_processor(image)
 
         first_instruction = info['conversations'][0]['value'].replace('<image>', '').replace('\n', '').strip()
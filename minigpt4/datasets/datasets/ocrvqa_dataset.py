@@ -16,6 +16,7 @@ import webdataset as wds
 
 from minigpt4.datasets.datasets.base_dataset import BaseDataset
 from minigpt4.datasets.datasets.caption_datasets import CaptionDataset
+from minigpt4.datasets.datasets.image_io import load_image
 
 
 class OCRVQADataset(Dataset):
@@ -61,7 +62,7 @@ class OCRVQADataset(Dataset):
 
     def __getitem__(self, index):
         sample = self.data[index]
-        image = Image.open(os.path.join(self.vis_root, sample['image_path'])).convert("RGB")
+        image = load_image(os.path.join(self.vis_root, sample['image_path']), self.vis_processor)[0]
         image = self.vis_processor(image)
         question = self.text_processor(sample["question"])
         answer = self.text_processor(sample["answer"])
@@ -16,6 +16,7 @@ import webdataset as wds
 
 from minigpt4.datasets.datasets.base_dataset import BaseDataset
 from minigpt4.datasets.datasets.caption_datasets import CaptionDataset
+from minigpt4.datasets.datasets.image_io import load_image
 
 
 
@@ -64,7 +65,7 @@ class TextCapDataset(Dataset):
         image_file = '{}.jpg'.format(info['image_id'])
 
         image_path = os.path.join(self.vis_root, image_file)
-        image = Image.open(image_path).convert("RGB")
+        image = load_image(image_path, self.vis_processor)[0]
         image = self.vis_processor(image)
 
         caption = info["caption_str"]
@@ -14,11 +14,13 @@ from matplotlib.patches import Polygon, Rectangle
 from torch.utils.data import Dataset
 import webdataset as wds
 
+from minigpt4.datasets.datasets.annotation_store import load_annotations
 from minigpt4.datasets.datasets.base_dataset import BaseDataset
 from minigpt4.datasets.datasets.caption_datasets import CaptionDataset
+from minigpt4.datasets.datasets.dataloader_utils import ApproxLengthMixin
 
 
-class UnnaturalDataset(Dataset):
+class UnnaturalDataset(ApproxLengthMixin, Dataset):
     def __init__(self, text_processor, ann_path):
         """
         vis_root (string): Root directory of images (e.g. coco/images/)
@@ -26,12 +28,15 @@ class UnnaturalDataset(Dataset):
         """
         self.text_processor = text_processor
 
-        with open(ann_path, 'r') as f:
-            self.ann = json.load(f)
+        self.ann = load_annotations(ann_path)
 
     def __len__(self):
         return len(self.ann)
 
+    def sample_texts(self, index):
+        info = self.ann[index]["instances"][0]
+        return [info["instruction_with_input"], info["constraints"] or "", info["output"]]
+
     def __getitem__(self, index):
         info = self.ann[index]["instances"][0]
         instruction = info["instruction_with_input"]
@@ -7,6 +7,7 @@ import itertools
 
 import numpy as np
 from PIL import Image
+from minigpt4.datasets.datasets.image_io import load_image
 from torch.utils.data import Dataset
 from visual_genome import local
 
@@ -49,8 +50,7 @@ class ReferVisualGenomeDataset(Dataset):
         region = self.regions[index]
         image_file = region.image.url.split('/')[-2:]
         image_path = os.path.join(self.data_dir, *image_file)
-        image = Image.open(image_path).convert("RGB")
-        image_orig_size = image.size
+        image, image_orig_size = load_image(image_path, self.vis_processor)
         image = self.vis_processor(image)
         image_new_size = [100,100]
 
@@ -20,7 +20,9 @@ from peft import (
     prepare_model_for_int8_training,
 )
 
+from minigpt4.common.checkpoint import load_cached_safetensors, load_model_state
 from minigpt4.common.dist_utils import download_cached_file
+from minigpt4.common.registry import registry
 from minigpt4.common.utils import get_abs_path, is_url
 from minigpt4.models.eva_vit import create_eva_vit_g
 from minigpt4.models.modeling_llama import LlamaForCausalLM
@@ -48,16 +50,12 @@ class BaseModel(nn.Module):
             cached_file = download_cached_file(
                 url_or_filename, check_hash=False, progress=True
             )
-            checkpoint = torch.load(cached_file, map_location="cpu")
         elif os.path.isfile(url_or_filename):
-            checkpoint = torch.load(url_or_filename, map_location="cpu")
+            cached_file = url_or_filename
         else:
             raise RuntimeError("checkpoint url or path is invalid")
 
-        if "model" in checkpoint.keys():
-            state_dict = checkpoint["model"]
-        else:
-            state_dict = checkpoint
+        state_dict = load_model_state(cached_file)
 
         msg = self.load_state_dict(state_dict, strict=False)
 
@@ -140,7 +138,7 @@ class BaseModel(nn.Module):
 
     @classmethod
     def init_vision_encoder(
-        cls, model_name, img_size, drop_path_rate, use_grad_checkpoint, precision, freeze
+        cls, model_name, img_size, drop_path_rate, use_grad_checkpoint, precision, freeze, attn_backend="eager"
     ):
         logging.info('Loading VIT')
 
@@ -149,7 +147,7 @@ class BaseModel(nn.Module):
             precision = "fp32"  # fp16 is not for training
 
         visual_encoder = create_eva_vit_g(
-            img_size, drop_path_rate, use_grad_checkpoint, precision
+            img_size, drop_path_rate, use_grad_checkpoint, precision, attn_backend
         )
 
         ln_vision = LayerNorm(visual_encoder.num_features)
@@ -182,9 +180,11 @@ class BaseModel(nn.Module):
                 device_map={'': low_res_device}
             )
         else:
+            # built on the meta device and loaded shard by shard, in fp16
             llama_model = LlamaForCausalLM.from_pretrained(
                 llama_model_path,
                 torch_dtype=torch.float16,
+                low_cpu_mem_usage=True,
             )
 
         if lora_r > 0:
@@ -212,13 +212,14 @@ class BaseModel(nn.Module):
             cached_file = download_cached_file(
                 url_or_filename, check_hash=False, progress=True
             )
-            checkpoint = torch.load(cached_file, map_location="cpu")
         elif os.path.isfile(url_or_filename):
-            checkpoint = torch.load(url_or_filename, map_location="cpu")
+            cached_file = url_or_filename
         else:
             raise RuntimeError("checkpoint url or path is invalid")
 
-        state_dict = checkpoint["model"]
+        # converted once to safetensors, memory-mapped afterwards
+        state_dict = load_cached_safetensors(
+            cached_file, os.path.join(registry.get_path("cache_root"), "pretrained_safetensors"))
 
         msg = self.load_state_dict(state_dict, strict=False)
 
@@ -0,0 +1,134 @@
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+class ImageEmbeddingCache:
+    """
+    Content-addressed cache for the outputs of ``encode_img``.
+
+    Entries are keyed by a hash of the pixel tensor (or of a stable image id, such as
+    a file path with its size and mtime) plus a fingerprint of the model (architecture,
+    checkpoint and projection weights), so a cache directory can be shared between
+    processes without serving embeddings of a different checkpoint. Recently used
+    embeddings are kept in an in-memory LRU; when ``cache_dir`` is set, every entry is
+    also written to disk as a ``.npy`` file and memory-mapped on load.
+
+    Args:
+        fingerprint (str): model/checkpoint fingerprint mixed into every key.
+        max_size (int): maximum number of embeddings kept in memory.
+        cache_dir (str): optional directory of the on-disk store.
+    """
+
+    def __init__(self, fingerprint, max_size=256, cache_dir=None):
+        self.max_size = max_size
+        self.root_dir = cache_dir
+        self._entries = OrderedDict()
+        self.set_fingerprint(fingerprint)
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def set_fingerprint(self, fingerprint):
+        """Switch to the entries of another model state, e.g. after llama_proj was updated."""
+        self.fingerprint = fingerprint
+        self.cache_dir = None
+        if self.root_dir:
+            self.cache_dir = os.path.join(self.root_dir, fingerprint[:16])
+            os.makedirs(self.cache_dir, exist_ok=True)
+        self._entries.clear()
+
+    def key(self, image=None, image_id=None):
+        """
+        Hash a stable image id, or else a single pixel tensor (C, H, W), which is copied
+        to the host for it, together with the model fingerprint.
+        """
+        h = hashlib.sha1(self.fingerprint.encode())
+        if image_id is not None:
+            h.update("id:{}".format(image_id).encode())
+            return h.hexdigest()
+        image = image.detach().contiguous().cpu()
+        h.update(str((tuple(image.shape), str(image.dtype))).encode())
+        h.update(image.view(torch.uint8).numpy().tobytes())
+        return h.hexdigest()
+
+    def get(self, key):
+        emb = self._entries.get(key)
+        if emb is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return emb
+
+        if self.cache_dir is not None:
+            path = self._path(key)
+            if os.path.isfile(path):
+                # stays memory-mapped (copy-on-write), only copied when moved to the device
+                emb = torch.from_numpy(np.load(path, mmap_mode="c"))
+                self._put_memory(key, emb)
+                self.disk_hits += 1
+                return emb
+
+        self.misses += 1
+        return None
+
+    def put(self, key, emb):
+        emb = emb.detach().cpu()
+        self._put_memory(key, emb)
+
+        if self.cache_dir is not None:
+            path = self._path(key)
+            if not os.path.isfile(path):
+                tmp_path = "{}.{}.tmp".format(path, os.getpid())
+                with open(tmp_path, "wb") as f:
+                    np.save(f, emb.numpy())
+                os.replace(tmp_path, path)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        total = self.hits + self.disk_hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / total if total else 0.0,
+            "size": len(self._entries),
+        }
+
+    def _put_memory(self, key, emb):
+        self._entries[key] = emb
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".npy")
+
+
+def image_file_id(path):
+    """A stable id of an image file, which changes when the file is modified."""
+    stat = os.stat(path)
+    return "{}:{}:{}".format(os.path.abspath(path), stat.st_size, stat.st_mtime)
+
+
+def model_fingerprint(model, cfg_items=()):
+    """
+    Fingerprint a model by its class, some config values and the weights that are
+    applied after the frozen vision tower (e.g. llama_proj).
+    """
+    h = hashlib.sha1(type(model).__name__.encode())
+    for item in cfg_items:
+        h.update(str(item).encode())
+    if hasattr(model, "llama_proj"):
+        for name, tensor in sorted(model.llama_proj.state_dict().items()):
+            h.update(name.encode())
+            h.update(tensor.detach().float().cpu().numpy().tobytes())
+    fingerprint = h.hexdigest()
+    logging.info("Image embedding cache fingerprint: {}".format(fingerprint))
+    return fingerprint
@@ -5,7 +5,9 @@
 # https://github.com/facebookresearch/deit/
 # https://github.com/facebookresearch/dino
 # --------------------------------------------------------'
+import hashlib
 import math
+import os
 from functools import partial
 
 import torch
@@ -14,8 +16,11 @@ import torch.nn.functional as F
 import torch.utils.checkpoint as checkpoint
 from timm.models.layers import drop_path, to_2tuple, trunc_normal_
 from timm.models.registry import register_model
+from safetensors.torch import load_file
 
-from minigpt4.common.dist_utils import download_cached_file
+from minigpt4.common.checkpoint import save_safetensors
+from minigpt4.common.dist_utils import download_cached_file, prepare_once
+from minigpt4.common.registry import registry
 
 def _cfg(url='', **kwargs):
     return {
@@ -61,16 +66,40 @@ class Mlp(nn.Module):
         return x
 
 
+def relative_position_bias(module, dtype=None):
+    """
+    Gather module.relative_position_bias_table into the [nH, Wh*Ww+1, Wh*Ww+1] bias, in dtype
+    (the table dtype by default).
+    """
+    num_tokens = module.window_size[0] * module.window_size[1] + 1
+    bias = module.relative_position_bias_table[module.relative_position_index.view(-1)].view(
+        num_tokens, num_tokens, -1)  # Wh*Ww,Wh*Ww,nH
+    return bias.permute(2, 0, 1).contiguous().to(dtype or bias.dtype)  # nH, Wh*Ww, Wh*Ww
+
+
+ATTN_BACKENDS = ("eager", "sdpa", "chunked")
+
+
 class Attention(nn.Module):
+    """
+    attn_backend selects how softmax(q @ k.T + bias) @ v is computed:
+        "eager": the reference implementation, materializes the full attention matrix.
+        "sdpa": F.scaled_dot_product_attention with the bias as additive mask (chunked on CPU).
+        "chunked": processes attn_chunk_size queries at a time to bound the memory.
+    """
     def __init__(
             self, dim, num_heads=8, qkv_bias=False, qk_scale=None, attn_drop=0.,
-            proj_drop=0., window_size=None, attn_head_dim=None):
+            proj_drop=0., window_size=None, attn_head_dim=None, attn_backend="eager", attn_chunk_size=256):
         super().__init__()
+        assert attn_backend in ATTN_BACKENDS, "attn_backend must be one of {}".format(ATTN_BACKENDS)
+        self.attn_backend = attn_backend
+        self.attn_chunk_size = attn_chunk_size
         self.num_heads = num_heads
         head_dim = dim // num_heads
         if attn_head_dim is not None:
             head_dim = attn_head_dim
         all_head_dim = head_dim * self.num_heads
+        self.head_dim = head_dim
         self.scale = qk_scale or head_dim ** -0.5
 
         self.qkv = nn.Linear(dim, all_head_dim * 3, bias=False)
@@ -125,16 +154,54 @@ class Attention(nn.Module):
         qkv = qkv.reshape(B, N, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]   # make torchscript happy (cannot use tensor as tuple)
 
+        if self.attn_backend == "eager":
+            x = self.eager_attention(q, k, v, rel_pos_bias)
+        elif self.attn_backend == "sdpa" and q.is_cuda and hasattr(F, "scaled_dot_product_attention"):
+            x = self.sdpa_attention(q, k, v, self.attention_bias(rel_pos_bias, dtype=q.dtype))
+        else:
+            x = self.chunked_attention(q, k, v, self.attention_bias(rel_pos_bias))
+        x = x.transpose(1, 2).reshape(B, N, -1)
+
+        x = self.proj(x)
+        x = self.proj_drop(x)
+        return x
+
+    def attention_bias(self, rel_pos_bias=None, dtype=None):
+        """The additive bias [1, nH, N, N] of the attention scores, None if there is none."""
+        bias = None
+        if self.relative_position_bias_table is not None:
+            bias = relative_position_bias(self, dtype).unsqueeze(0)  # 1, nH, Wh*Ww, Wh*Ww
+        if rel_pos_bias is not None:
+            bias = rel_pos_bias if bias is None else bias + rel_pos_bias
+        return bias
+
+    def sdpa_attention(self, q, k, v, bias=None):
+        if bias is not None:
+            bias = bias.to(q.dtype).expand(q.shape[0], -1, -1, -1)
+        # sdpa scales by head_dim ** -0.5, fold a custom qk_scale into q
+        return F.scaled_dot_product_attention(
+            q * (self.scale * self.head_dim ** 0.5), k, v, attn_mask=bias,
+            dropout_p=self.attn_drop.p if self.training else 0.)
+
+    def chunked_attention(self, q, k, v, bias=None):
+        q = q * self.scale
+        out = []
+        for start in range(0, q.shape[2], self.attn_chunk_size):
+            end = start + self.attn_chunk_size
+            attn = q[:, :, start:end] @ k.transpose(-2, -1)
+            if bias is not None:
+                attn = attn + bias[..., start:end, :]
+            attn = attn.softmax(dim=-1)
+            attn = self.attn_drop(attn)
+            out.append(attn @ v)
+        return torch.cat(out, dim=2)
+
+    def eager_attention(self, q, k, v, rel_pos_bias=None):
         q = q * self.scale
         attn = (q @ k.transpose(-2, -1))
 
         if self.relative_position_bias_table is not None:
-            relative_position_bias = \
-                self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
-                    self.window_size[0] * self.window_size[1] + 1,
-                    self.window_size[0] * self.window_size[1] + 1, -1)  # Wh*Ww,Wh*Ww,nH
-            relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
-            attn = attn + relative_position_bias.unsqueeze(0)
+            attn = attn + relative_position_bias(self).unsqueeze(0)
 
         if rel_pos_bias is not None:
             attn = attn + rel_pos_bias
@@ -142,22 +209,20 @@ class Attention(nn.Module):
         attn = attn.softmax(dim=-1)
         attn = self.attn_drop(attn)
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, -1)
-        x = self.proj(x)
-        x = self.proj_drop(x)
-        return x
+        return attn @ v
 
 
 class Block(nn.Module):
 
     def __init__(self, dim, num_heads, mlp_ratio=4., qkv_bias=False, qk_scale=None, drop=0., attn_drop=0.,
                  drop_path=0., init_values=None, act_layer=nn.GELU, norm_layer=nn.LayerNorm,
-                 window_size=None, attn_head_dim=None):
+                 window_size=None, attn_head_dim=None, attn_backend="eager"):
         super().__init__()
         self.norm1 = norm_layer(dim)
         self.attn = Attention(
             dim, num_heads=num_heads, qkv_bias=qkv_bias, qk_scale=qk_scale,
-            attn_drop=attn_drop, proj_drop=drop, window_size=window_size, attn_head_dim=attn_head_dim)
+            attn_drop=attn_drop, proj_drop=drop, window_size=window_size, attn_head_dim=attn_head_dim,
+            attn_backend=attn_backend)
         # NOTE: drop path for stochastic depth, we shall see if this is better than dropout here
         self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
         self.norm2 = norm_layer(dim)
@@ -236,11 +301,7 @@ class RelativePositionBias(nn.Module):
         # trunc_normal_(self.relative_position_bias_table, std=.02)
 
     def forward(self):
-        relative_position_bias = \
-            self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
-                self.window_size[0] * self.window_size[1] + 1,
-                self.window_size[0] * self.window_size[1] + 1, -1)  # Wh*Ww,Wh*Ww,nH
-        return relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
+        return relative_position_bias(self)  # nH, Wh*Ww, Wh*Ww
 
 
 class VisionTransformer(nn.Module):
@@ -250,7 +311,7 @@ class VisionTransformer(nn.Module):
                  num_heads=12, mlp_ratio=4., qkv_bias=False, qk_scale=None, drop_rate=0., attn_drop_rate=0.,
                  drop_path_rate=0., norm_layer=nn.LayerNorm, init_values=None,
                  use_abs_pos_emb=True, use_rel_pos_bias=False, use_shared_rel_pos_bias=False,
-                 use_mean_pooling=True, init_scale=0.001, use_checkpoint=False):
+                 use_mean_pooling=True, init_scale=0.001, use_checkpoint=False, attn_backend="eager"):
         super().__init__()
         self.image_size = img_size
         self.num_classes = num_classes
@@ -273,13 +334,14 @@ class VisionTransformer(nn.Module):
             self.rel_pos_bias = None
         self.use_checkpoint = use_checkpoint
         
-        dpr = [x.item() for x in torch.linspace(0, drop_path_rate, depth)]  # stochastic depth decay rule
+        dpr = [x.item() for x in torch.linspace(0, drop_path_rate, depth, device="cpu")]  # stochastic depth decay rule
         self.use_rel_pos_bias = use_rel_pos_bias
         self.blocks = nn.ModuleList([
             Block(
                 dim=embed_dim, num_heads=num_heads, mlp_ratio=mlp_ratio, qkv_bias=qkv_bias, qk_scale=qk_scale,
                 drop=drop_rate, attn_drop=attn_drop_rate, drop_path=dpr[i], norm_layer=norm_layer,
-                init_values=init_values, window_size=self.patch_embed.patch_shape if use_rel_pos_bias else None)
+                init_values=init_values, window_size=self.patch_embed.patch_shape if use_rel_pos_bias else None,
+                attn_backend=attn_backend)
             for i in range(depth)])
 #         self.norm = nn.Identity() if use_mean_pooling else norm_layer(embed_dim)
 #         self.fc_norm = norm_layer(embed_dim) if use_mean_pooling else None
@@ -412,31 +474,53 @@ def convert_weights_to_fp16(model: nn.Module):
     model.apply(_convert_weights_to_fp16)
     
     
-def create_eva_vit_g(img_size=224,drop_path_rate=0.4,use_checkpoint=False,precision="fp16"):
-    model = VisionTransformer(
-        img_size=img_size,
-        patch_size=14,
-        use_mean_pooling=False,
-        embed_dim=1408,
-        depth=39,
-        num_heads=1408//88,
-        mlp_ratio=4.3637,
-        qkv_bias=True,
-        drop_path_rate=drop_path_rate,
-        norm_layer=partial(nn.LayerNorm, eps=1e-6),
-        use_checkpoint=use_checkpoint,
-    )  
+def create_eva_vit_g(img_size=224,drop_path_rate=0.4,use_checkpoint=False,precision="fp16",attn_backend="eager"):
+    def build():
+        return VisionTransformer(
+            img_size=img_size,
+            patch_size=14,
+            use_mean_pooling=False,
+            embed_dim=1408,
+            depth=39,
+            num_heads=1408//88,
+            mlp_ratio=4.3637,
+            qkv_bias=True,
+            drop_path_rate=drop_path_rate,
+            norm_layer=partial(nn.LayerNorm, eps=1e-6),
+            use_checkpoint=use_checkpoint,
+            attn_backend=attn_backend,
+        )
+
     url = "https://storage.googleapis.com/sfr-vision-language-research/LAVIS/models/BLIP2/eva_vit_g.pth"
     cached_file = download_cached_file(
         url, check_hash=False, progress=True
     )
-    state_dict = torch.load(cached_file, map_location="cpu")    
-    interpolate_pos_embed(model,state_dict)
-    
-    incompatible_keys = model.load_state_dict(state_dict, strict=False)
-#     print(incompatible_keys)
-    
+
+    # the weights after position interpolation and fp16 conversion, memory-mapped, converted again
+    # when the downloaded file changes
+    stamp = "{}:{}".format(os.path.getsize(cached_file), os.path.getmtime(cached_file))
+    cache_path = os.path.join(registry.get_path("cache_root"), "eva_vit_g", "eva_vit_g_{}_{}_{}.safetensors".format(
+        img_size, precision, hashlib.sha1(stamp.encode("utf-8")).hexdigest()[:16]))
+    def convert():
+        model = build()
+        state_dict = torch.load(cached_file, map_location="cpu")
+        interpolate_pos_embed(model,state_dict)
+
+        incompatible_keys = model.load_state_dict(state_dict, strict=False)
+#         print(incompatible_keys)
+
+        if precision == "fp16":
+#             model.to("cuda")
+            convert_weights_to_fp16(model)
+        save_safetensors(model.state_dict(), cache_path)
+
+    prepare_once(lambda: os.path.isfile(cache_path), convert)
+
+    # built without initializing the weights, which are all loaded from the cache
+    with torch.device("meta"):
+        model = build()
     if precision == "fp16":
-#         model.to("cuda") 
         convert_weights_to_fp16(model)
-    return model
\ No newline at end of file
+    model = model.to_empty(device="cpu")
+    model.load_state_dict(load_file(cache_path, device="cpu"))
+    return model
@@ -0,0 +1,128 @@
+"""
+Helpers for running the LLaMA decoder step by step on top of explicit past_key_values.
+
+transformers' generate() ignores inputs_embeds once past_key_values are given, so the
+serving and KV-cache reuse paths drive the decoder directly with these helpers.
+"""
+
+import torch
+
+
+def llama_step(model, inputs_embeds, attention_mask=None, position_ids=None, past_key_values=None):
+    """
+    Run one forward pass of model.llama_model on inputs_embeds.
+
+    Returns the float logits of the last position [batch, vocab] and the updated past_key_values.
+    """
+    with model.maybe_autocast():
+        outputs = model.llama_model(
+            inputs_embeds=inputs_embeds,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict=True,
+        )
+    return outputs.logits[:, -1].float(), outputs.past_key_values
+
+
+def sample_next_tokens(
+    logits,
+    generated_ids=None,
+    do_sample=False,
+    temperature=1.0,
+    top_p=1.0,
+    repetition_penalty=1.0,
+    min_new_tokens=0,
+    eos_token_id=2,
+    top_k=50,
+):
+    """
+    Pick the next token of every row of logits [batch, vocab].
+
+    generated_ids ([batch, steps] LongTensor) are the tokens generated so far. As in
+    generate() with inputs_embeds, only generated tokens take part in the repetition penalty
+    and in the min length constraint. Sampling keeps the top_k (50 as in the default
+    generation config of generate(), 0 disables it) then the top_p tokens.
+    """
+    logits = logits.float()
+    num_generated = 0 if generated_ids is None else generated_ids.shape[1]
+
+    if repetition_penalty != 1.0 and num_generated > 0:
+        score = torch.gather(logits, 1, generated_ids)
+        score = torch.where(score < 0, score * repetition_penalty, score / repetition_penalty)
+        logits = logits.scatter(1, generated_ids, score)
+
+    if num_generated < min_new_tokens and eos_token_id is not None:
+        logits = logits.clone()
+        logits[:, eos_token_id] = -float("inf")
+
+    if not do_sample:
+        return logits.argmax(dim=-1)
+
+    logits = logits / max(float(temperature), 1e-5)
+    if top_k > 0 and top_k < logits.shape[-1]:
+        kth_best = torch.topk(logits, top_k, dim=-1).values[:, -1:]
+        logits = logits.masked_fill(logits < kth_best, -float("inf"))
+    if top_p < 1.0:
+        sorted_logits, sorted_idx = torch.sort(logits, descending=True)
+        sorted_probs = sorted_logits.softmax(dim=-1)
+        # drop tokens once the mass before them already reaches top_p, always keep the best token
+        sorted_remove = (sorted_probs.cumsum(dim=-1) - sorted_probs) >= top_p
+        sorted_remove[:, 0] = False
+        remove = sorted_remove.scatter(1, sorted_idx, sorted_remove)
+        logits = logits.masked_fill(remove, -float("inf"))
+    probs = logits.softmax(dim=-1)
+    return torch.multinomial(probs, num_samples=1).squeeze(1)
+
+
+def ends_with_stop(token_ids, stop_words_ids):
+    """token_ids is a python list; stop_words_ids a list of token id lists."""
+    for stop in stop_words_ids:
+        if len(stop) and token_ids[-len(stop):] == list(stop):
+            return True
+    return False
+
+
+def past_length(past_key_values):
+    return past_key_values[0][0].shape[2]
+
+
+def slice_past(past_key_values, end):
+    """Keep the first `end` positions of every layer cache."""
+    return tuple((k[:, :, :end], v[:, :, :end]) for k, v in past_key_values)
+
+
+def expand_past(past_key_values, repeats):
+    """
+    Repeat every sample of the cache `repeats` times along the batch dimension.
+    A single-sample cache is broadcast without copying it.
+    """
+    if past_key_values[0][0].shape[0] == 1:
+        return tuple(
+            (k.expand(repeats, -1, -1, -1), v.expand(repeats, -1, -1, -1))
+            for k, v in past_key_values
+        )
+    return tuple(
+        (k.repeat_interleave(repeats, dim=0), v.repeat_interleave(repeats, dim=0))
+        for k, v in past_key_values
+    )
+
+
+class PrefixCache:
+    """
+    past_key_values of a prompt prefix shared by a whole batch, see MiniGPTBase.build_prefix_cache.
+
+    Args:
+        text (str): the prompt text before the first <ImageHere>.
+        with_image (bool): whether the cache also covers the first image.
+        past_key_values: the LLaMA cache of the prefix, with a batch size of 1.
+    """
+
+    def __init__(self, text, with_image, past_key_values):
+        self.text = text
+        self.with_image = with_image
+        self.past_key_values = past_key_values
+
+    def __len__(self):
+        return past_length(self.past_key_values)
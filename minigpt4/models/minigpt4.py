@@ -5,6 +5,8 @@ import torch
 from torch.cuda.amp import autocast as autocast
 import torch.nn as nn
 
+from minigpt4.common.checkpoint import load_model_state
+from minigpt4.common.logger import startup_timer
 from minigpt4.common.registry import registry
 from minigpt4.models.base_model import disabled_train
 from minigpt4.models.minigpt_base import MiniGPTBase
@@ -31,6 +33,7 @@ class MiniGPT4(MiniGPTBase):
             use_grad_checkpoint=False,
             vit_precision="fp16",
             freeze_vit=True,
+            vit_attn_backend="eager",
             has_qformer=True,
             freeze_qformer=True,
             num_query_token=32,
@@ -49,6 +52,7 @@ class MiniGPT4(MiniGPTBase):
             use_grad_checkpoint=use_grad_checkpoint,
             vit_precision=vit_precision,
             freeze_vit=freeze_vit,
+            vit_attn_backend=vit_attn_backend,
             llama_model=llama_model,
             max_txt_len=max_txt_len,
             end_sym=end_sym,
@@ -59,10 +63,11 @@ class MiniGPT4(MiniGPTBase):
         self.has_qformer = has_qformer
         if self.has_qformer:
             print('Loading Q-Former')
-            self.Qformer, self.query_tokens = self.init_Qformer(
-                num_query_token, self.visual_encoder.num_features, freeze_qformer
-            )
-            self.load_from_pretrained(url_or_filename=q_former_model)  # load q-former weights here
+            with startup_timer.phase("qformer"):
+                self.Qformer, self.query_tokens = self.init_Qformer(
+                    num_query_token, self.visual_encoder.num_features, freeze_qformer
+                )
+                self.load_from_pretrained(url_or_filename=q_former_model)  # load q-former weights here
 
             img_f_dim = self.Qformer.config.hidden_size
             print('Loading Q-Former Done')
@@ -115,7 +120,11 @@ class MiniGPT4(MiniGPTBase):
 
         return Qformer, query_tokens
 
-    def encode_img(self, image):
+    def encode_frozen(self, image):
+        """The output of the frozen vision tower and Q-Former that is fed to llama_proj."""
+        if not self.has_qformer:
+            return super().encode_frozen(image)
+        assert self.visual_encoder is not None, "The vision encoder is dropped, use precomputed image features."
         device = image.device
 
         if len(image.shape) > 4:
@@ -123,26 +132,16 @@ class MiniGPT4(MiniGPTBase):
 
         with self.maybe_autocast():
             image_embeds = self.ln_vision(self.visual_encoder(image)).to(device)
-            if self.has_qformer:
-                image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(device)
-
-                query_tokens = self.query_tokens.expand(image_embeds.shape[0], -1, -1)
-                query_output = self.Qformer.bert(
-                    query_embeds=query_tokens,
-                    encoder_hidden_states=image_embeds,
-                    encoder_attention_mask=image_atts,
-                    return_dict=True,
-                )
-
-                inputs_llama = self.llama_proj(query_output.last_hidden_state)
-            else:
-                image_embeds = image_embeds[:, 1:, :]
-                bs, pn, hs = image_embeds.shape
-                image_embeds = image_embeds.view(bs, int(pn / 4), int(hs * 4))
-
-                inputs_llama = self.llama_proj(image_embeds)
-            atts_llama = torch.ones(inputs_llama.size()[:-1], dtype=torch.long).to(image.device)
-        return inputs_llama, atts_llama
+            image_atts = torch.ones(image_embeds.size()[:-1], dtype=torch.long).to(device)
+
+            query_tokens = self.query_tokens.expand(image_embeds.shape[0], -1, -1)
+            query_output = self.Qformer.bert(
+                query_embeds=query_tokens,
+                encoder_hidden_states=image_embeds,
+                encoder_attention_mask=image_atts,
+                return_dict=True,
+            )
+        return query_output.last_hidden_state
 
     @classmethod
     def from_config(cls, cfg):
@@ -156,6 +155,7 @@ class MiniGPT4(MiniGPTBase):
         use_grad_checkpoint = cfg.get("use_grad_checkpoint", False)
         vit_precision = cfg.get("vit_precision", "fp16")
         freeze_vit = cfg.get("freeze_vit", True)
+        vit_attn_backend = cfg.get("vit_attn_backend", "eager")
         has_qformer = cfg.get("has_qformer", True)
         freeze_qformer = cfg.get("freeze_qformer", True)
         low_resource = cfg.get("low_resource", False)
@@ -174,6 +174,7 @@ class MiniGPT4(MiniGPTBase):
             use_grad_checkpoint=use_grad_checkpoint,
             vit_precision=vit_precision,
             freeze_vit=freeze_vit,
+            vit_attn_backend=vit_attn_backend,
             has_qformer=has_qformer,
             freeze_qformer=freeze_qformer,
             num_query_token=num_query_token,
@@ -189,7 +190,26 @@ class MiniGPT4(MiniGPTBase):
         ckpt_path = cfg.get("ckpt", "")  # load weights of MiniGPT-4
         if ckpt_path:
             print("Load MiniGPT-4 Checkpoint: {}".format(ckpt_path))
-            ckpt = torch.load(ckpt_path, map_location="cpu")
-            msg = model.load_state_dict(ckpt['model'], strict=False)
+            with startup_timer.phase("ckpt"):
+                msg = model.load_state_dict(load_model_state(ckpt_path), strict=False)
+
+        # compute the training loss over vocab chunks instead of the full logits
+        model.llama_model.config.loss_chunk_size = cfg.get("loss_chunk_size", 0)
+
+        # several samples per training row, see MiniGPTBase.pack_batch
+        model.pack_sequences = cfg.get("pack_sequences", False)
+        model.pack_length = cfg.get("pack_length", 0)
+
+        if cfg.get("precomputed_image_feats", False):
+            assert freeze_qformer or not has_qformer, "precomputed image features need a frozen Q-Former"
+            model.drop_vision_encoder()
+
+        img_embed_cache_size = cfg.get("img_embed_cache_size", 0)
+        if img_embed_cache_size > 0:
+            model.enable_img_embed_cache(
+                max_size=img_embed_cache_size,
+                cache_dir=cfg.get("img_embed_cache_dir", None),
+                cfg_items=(vit_model, img_size, llama_model, ckpt_path),
+            )
 
         return model
@@ -5,8 +5,11 @@ import torch
 from torch.cuda.amp import autocast as autocast
 import torch.nn as nn
 
+from minigpt4.common.logger import startup_timer
 from minigpt4.common.registry import registry
 from minigpt4.models.base_model import BaseModel
+from minigpt4.models.embedding_cache import ImageEmbeddingCache, model_fingerprint
+from minigpt4.models.generation_utils import llama_step, sample_next_tokens, expand_past, PrefixCache
 from transformers import StoppingCriteria, StoppingCriteriaList
 
 from minigpt4.conversation.conversation import StoppingCriteriaSub
@@ -24,6 +27,7 @@ class MiniGPTBase(BaseModel):
         use_grad_checkpoint=False,
         vit_precision="fp16",
         freeze_vit=True,
+        vit_attn_backend="eager",
         llama_model="",
         max_txt_len=32,
         max_context_len=3800,
@@ -38,19 +42,21 @@ class MiniGPTBase(BaseModel):
     ):
         super().__init__()
 
-        self.llama_model, self.llama_tokenizer = self.init_llm(
-            llama_model_path=llama_model,
-            low_resource=low_resource,
-            low_res_device=device_8bit,
-            lora_r=lora_r,
-            lora_target_modules=lora_target_modules,
-            lora_alpha=lora_alpha,
-            lora_dropout=lora_dropout,
-        )
+        with startup_timer.phase("llama"):
+            self.llama_model, self.llama_tokenizer = self.init_llm(
+                llama_model_path=llama_model,
+                low_resource=low_resource,
+                low_res_device=device_8bit,
+                lora_r=lora_r,
+                lora_target_modules=lora_target_modules,
+                lora_alpha=lora_alpha,
+                lora_dropout=lora_dropout,
+            )
 
-        self.visual_encoder, self.ln_vision = self.init_vision_encoder(
-            vit_model, img_size, drop_path_rate, use_grad_checkpoint, vit_precision, freeze_vit
-        )
+        with startup_timer.phase("vit"):
+            self.visual_encoder, self.ln_vision = self.init_vision_encoder(
+                vit_model, img_size, drop_path_rate, use_grad_checkpoint, vit_precision, freeze_vit, vit_attn_backend
+            )
 
         self.max_txt_len = max_txt_len
         self.max_context_len = max_context_len
@@ -59,22 +65,116 @@ class MiniGPTBase(BaseModel):
         self.prompt_template = prompt_template
         self.prompt_list = []
 
+        self.img_embed_cache = None
+
+        self.pack_sequences = False
+        self.pack_length = 0
+
     def vit_to_cpu(self):
         self.ln_vision.to("cpu")
         self.ln_vision.float()
         self.visual_encoder.to("cpu")
         self.visual_encoder.float()
 
-    def get_context_emb(self, prompt, img_list):
-        device = img_list[0].device
+    def drop_vision_encoder(self):
+        """Free the frozen vision tower when training only on precomputed image features."""
+        self.visual_encoder = None
+        self.ln_vision = None
+        logging.info("drop vision encoder, the model expects precomputed image features")
+
+    def encode_frozen(self, image):
+        """
+        The output of the frozen vision tower that is fed to llama_proj: the ViT patch embeddings,
+        every 4 adjacent ones concatenated.
+        """
+        assert self.visual_encoder is not None, "The vision encoder is dropped, use precomputed image features."
+        device = image.device
+
+        if len(image.shape) > 4:
+            image = image.reshape(-1, *image.shape[-3:])
+
+        with self.maybe_autocast():
+            image_embeds = self.ln_vision(self.visual_encoder(image)).to(device)
+            image_embeds = image_embeds[:, 1:, :]
+            bs, pn, hs = image_embeds.shape
+            image_feats = image_embeds.view(bs, int(pn / 4), int(hs * 4))
+        return image_feats
+
+    def project_features(self, image_feats):
+        """Map the output of encode_frozen (or precomputed features) to llama embeddings."""
+        if len(image_feats.shape) > 3:
+            image_feats = image_feats.reshape(-1, *image_feats.shape[-2:])
+        with self.maybe_autocast():
+            inputs_llama = self.llama_proj(image_feats.to(self.device))
+        atts_llama = torch.ones(inputs_llama.size()[:-1], dtype=torch.long).to(inputs_llama.device)
+        return inputs_llama, atts_llama
+
+    def encode_img(self, image):
+        return self.project_features(self.encode_frozen(image))
+
+    def enable_img_embed_cache(self, max_size=256, cache_dir=None, cfg_items=()):
+        """
+        Put a content-addressed cache in front of encode_img for inference.
+        cfg_items should identify the checkpoint (e.g. vit/llama/ckpt paths).
+        """
+        fingerprint = model_fingerprint(self, cfg_items)
+        self.img_embed_cache = ImageEmbeddingCache(fingerprint, max_size=max_size, cache_dir=cache_dir)
+        self.img_embed_cache_cfg_items = cfg_items
+        self.img_embed_cache_versions = self._proj_versions()
+        return self.img_embed_cache
+
+    def _proj_versions(self):
+        # bumped by every in-place update of the weights (optimizer step, load_state_dict)
+        if not hasattr(self, "llama_proj"):
+            return ()
+        return tuple(p._version for p in self.llama_proj.parameters())
+
+    def encode_img_cached(self, image, image_ids=None):
+        """
+        encode_img with per-image lookups in the embedding cache. The cache is bypassed
+        when gradients are enabled, and its fingerprint is recomputed when llama_proj was
+        updated since it was taken (e.g. evaluation during training). `image_ids` (see
+        image_file_id) are used as keys instead of hashing the pixels.
+        """
+        if self.img_embed_cache is None or torch.is_grad_enabled():
+            return self.encode_img(image)
+
+        versions = self._proj_versions()
+        if versions != self.img_embed_cache_versions:
+            self.img_embed_cache.set_fingerprint(model_fingerprint(self, self.img_embed_cache_cfg_items))
+            self.img_embed_cache_versions = versions
+
+        device = image.device
+        if len(image.shape) > 4:
+            image = image.reshape(-1, *image.shape[-3:])
+
+        if image_ids is not None:
+            keys = [self.img_embed_cache.key(image_id=image_id) for image_id in image_ids]
+        else:
+            keys = [self.img_embed_cache.key(img) for img in image]
+        embs = [self.img_embed_cache.get(key) for key in keys]
+
+        miss_idx = [i for i, emb in enumerate(embs) if emb is None]
+        if miss_idx:
+            miss_embeds, _ = self.encode_img(image[miss_idx])
+            for i, emb in zip(miss_idx, miss_embeds):
+                self.img_embed_cache.put(keys[i], emb)
+                embs[i] = emb
+
+        inputs_llama = torch.stack([emb.to(device) for emb in embs])
+        atts_llama = torch.ones(inputs_llama.size()[:-1], dtype=torch.long).to(device)
+        return inputs_llama, atts_llama
+
+    def get_context_emb(self, prompt, img_list, add_bos=True):
+        device = img_list[0].device if img_list else self.device
         prompt_segs = prompt.split('<ImageHere>')
         assert len(prompt_segs) == len(img_list) + 1, "Unmatched numbers of image placeholders and images."
         seg_tokens = [
             self.llama_tokenizer(
-                seg, return_tensors="pt", add_special_tokens=i==0).to(device).input_ids # only add bos to the first seg
+                seg, return_tensors="pt", add_special_tokens=add_bos and i==0).to(device).input_ids # only add bos to the first seg
             for i, seg in enumerate(prompt_segs)
         ]
-        seg_embs = [self.embed_tokens(seg_t) for seg_t in seg_tokens]
+        seg_embs = [self.embed_tokens(seg_t.long()) for seg_t in seg_tokens]  # an empty segment gives float ids
 
         mixed_embs = [emb for pair in zip(seg_embs[:-1], img_list) for emb in pair] + [seg_embs[-1]]
         mixed_embs = torch.cat(mixed_embs, dim=1)
@@ -98,40 +198,65 @@ class MiniGPTBase(BaseModel):
             return prompt_embeds, atts_prompt
         else:
             # return the multi-modal embedding in right padding
-            emb_lists = []
+            # all text segments of the batch are tokenized and embedded at once, then text and image
+            # embeddings are gathered into the padded output with a single index tensor
             if isinstance(prompts, str):
                 prompts = [prompts] * len(img_embeds)
 
-            for idx, (each_img_embed, each_prompt) in enumerate(zip(img_embeds, prompts)):
-                pn = each_img_embed.shape[-2]
-                if lengths is not None:
-                    each_img_embed = each_img_embed.reshape(-1, each_img_embed.shape[-1])
-                    each_img_embed = each_img_embed[:lengths[idx] * pn]
-                p_segs = each_prompt.split('<ImageHere>')
-                interleave_emb = []
-                for idx, seg in enumerate(p_segs[:-1]):
-                    p_tokens = self.llama_tokenizer(
-                        seg, return_tensors="pt", add_special_tokens=False).to(img_embeds.device)
-                    p_embed = self.embed_tokens(p_tokens.input_ids)
-                    interleave_emb.append(torch.cat([p_embed, each_img_embed[None][:, idx * pn:(idx + 1) * pn]], dim=1))
-                wrapped_emb = torch.cat(interleave_emb, dim=1)
-                p_tokens = self.llama_tokenizer(
-                    p_segs[-1], return_tensors="pt", add_special_tokens=False).to(img_embeds.device)
-                p_embed = self.embed_tokens(p_tokens.input_ids)
-                wrapped_emb = torch.cat([wrapped_emb, p_embed], dim=1)
-                emb_lists.append(wrapped_emb)
-
-            emb_lens = [emb.shape[1] for emb in emb_lists]
-            pad_emb = self.embed_tokens(torch.tensor(self.llama_tokenizer.pad_token_id, device=img_embeds.device))
-
-            max_length = max(emb_lens) if max(emb_lens) < self.max_context_len else self.max_context_len
-            wrapped_embs = pad_emb.expand(len(emb_lens), max_length, -1).clone()
-            wrapped_atts = torch.zeros([len(emb_lens), max_length], dtype=torch.int, device=img_embeds.device)
-            
-            for i, emb in enumerate(emb_lists):
-                length = emb_lens[i] if emb_lens[i] < self.max_context_len else self.max_context_len
-                wrapped_embs[i, :length] = emb[:, :length]
-                wrapped_atts[i, :length] = 1
+            device = img_embeds.device
+            batch_size = len(prompts)
+            pn = img_embeds.shape[-2]
+            img_embeds = img_embeds.reshape(batch_size, -1, img_embeds.shape[-1])  # all images of a sample in a row
+            if lengths is not None:
+                num_img_tokens = [int(length) * pn for length in lengths]
+            else:
+                num_img_tokens = [img_embeds.shape[1]] * batch_size
+
+            p_segs = [prompt.split('<ImageHere>') for prompt in prompts]
+            self.llama_tokenizer.padding_side = "right"
+            seg_tokens = self.llama_tokenizer(
+                [seg for segs in p_segs for seg in segs],
+                return_tensors="pt",
+                padding="longest",
+                add_special_tokens=False
+            ).to(device)
+            seg_lens = seg_tokens.attention_mask.sum(1).tolist()
+            seg_width = seg_tokens.input_ids.shape[1]
+            seg_embeds = self.embed_tokens(seg_tokens.input_ids).flatten(0, 1)
+            pad_emb = self.embed_tokens(torch.tensor(self.llama_tokenizer.pad_token_id, device=device))
+
+            # rows of the gather source: [text tokens of all segments | image tokens | pad]
+            img_offset = seg_embeds.shape[0]
+            pad_index = img_offset + img_embeds.shape[0] * img_embeds.shape[1]
+            source = torch.cat([
+                seg_embeds,
+                img_embeds.flatten(0, 1).to(seg_embeds.dtype),
+                pad_emb[None],
+            ])
+
+            indices = []
+            seg_id = 0
+            for i, segs in enumerate(p_segs):
+                index = []
+                img_base = img_offset + i * img_embeds.shape[1]
+                for idx in range(len(segs)):
+                    seg_start = seg_id * seg_width
+                    index.extend(range(seg_start, seg_start + seg_lens[seg_id]))
+                    seg_id += 1
+                    if idx < len(segs) - 1:
+                        img_start = idx * pn
+                        img_end = max(img_start, min((idx + 1) * pn, num_img_tokens[i]))
+                        index.extend(range(img_base + img_start, img_base + img_end))
+                indices.append(index[:self.max_context_len])
+
+            emb_lens = [len(index) for index in indices]
+            max_length = max(emb_lens)
+            index = torch.tensor(
+                [index + [pad_index] * (max_length - len(index)) for index in indices], device=device)
+
+            wrapped_embs = source[index]
+            wrapped_atts = (torch.arange(max_length, device=device)[None] <
+                            torch.tensor(emb_lens, device=device)[:, None]).to(torch.int)
             return wrapped_embs, wrapped_atts
 
     def concat_emb_input_output(self, input_embs, input_atts, output_embs, output_atts):
@@ -139,28 +264,22 @@ class MiniGPTBase(BaseModel):
         Concatenate the batched input embedding and batched output embedding together.
         Both the input and the output embedding should be right padded.
         """
-        input_lens = []
-        cat_embs = []
-        cat_atts = []
-        for i in range(input_embs.size(0)):
-            input_len = input_atts[i].sum()
-            input_lens.append(input_len)
-            cat_embs.append(
-                torch.cat([
-                    input_embs[i][:input_len],
-                    output_embs[i],
-                    input_embs[i][input_len:]
-                ])
-            )
-            cat_atts.append(
-                torch.cat([
-                    input_atts[i][:input_len],
-                    output_atts[i],
-                    input_atts[i][input_len:]
-                ])
-            )
-        cat_embs = torch.stack(cat_embs)
-        cat_atts = torch.stack(cat_atts)
+        input_lens = input_atts.sum(1)
+        input_width, output_width = input_atts.shape[1], output_atts.shape[1]
+
+        # for each position of the result, its source position in cat([input, output], dim=1):
+        # [valid input tokens, all output tokens, input padding]
+        pos = torch.arange(input_width + output_width, device=input_atts.device)[None]
+        lens = input_lens[:, None]
+        src = torch.where(
+            pos < lens,
+            pos,
+            torch.where(pos < lens + output_width, pos - lens + input_width, pos - output_width)
+        )
+
+        cat_embs = torch.cat([input_embs, output_embs], dim=1)
+        cat_embs = cat_embs.gather(1, src[..., None].expand(-1, -1, cat_embs.shape[-1]))
+        cat_atts = torch.cat([input_atts, output_atts], dim=1).gather(1, src)
         return cat_embs, cat_atts, input_lens
 
     def tokenize_conversation(self, conv_q, conv_a):
@@ -210,8 +329,10 @@ class MiniGPTBase(BaseModel):
 
     def preparing_embedding(self, samples):
         ### prepare input tokens
-        if 'image' in samples:
-            img_embeds, img_atts = self.encode_img(samples["image"])
+        if 'image_feats' in samples:
+            img_embeds, img_atts = self.project_features(samples["image_feats"])
+        elif 'image' in samples:
+            img_embeds, img_atts = self.encode_img_cached(samples["image"])
         else:
             img_embeds = img_atts = None
 
@@ -242,7 +363,7 @@ class MiniGPTBase(BaseModel):
             if 'length' in samples:
                 # the input is a image train (like videos)
                 bsz, pn, hs = img_embeds.shape
-                img_embeds = img_embeds.reshape(len(samples['image']), -1, pn, hs)
+                img_embeds = img_embeds.reshape(len(samples.get('image', samples.get('image_feats'))), -1, pn, hs)
                 cond_embeds, cond_atts = self.prompt_wrap(img_embeds, img_atts, instruction, samples['length'])
             else:
                 cond_embeds, cond_atts = self.prompt_wrap(img_embeds, img_atts, instruction)
@@ -292,20 +413,80 @@ class MiniGPTBase(BaseModel):
         targets = torch.ones([inputs_embeds.shape[0], inputs_embeds.shape[1]],
                              dtype=torch.long).to(self.device).fill_(-100)
 
-        for i, target in enumerate(part_targets):
-            targets[i, input_lens[i]+1:input_lens[i]+len(target)+1] = target  # plus 1 for bos
+        target_pos = input_lens[:, None] + 1 + torch.arange(part_targets.shape[1], device=input_lens.device)  # plus 1 for bos
+        targets.scatter_(1, target_pos, part_targets)
+
+        position_ids, stats = None, {}
+        if self.pack_sequences and self.training and reduction == 'mean':
+            inputs_embeds, attention_mask, position_ids, targets, stats = \
+                self.pack_batch(inputs_embeds, attention_mask, targets)
 
         with self.maybe_autocast():
             outputs = self.llama_model(
                 inputs_embeds=inputs_embeds,
                 attention_mask=attention_mask,
+                position_ids=position_ids,
                 return_dict=True,
                 labels=targets,
                 reduction=reduction
             )
         loss = outputs.loss
+        # tokens the loss is computed on, left on the device for the training metrics
+        stats["num_tokens"] = (targets[:, 1:] != -100).sum()
+
+        return {"loss": loss, **stats}
 
-        return {"loss": loss}
+    def pack_batch(self, inputs_embeds, attention_mask, targets):
+        """
+        Pack the right padded samples of a batch into as few rows of pack_length tokens (at least
+        the longest sample) as possible, first-fit by decreasing length. Every sample keeps its
+        own position ids starting from 0 and only attends to itself through a block-diagonal causal
+        mask of shape [rows, 1, length, length]. The bos token of each sample has no target, so no
+        token is trained to predict across a sample boundary and the mean loss is unchanged.
+        """
+        batch_size, width = attention_mask.shape
+        lens = ((attention_mask > 0) * torch.arange(1, width + 1, device=attention_mask.device)).max(1)[0].tolist()
+        capacity = max(self.pack_length, max(lens))
+
+        rows = []  # [used length, sample ids]
+        for idx in sorted(range(batch_size), key=lambda i: -lens[i]):
+            for row in rows:
+                if row[0] + lens[idx] <= capacity:
+                    row[0] += lens[idx]
+                    row[1].append(idx)
+                    break
+            else:
+                rows.append([lens[idx], [idx]])
+
+        packed_width = max(row[0] for row in rows)
+        src_sample = torch.zeros([len(rows), packed_width], dtype=torch.long)
+        src_pos = torch.zeros([len(rows), packed_width], dtype=torch.long)
+        segment = torch.zeros([len(rows), packed_width], dtype=torch.long)  # 0 for padding
+        for row_idx, (_, sample_ids) in enumerate(rows):
+            start = 0
+            for seg_idx, idx in enumerate(sample_ids):
+                end = start + lens[idx]
+                src_sample[row_idx, start:end] = idx
+                src_pos[row_idx, start:end] = torch.arange(lens[idx])
+                segment[row_idx, start:end] = seg_idx + 1
+                start = end
+        src_sample, src_pos, segment = [x.to(inputs_embeds.device) for x in (src_sample, src_pos, segment)]
+
+        valid = (segment > 0) & (attention_mask[src_sample, src_pos] > 0)
+        packed_embeds = inputs_embeds[src_sample, src_pos] * valid[..., None].to(inputs_embeds.dtype)
+        packed_targets = targets[src_sample, src_pos].masked_fill(~valid, -100)
+
+        causal = torch.ones([packed_width, packed_width], dtype=torch.bool, device=valid.device).tril()
+        allowed = (segment[:, :, None] == segment[:, None, :]) & causal & valid[:, None, :]
+        packed_mask = torch.zeros(allowed.shape, dtype=inputs_embeds.dtype, device=valid.device)
+        packed_mask = packed_mask.masked_fill(~allowed, torch.finfo(inputs_embeds.dtype).min)[:, None]
+
+        num_tokens = float(sum(lens))
+        stats = {
+            "pad_ratio": 1 - num_tokens / (batch_size * width),
+            "packed_pad_ratio": 1 - num_tokens / (len(rows) * packed_width),
+        }
+        return packed_embeds, packed_mask, src_pos, packed_targets, stats
 
     def embed_tokens(self, token_ids):
         if hasattr(self.llama_model.base_model, 'model'): ## lora wrapped model
@@ -314,6 +495,25 @@ class MiniGPTBase(BaseModel):
             embeds = self.llama_model.base_model.embed_tokens(token_ids)
         return embeds
 
+    @torch.no_grad()
+    def build_prefix_cache(self, prefix, image=None):
+        """
+        Prefill the prompt text before the first <ImageHere> once so that generate() can share it
+        across a batch, e.g. the "<s>[INST] <Img>" start of the MiniGPT-v2 template.
+        If image is given, the cache also covers this image and can be used for all the
+        questions about it.
+        """
+        prefix = prefix.split('<ImageHere>')[0]
+        if image is None:
+            embs = self.get_context_emb(prefix, [])
+        else:
+            if image.dim() == 3:
+                image = image.unsqueeze(0)
+            img_embeds, _ = self.encode_img_cached(image.to(self.device))
+            embs = self.get_context_emb(prefix + '<ImageHere>', [img_embeds])
+        _, past_key_values = llama_step(self, embs)
+        return PrefixCache(prefix, image is not None, past_key_values)
+
     @torch.no_grad()
     def generate(
         self,
@@ -328,15 +528,68 @@ class MiniGPTBase(BaseModel):
         temperature=1,
         do_sample=False,
         stop_words_ids=[2],
+        prefix_cache=None,
     ):
         '''
             function for generate test use
+            prefix_cache: optional output of build_prefix_cache shared by all the texts.
+            With an image prefix cache, images can be None. It is not used with beam search.
+            stop_words_ids: token ids that end an answer, which is cut before the first of them.
         '''
 
         stopping_criteria = StoppingCriteriaList([StoppingCriteriaSub(
             stops=[torch.tensor([i]).to(self.device) for i in stop_words_ids])])
 
-        img_embeds, atts_img = self.encode_img(images.to(self.device))
+        if prefix_cache is not None and num_beams > 1:
+            logging.warning("The prefix cache is not used with beam search, the prompts are prefilled in full.")
+            assert images is not None, "Beam search needs the images, they are not taken from the prefix cache."
+
+        if prefix_cache is not None and num_beams == 1:
+            outputs = self.generate_with_prefix(
+                prefix_cache,
+                images,
+                texts,
+                max_new_tokens=max_new_tokens,
+                min_length=min_length,
+                top_p=top_p,
+                repetition_penalty=repetition_penalty,
+                temperature=temperature,
+                do_sample=do_sample,
+                stop_words_ids=stop_words_ids,
+            )
+        else:
+            outputs = self.generate_full(
+                images,
+                texts,
+                num_beams=num_beams,
+                max_new_tokens=max_new_tokens,
+                min_length=min_length,
+                top_p=top_p,
+                repetition_penalty=repetition_penalty,
+                length_penalty=length_penalty,
+                temperature=temperature,
+                do_sample=do_sample,
+            )
+
+        answers = []
+        for output_token in outputs:
+            if output_token[0] == 0:
+                output_token = output_token[1:]
+            # the answer ends at its first stop word
+            stops = torch.isin(output_token, torch.tensor(stop_words_ids, device=output_token.device)).nonzero()
+            if len(stops):
+                output_token = output_token[:stops[0, 0]]
+            output_texts = self.llama_tokenizer.decode(output_token, skip_special_tokens=True)
+            output_texts = output_texts.split('</s>')[0]  # remove the stop sign </s>
+            output_texts = output_texts.replace("<s>", "")
+            output_texts = output_texts.split(r'[/INST]')[-1].strip()
+            answers.append(output_texts)
+
+        return answers
+
+    def generate_full(self, images, texts, num_beams=1, max_new_tokens=20, min_length=1, top_p=0.9,
+                      repetition_penalty=1, length_penalty=1, temperature=1, do_sample=False):
+        img_embeds, atts_img = self.encode_img_cached(images.to(self.device))
         image_lists = [[image_emb[None]] for image_emb in img_embeds]
 
         batch_embs = [self.get_context_emb(text, img_list) for text, img_list in zip(texts, image_lists)]
@@ -378,30 +631,146 @@ class MiniGPTBase(BaseModel):
         #         do_sample=do_sample,
         #         # stopping_criteria=stopping_criteria,
         #     )
-        answers = []
-        for output_token in outputs:
-            if output_token[0] == 0:
-                output_token = output_token[1:]
-            output_texts = self.llama_tokenizer.decode(output_token, skip_special_tokens=True)
-            output_texts = output_texts.split('</s>')[0]  # remove the stop sign </s>
-            output_texts = output_texts.replace("<s>", "")
-            output_texts = output_texts.split(r'[/INST]')[-1].strip()
-            answers.append(output_texts)
+        return outputs
 
-        return answers
+    @torch.no_grad()
+    def generate_with_prefix(self, prefix_cache, images, texts, max_new_tokens=20, min_length=1, top_p=0.9,
+                             repetition_penalty=1, temperature=1, do_sample=False, stop_words_ids=(2,)):
+        """
+        Greedy / sampling decoding of texts that all start with the prefix of prefix_cache.
+        Only the part after the prefix is prefilled. It is left padded, so padding sits between
+        the prefix and the text and the positions of the text continue right after the prefix.
+        A sequence ends at eos or at one of the stop_words_ids, then it is padded with eos.
+        """
+        suffixes = []
+        for text in texts:
+            prefix, sep, suffix = text.partition('<ImageHere>')
+            assert prefix == prefix_cache.text and sep, "The text does not start with the cached prefix."
+            suffixes.append(suffix if prefix_cache.with_image else sep + suffix)
+
+        if prefix_cache.with_image:
+            image_lists = [[] for _ in suffixes]
+        else:
+            img_embeds, atts_img = self.encode_img_cached(images.to(self.device))
+            image_lists = [[image_emb[None]] for image_emb in img_embeds]
+        batch_embs = [self.get_context_emb(suffix, img_list, add_bos=False)
+                      for suffix, img_list in zip(suffixes, image_lists)]
+
+        batch_size = len(batch_embs)
+        max_len = max([emb.shape[1] for emb in batch_embs])
+        emb_dim = batch_embs[0].shape[2]
+        dtype = batch_embs[0].dtype
+        device = batch_embs[0].device
+
+        embs = torch.zeros([batch_size, max_len, emb_dim], dtype=dtype, device=device)
+        attn_mask = torch.zeros([batch_size, len(prefix_cache) + max_len], dtype=torch.long, device=device)
+        attn_mask[:, :len(prefix_cache)] = 1
+        for i, emb in enumerate(batch_embs):
+            emb_len = emb.shape[1]
+            embs[i, -emb_len:] = emb[0]
+            attn_mask[i, -emb_len:] = 1
+        position_ids = (attn_mask.cumsum(-1) - 1).clamp(min=0)[:, len(prefix_cache):]
+
+        eos_token_id = self.llama_tokenizer.eos_token_id
+        stop_ids = torch.tensor(list(stop_words_ids) + [eos_token_id], device=device)
+        logits, past_key_values = llama_step(
+            self, embs, attn_mask, position_ids, expand_past(prefix_cache.past_key_values, batch_size))
+        outputs = torch.zeros([batch_size, 0], dtype=torch.long, device=device)
+        unfinished = torch.ones(batch_size, dtype=torch.bool, device=device)
+        for _ in range(max_new_tokens):
+            next_tokens = sample_next_tokens(
+                logits,
+                outputs,
+                do_sample=do_sample,
+                temperature=temperature,
+                top_p=top_p,
+                repetition_penalty=repetition_penalty,
+                min_new_tokens=min_length,
+                eos_token_id=eos_token_id,
+            )
+            next_tokens = torch.where(unfinished, next_tokens, torch.full_like(next_tokens, eos_token_id))
+            outputs = torch.cat([outputs, next_tokens[:, None]], dim=1)
+            unfinished &= ~torch.isin(next_tokens, stop_ids)
+            if not unfinished.any():
+                break
+
+            attn_mask = torch.cat([attn_mask, attn_mask.new_ones([batch_size, 1])], dim=1)
+            position_ids = position_ids[:, -1:] + 1
+            logits, past_key_values = llama_step(
+                self, self.embed_tokens(next_tokens[:, None]), attn_mask, position_ids, past_key_values)
+        return outputs
 
     @torch.no_grad()
-    def multi_select(self, images, texts, answers, num_cand=None):
+    def multi_select(self, images, texts, answers, num_cand=None, num_cand_per_pass=None):
+        """
+        Rank the candidate answers of every sample by their loss. answers is a list over candidates
+        of lists over the batch. The images and the questions are encoded and prefilled once, then the
+        candidates are scored on top of the shared cache in batched teacher-forced passes of
+        num_cand_per_pass candidates (all of them by default). The losses are the ones of
+        forward(reduction='none') called once per candidate.
+        """
+        img_embeds, img_atts = self.encode_img_cached(images)
+        instruction = texts
+        if hasattr(self, 'chat_template') and self.chat_template:
+            instruction = [self.prompt_template.format(instruct) for instruct in instruction]
+        cond_embeds, cond_atts = self.prompt_wrap(img_embeds, img_atts, instruction)
+
+        batch_size, cond_width = cond_atts.shape
+        device = cond_atts.device
+        bos = torch.ones([batch_size, 1], dtype=torch.long, device=device) * self.llama_tokenizer.bos_token_id
+        input_embeds = torch.cat([self.embed_tokens(bos), cond_embeds], dim=1)
+        input_atts = torch.cat([cond_atts[:, :1], cond_atts], dim=1)
+
+        # move the padding to the left so that the last position of every row is its last question token
+        input_lens = input_atts.sum(1)
+        width = input_atts.shape[1]
+        src = (torch.arange(width, device=device)[None] - (width - input_lens)[:, None]) % width
+        input_embeds = input_embeds.gather(1, src[..., None].expand(-1, -1, input_embeds.shape[-1]))
+        input_atts = input_atts.gather(1, src)
+        position_ids = (input_atts.cumsum(-1) - 1).clamp(min=0)
+        last_logits, past_key_values = llama_step(self, input_embeds, input_atts, position_ids)
+
+        num_cand_per_pass = num_cand_per_pass or len(answers)
         all_losses = []
-        for answer in answers:
-            choice_samples = {
-                'image': images,
-                'instruction_input': texts,
-                'answer': answer
-            }
-            loss = self.forward(choice_samples, reduction='none')['loss'].reshape(-1, 1)
-            all_losses.append(loss)
-            torch.cuda.empty_cache()
+        for start in range(0, len(answers), num_cand_per_pass):
+            cand_answers = answers[start:start + num_cand_per_pass]
+            num_rows = len(cand_answers)
+
+            # rows are ordered candidate by candidate: row c * batch_size + i
+            self.llama_tokenizer.padding_side = "right"
+            regress_tokens = self.llama_tokenizer(
+                [t + self.end_sym for answer in cand_answers for t in answer],
+                return_tensors="pt",
+                padding="longest",
+                truncation=True,
+                max_length=self.max_txt_len,
+                add_special_tokens=False
+            ).to(self.device)
+            regress_token_ids = regress_tokens.input_ids
+            regress_atts = regress_tokens.attention_mask
+            part_targets = regress_token_ids.masked_fill(
+                regress_token_ids == self.llama_tokenizer.pad_token_id, -100
+            )
+            answer_width = regress_token_ids.shape[1]
+
+            with self.maybe_autocast():
+                outputs = self.llama_model(
+                    inputs_embeds=self.embed_tokens(regress_token_ids),
+                    attention_mask=torch.cat([input_atts.repeat(num_rows, 1), regress_atts], dim=1),
+                    position_ids=input_lens.repeat(num_rows)[:, None] + torch.arange(answer_width, device=device),
+                    past_key_values=tuple(
+                        (k.repeat(num_rows, 1, 1, 1), v.repeat(num_rows, 1, 1, 1)) for k, v in past_key_values),
+                    use_cache=False,
+                    return_dict=True,
+                )
+            # the first answer token is predicted by the last question token
+            logits = torch.cat([last_logits.repeat(num_rows, 1)[:, None], outputs.logits[:, :-1].float()], dim=1)
+            nll = nn.functional.cross_entropy(
+                logits.flatten(0, 1), part_targets.flatten(), reduction='none').view(num_rows, batch_size, -1).sum(2)
+
+            # forward(reduction='none') averages over every position of the padded sequence of each candidate
+            cand_widths = regress_atts.view(num_rows, batch_size, -1).sum(2).max(1).values
+            all_losses.append((nll / (cond_width + cand_widths[:, None])).t())
         all_losses = torch.cat(all_losses, dim=-1)
         if num_cand is not None:
             for i in range(all_losses.shape[0]):
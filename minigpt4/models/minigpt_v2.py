@@ -5,6 +5,8 @@ import torch
 from torch.cuda.amp import autocast as autocast
 import torch.nn as nn
 
+from minigpt4.common.checkpoint import load_model_state
+from minigpt4.common.logger import startup_timer
 from minigpt4.common.registry import registry
 from minigpt4.models.base_model import disabled_train
 from minigpt4.models.minigpt_base import MiniGPTBase
@@ -29,6 +31,7 @@ class MiniGPTv2(MiniGPTBase):
             use_grad_checkpoint=False,
             vit_precision="fp16",
             freeze_vit=True,
+            vit_attn_backend="eager",
             llama_model="",
             prompt_template='[INST] {} [/INST]',
             max_txt_len=300,
@@ -50,6 +53,7 @@ class MiniGPTv2(MiniGPTBase):
             use_grad_checkpoint=use_grad_checkpoint,
             vit_precision=vit_precision,
             freeze_vit=freeze_vit,
+            vit_attn_backend=vit_attn_backend,
             llama_model=llama_model,
             max_txt_len=max_txt_len,
             max_context_len=max_context_len,
@@ -72,22 +76,6 @@ class MiniGPTv2(MiniGPTBase):
         if use_grad_checkpoint_llm:
             self.llama_model.gradient_checkpointing_enable()
 
-    def encode_img(self, image):
-        device = image.device
-
-        if len(image.shape) > 4:
-            image = image.reshape(-1, *image.shape[-3:])
-
-        with self.maybe_autocast():
-            image_embeds = self.ln_vision(self.visual_encoder(image)).to(device)
-            image_embeds = image_embeds[:, 1:, :]
-            bs, pn, hs = image_embeds.shape
-            image_embeds = image_embeds.view(bs, int(pn / 4), int(hs * 4))
-
-            inputs_llama = self.llama_proj(image_embeds)
-            atts_llama = torch.ones(inputs_llama.size()[:-1], dtype=torch.long).to(image.device)
-        return inputs_llama, atts_llama
-
     @classmethod
     def from_config(cls, cfg):
         vit_model = cfg.get("vit_model", "eva_clip_g")
@@ -98,6 +86,7 @@ class MiniGPTv2(MiniGPTBase):
         use_grad_checkpoint = cfg.get("use_grad_checkpoint", False)
         vit_precision = cfg.get("vit_precision", "fp16")
         freeze_vit = cfg.get("freeze_vit", True)
+        vit_attn_backend = cfg.get("vit_attn_backend", "eager")
         low_resource = cfg.get("low_resource", False)
 
         prompt_template = cfg.get("prompt_template", '[INST] {} [/INST]')
@@ -118,6 +107,7 @@ class MiniGPTv2(MiniGPTBase):
             use_grad_checkpoint=use_grad_checkpoint,
             vit_precision=vit_precision,
             freeze_vit=freeze_vit,
+            vit_attn_backend=vit_attn_backend,
             llama_model=llama_model,
             prompt_template=prompt_template,
             max_txt_len=max_txt_len,
@@ -133,7 +123,25 @@ class MiniGPTv2(MiniGPTBase):
         ckpt_path = cfg.get("ckpt", "")  # load weights of MiniGPT-4
         if ckpt_path:
             print("Load Minigpt-4-LLM Checkpoint: {}".format(ckpt_path))
-            ckpt = torch.load(ckpt_path, map_location="cpu")
-            msg = model.load_state_dict(ckpt['model'], strict=False)
+            with startup_timer.phase("ckpt"):
+                msg = model.load_state_dict(load_model_state(ckpt_path), strict=False)
+
+        # compute the training loss over vocab chunks instead of the full logits
+        model.llama_model.config.loss_chunk_size = cfg.get("loss_chunk_size", 0)
+
+        # several samples per training row, see MiniGPTBase.pack_batch
+        model.pack_sequences = cfg.get("pack_sequences", False)
+        model.pack_length = cfg.get("pack_length", 0)
+
+        if cfg.get("precomputed_image_feats", False):
+            model.drop_vision_encoder()
+
+        img_embed_cache_size = cfg.get("img_embed_cache_size", 0)
+        if img_embed_cache_size > 0:
+            model.enable_img_embed_cache(
+                max_size=img_embed_cache_size,
+                cache_dir=cfg.get("img_embed_cache_dir", None),
+                cfg_items=(vit_model, img_size, llama_model, ckpt_path),
+            )
 
         return model
@@ -3,16 +3,117 @@ from typing import List, Optional, Tuple, Union
 
 import torch
 import torch.nn.functional as F
+from torch import nn
 from torch.nn import CrossEntropyLoss
 
 from transformers.utils import add_start_docstrings_to_model_forward, replace_return_docstrings
 from transformers.modeling_outputs import CausalLMOutputWithPast
 from transformers.models.llama.modeling_llama import LLAMA_INPUTS_DOCSTRING, _CONFIG_FOR_DOC
 from transformers.models.llama.modeling_llama import LlamaForCausalLM as LlamaForCausalLMOrig
+from transformers.models.llama.modeling_llama import LlamaModel as LlamaModelOrig
+from transformers.models.llama.modeling_llama import LlamaPreTrainedModel
+
+
+class ChunkedCrossEntropy(torch.autograd.Function):
+    """
+    Cross entropy of hidden_states @ weight.T against labels, computed over vocab chunks of
+    chunk_size so that the [num_tokens, vocab] logits are never materialized. The logits of
+    each chunk are recomputed in the backward pass.
+    """
+
+    @staticmethod
+    @torch.cuda.amp.custom_fwd
+    def forward(ctx, hidden_states, weight, labels, chunk_size):
+        num_tokens = hidden_states.shape[0]
+        lse = torch.full([num_tokens], -float("inf"), dtype=torch.float, device=hidden_states.device)
+        target_logits = torch.zeros([num_tokens], dtype=torch.float, device=hidden_states.device)
+        for start in range(0, weight.shape[0], chunk_size):
+            logits = (hidden_states @ weight[start:start + chunk_size].t()).float()
+            lse = torch.logaddexp(lse, torch.logsumexp(logits, dim=-1))
+            in_chunk = (labels >= start) & (labels < start + logits.shape[1])
+            chunk_labels = (labels - start).clamp(0, logits.shape[1] - 1)
+            target_logits += torch.where(
+                in_chunk, logits.gather(1, chunk_labels[:, None])[:, 0], torch.zeros_like(target_logits))
+
+        ctx.save_for_backward(hidden_states, weight, labels, lse)
+        ctx.chunk_size = chunk_size
+        return lse - target_logits
+
+    @staticmethod
+    @torch.cuda.amp.custom_bwd
+    def backward(ctx, grad_output):
+        hidden_states, weight, labels, lse = ctx.saved_tensors
+        chunk_size = ctx.chunk_size
+        grad_hidden = torch.zeros_like(hidden_states, dtype=torch.float) if ctx.needs_input_grad[0] else None
+        grad_weight = torch.zeros_like(weight, dtype=torch.float) if ctx.needs_input_grad[1] else None
+
+        for start in range(0, weight.shape[0], chunk_size):
+            weight_chunk = weight[start:start + chunk_size]
+            logits = (hidden_states @ weight_chunk.t()).float()
+            # d loss / d logits = softmax - one_hot(label)
+            grad_logits = torch.exp(logits - lse[:, None])
+            in_chunk = (labels >= start) & (labels < start + logits.shape[1])
+            rows = in_chunk.nonzero()[:, 0]
+            grad_logits[rows, labels[rows] - start] -= 1
+            grad_logits *= grad_output[:, None]
+
+            if grad_hidden is not None:
+                grad_hidden += grad_logits.to(weight_chunk.dtype) @ weight_chunk
+            if grad_weight is not None:
+                grad_weight[start:start + chunk_size] += grad_logits.t().to(hidden_states.dtype) @ hidden_states
+
+        if grad_hidden is not None:
+            grad_hidden = grad_hidden.to(hidden_states.dtype)
+        if grad_weight is not None:
+            grad_weight = grad_weight.to(weight.dtype)
+        return grad_hidden, grad_weight, None, None
+
+
+def chunked_causal_lm_loss(hidden_states, weight, labels, chunk_size, reduction="mean"):
+    """
+    The shifted causal LM loss of forward() computed on the supervised positions only.
+    reduction='none' returns, as forward() does, the per-sample loss summed over the sample
+    and divided by its number of shifted positions.
+    """
+    shift_hidden = hidden_states[:, :-1]
+    shift_labels = labels[:, 1:].to(hidden_states.device)
+    mask = shift_labels != -100
+
+    nll = ChunkedCrossEntropy.apply(shift_hidden[mask], weight, shift_labels[mask], chunk_size)
+    if reduction == "none":
+        rows = mask.nonzero()[:, 0]
+        loss = torch.zeros(labels.shape[0], dtype=nll.dtype, device=nll.device).index_add(0, rows, nll)
+        return loss / shift_labels.shape[1]
+    if reduction == "sum":
+        return nll.sum()
+    return nll.sum() / mask.sum()
+
+
+class LlamaModel(LlamaModelOrig):
+
+    def _prepare_decoder_attention_mask(self, attention_mask, input_shape, inputs_embeds, past_key_values_length):
+        if attention_mask is not None and attention_mask.dim() == 4:
+            # an additive [bsz, 1, tgt_len, src_len] mask built by the caller, e.g. the block-diagonal
+            # causal mask of packed sequences
+            dtype = inputs_embeds.dtype
+            return attention_mask.to(dtype).clamp(min=torch.finfo(dtype).min)
+        return super()._prepare_decoder_attention_mask(
+            attention_mask, input_shape, inputs_embeds, past_key_values_length)
 
 
 class LlamaForCausalLM(LlamaForCausalLMOrig):
 
+    def __init__(self, config):
+        # as LlamaForCausalLMOrig.__init__, with the LlamaModel above that accepts ready-made
+        # 4D attention masks in addition to the 2D padding masks
+        LlamaPreTrainedModel.__init__(self, config)
+        self.model = LlamaModel(config)
+
+        self.lm_head = nn.Linear(config.hidden_size, config.vocab_size, bias=False)
+
+        # Initialize weights and apply final processing
+        self.post_init()
+
     @add_start_docstrings_to_model_forward(LLAMA_INPUTS_DOCSTRING)
     @replace_return_docstrings(output_type=CausalLMOutputWithPast, config_class=_CONFIG_FOR_DOC)
     def forward(
@@ -75,6 +176,21 @@ class LlamaForCausalLM(LlamaForCausalLMOrig):
         )
 
         hidden_states = outputs[0]
+        loss_chunk_size = getattr(self.config, 'loss_chunk_size', 0)
+        if labels is not None and loss_chunk_size:
+            # skip the full logits, see chunked_causal_lm_loss
+            loss = chunked_causal_lm_loss(
+                hidden_states, self.lm_head.weight, labels, loss_chunk_size, reduction=reduction)
+            if not return_dict:
+                return (loss, None) + outputs[1:]
+            return CausalLMOutputWithPast(
+                loss=loss,
+                logits=None,
+                past_key_values=outputs.past_key_values,
+                hidden_states=outputs.hidden_states,
+                attentions=outputs.attentions,
+            )
+
         if hasattr(self.config, 'pretraining_tp') and self.config.pretraining_tp > 1:
             lm_head_slices = self.lm_head.weight.split(self.vocab_size // self.config.pretraining_tp, dim=0)
             logits = [F.linear(hidden_states, lm_head_slices[i]) for i in range(self.config.pretraining_tp)]
@@ -7,11 +7,13 @@
 
 import re
 
+import torch
 from minigpt4.common.registry import registry
 from minigpt4.processors.base_processor import BaseProcessor
 from minigpt4.processors.randaugment import RandomAugment
 from omegaconf import OmegaConf
 from torchvision import transforms
+from torchvision.transforms import functional as TF
 from torchvision.transforms.functional import InterpolationMode
 
 
@@ -22,8 +24,32 @@ class BlipImageBaseProcessor(BaseProcessor):
         if std is None:
             std = (0.26862954, 0.26130258, 0.27577711)
 
+        self.mean = mean
+        self.std = std
         self.normalize = transforms.Normalize(mean, std)
 
+    def batch_transform(self, images):
+        """
+        Device side version of the bicubic resize, ToTensor and Normalize of the processor, for the
+        list of decoded uint8 [3, H, W] images returned with device_preprocess. Images of the same size
+        are resized together, the resized images are rounded to uint8 levels as PIL does.
+        """
+        out = torch.empty([len(images), 3, self.image_size, self.image_size], device=images[0].device)
+        groups = {}
+        for i, image in enumerate(images):
+            groups.setdefault(tuple(image.shape), []).append(i)
+        for indices in groups.values():
+            batch = torch.stack([images[i] for i in indices]).float()
+            out[indices] = TF.resize(
+                batch, [self.image_size, self.image_size], interpolation=InterpolationMode.BICUBIC, antialias=True
+            )
+        out = out.clamp_(0, 255).round_().div_(255)
+        return TF.normalize(out, self.mean, self.std, inplace=True)
+
+    def decode(self, item):
+        # device_preprocess: the dataloader workers only convert the image to a uint8 tensor
+        return TF.pil_to_tensor(item)
+
 
 @registry.register_processor("blip_caption")
 class BlipCaptionProcessor(BaseProcessor):
@@ -70,8 +96,10 @@ class BlipCaptionProcessor(BaseProcessor):
 
 @registry.register_processor("blip2_image_train")
 class Blip2ImageTrainProcessor(BlipImageBaseProcessor):
-    def __init__(self, image_size=224, mean=None, std=None, min_scale=0.5, max_scale=1.0):
+    def __init__(self, image_size=224, mean=None, std=None, min_scale=0.5, max_scale=1.0, device_preprocess=False):
         super().__init__(mean=mean, std=std)
+        self.image_size = image_size
+        self.device_preprocess = device_preprocess
 
         self.transform = transforms.Compose(
             [
@@ -85,6 +113,8 @@ class Blip2ImageTrainProcessor(BlipImageBaseProcessor):
         )
 
     def __call__(self, item):
+        if self.device_preprocess:
+            return self.decode(item)
         return self.transform(item)
 
     @classmethod
@@ -100,19 +130,25 @@ class Blip2ImageTrainProcessor(BlipImageBaseProcessor):
         min_scale = cfg.get("min_scale", 0.5)
         max_scale = cfg.get("max_scale", 1.0)
 
+        # resize and normalize on the gpu, see BlipImageBaseProcessor.batch_transform
+        device_preprocess = cfg.get("device_preprocess", False)
+
         return cls(
             image_size=image_size,
             mean=mean,
             std=std,
             min_scale=min_scale,
             max_scale=max_scale,
+            device_preprocess=device_preprocess,
         )
 
 
 @registry.register_processor("blip2_image_eval")
 class Blip2ImageEvalProcessor(BlipImageBaseProcessor):
-    def __init__(self, image_size=224, mean=None, std=None):
+    def __init__(self, image_size=224, mean=None, std=None, device_preprocess=False):
         super().__init__(mean=mean, std=std)
+        self.image_size = image_size
+        self.device_preprocess = device_preprocess
 
         self.transform = transforms.Compose(
             [
@@ -125,6 +161,8 @@ class Blip2ImageEvalProcessor(BlipImageBaseProcessor):
         )
 
     def __call__(self, item):
+        if self.device_preprocess:
+            return self.decode(item)
         return self.transform(item)
 
     @classmethod
@@ -137,4 +175,7 @@ class Blip2ImageEvalProcessor(BlipImageBaseProcessor):
         mean = cfg.get("mean", None)
         std = cfg.get("std", None)
 
-        return cls(image_size=image_size, mean=mean, std=std)
+        # resize and normalize on the gpu, see BlipImageBaseProcessor.batch_transform
+        device_preprocess = cfg.get("device_preprocess", False)
+
+        return cls(image_size=image_size, mean=mean, std=std, device_preprocess=device_preprocess)
@@ -6,6 +6,7 @@
 """
 
 import datetime
+import functools
 import json
 import logging
 import os
@@ -15,6 +16,7 @@ from pathlib import Path
 import torch
 import torch.distributed as dist
 import webdataset as wds
+from minigpt4.common.checkpoint import AsyncCheckpointWriter, get_rng_state, load_model_state, set_rng_state
 from minigpt4.common.dist_utils import (
     download_cached_file,
     get_rank,
@@ -27,11 +29,16 @@ from minigpt4.common.utils import is_url
 from minigpt4.datasets.data_utils import concat_datasets, reorg_datasets_by_split, ChainDataset
 from minigpt4.datasets.datasets.dataloader_utils import (
     IterLoader,
+    LengthGroupedBatchSampler,
     MultiIterLoader,
     PrefetchLoader,
+    RawImageCollater,
+    ResumableBatchSampler,
+    get_sample_lengths,
 )
+from torch.distributed.optim import ZeroRedundancyOptimizer
 from torch.nn.parallel import DistributedDataParallel as DDP
-from torch.utils.data import DataLoader, DistributedSampler
+from torch.utils.data import DataLoader, DistributedSampler, IterableDataset
 
 
 @registry.register_runner("runner_base")
@@ -60,6 +67,9 @@ class RunnerBase:
         self._lr_sched = None
 
         self.start_epoch = 0
+        self.start_iters = 0  # steps of start_epoch already done when resuming from an iteration checkpoint
+        self._find_unused_parameters = False  # find_unused_parameters "auto", set by train()
+        self.checkpoint_writer = AsyncCheckpointWriter()
 
         # self.setup_seeds()
         self.setup_output_dir()
@@ -87,8 +97,13 @@ class RunnerBase:
             # distributed training wrapper
             if self.use_distributed:
                 if self._wrapped_model is None:
+                    # only parameters requiring grad are put in the all-reduce buckets
                     self._wrapped_model = DDP(
-                        self._model, device_ids=[self.config.run_cfg.gpu], find_unused_parameters=True
+                        self._model,
+                        device_ids=[self.config.run_cfg.gpu],
+                        find_unused_parameters=self.find_unused_parameters,
+                        static_graph=self.static_graph,
+                        bucket_cap_mb=self.bucket_cap_mb,
                     )
             else:
                 self._wrapped_model = self._model
@@ -119,12 +134,23 @@ class RunnerBase:
                 {"params": p_non_wd, "weight_decay": 0},
             ]
             beta2 = self.config.run_cfg.get("beta2", 0.999)
-            self._optimizer = torch.optim.AdamW(
-                optim_params,
-                lr=float(self.config.run_cfg.init_lr),
-                weight_decay=float(self.config.run_cfg.weight_decay),
-                betas=(0.9, beta2),
-            )
+            if self.zero_optimizer:
+                # ZeRO-1: every rank keeps (and updates) the AdamW state of its partition of the
+                # parameters only, and broadcasts the updated parameters to the other ranks
+                self._optimizer = ZeroRedundancyOptimizer(
+                    optim_params,
+                    optimizer_class=torch.optim.AdamW,
+                    lr=float(self.config.run_cfg.init_lr),
+                    weight_decay=float(self.config.run_cfg.weight_decay),
+                    betas=(0.9, beta2),
+                )
+            else:
+                self._optimizer = torch.optim.AdamW(
+                    optim_params,
+                    lr=float(self.config.run_cfg.init_lr),
+                    weight_decay=float(self.config.run_cfg.weight_decay),
+                    betas=(0.9, beta2),
+                )
 
         return self._optimizer
 
@@ -286,6 +312,46 @@ class RunnerBase:
         log_freq = self.config.run_cfg.get("log_freq", 50)
         return int(log_freq)
 
+    @property
+    def find_unused_parameters(self):
+        """
+        Whether DDP searches the autograd graph for parameters without gradient at every step.
+        With "auto" (default), it only does so when a training dataset has samples without image,
+        whose batches leave the image projection unused. train() decides it before wrapping the model.
+        """
+        find_unused = self.config.run_cfg.get("find_unused_parameters", "auto")
+        if find_unused != "auto":
+            return bool(find_unused)
+        return self._find_unused_parameters
+
+    def _has_text_only_datasets(self):
+        # datasets without image have no vis_processor, e.g. UnnaturalDataset;
+        # webdatasets are image-text pairs
+        for dataset in self.datasets.get("train", []):
+            if isinstance(dataset, (ChainDataset, wds.DataPipeline, IterableDataset)):
+                continue
+            if getattr(dataset, "vis_processor", None) is None:
+                logging.info("{} has samples without image, DDP searches for unused parameters.".format(
+                    getattr(dataset, "name", type(dataset).__name__)))
+                return True
+        return False
+
+    @property
+    def keep_last_checkpoints(self):
+        return int(self.config.run_cfg.get("keep_last_checkpoints", 0))
+
+    @property
+    def zero_optimizer(self):
+        return self.use_distributed and self.config.run_cfg.get("zero_optimizer", False)
+
+    @property
+    def static_graph(self):
+        return self.config.run_cfg.get("static_graph", False)
+
+    @property
+    def bucket_cap_mb(self):
+        return int(self.config.run_cfg.get("bucket_cap_mb", 25))
+
     @property
     def init_lr(self):
         return float(self.config.run_cfg.init_lr)
@@ -333,6 +399,31 @@ class RunnerBase:
     def use_dist_eval_sampler(self):
         return self.config.run_cfg.get("use_dist_eval_sampler", True)
 
+    @property
+    def length_grouped(self):
+        """
+        Set to True to batch the samples of map-style training datasets implementing
+        `approx_length` by similar length, see LengthGroupedBatchSampler.
+        """
+        return self.config.run_cfg.get("length_grouped", False)
+
+    @property
+    def length_group_size(self):
+        return int(self.config.run_cfg.get("length_group_size", 50))
+
+    @property
+    def ckpt_every_n_iters(self):
+        """
+        Save checkpoint_latest.pth every n training steps (0 to disable), in the background, to
+        resume from the exact step with resume_ckpt_path.
+        """
+        return int(self.config.run_cfg.get("ckpt_every_n_iters", 0))
+
+    @property
+    def prefetch_depth(self):
+        """Number of batches copied to the device ahead of the training step."""
+        return int(self.config.run_cfg.get("prefetch_depth", 1))
+
     @property
     def resume_ckpt_path(self):
         return self.config.run_cfg.get("resume_ckpt_path", None)
@@ -366,6 +457,13 @@ class RunnerBase:
 
         self.log_config()
 
+        # find_unused_parameters "auto", decided once before the model is wrapped in DDP
+        find_unused = self.config.run_cfg.get("find_unused_parameters", "auto")
+        if not self.evaluate_only and not self.static_graph and find_unused == "auto":
+            assert self._wrapped_model is None, "The model is wrapped before find_unused_parameters is decided."
+            self.dataloaders  # organizes self.datasets by split
+            self._find_unused_parameters = self._has_text_only_datasets()
+
         # resume from checkpoint if specified
         if not self.evaluate_only and self.resume_ckpt_path is not None:
             self._load_checkpoint(self.resume_ckpt_path)
@@ -411,6 +509,8 @@ class RunnerBase:
             if self.config.run_cfg.distributed:
                 dist.barrier()
 
+        self.checkpoint_writer.wait()
+
         # testing phase
         test_epoch = "best" if len(self.valid_splits) > 0 else cur_epoch
         self.evaluate(cur_epoch=test_epoch, skip_reload=self.evaluate_only)
@@ -434,7 +534,8 @@ class RunnerBase:
         # train
         self.model.train()
 
-        return self.task.train_epoch(
+        start_step, self.start_iters = self.start_iters, 0
+        train_stats = self.task.train_epoch(
             epoch=epoch,
             model=self.model,
             data_loader=self.train_loader,
@@ -444,7 +545,17 @@ class RunnerBase:
             cuda_enabled=self.cuda_enabled,
             log_freq=self.log_freq,
             accum_grad_iters=self.accum_grad_iters,
+            start_step=start_step,
+            step_callback=functools.partial(self._after_train_step, epoch),
         )
+        # the checkpoints of the epoch are saved by the main process only
+        self._consolidate_optimizer_state()
+        return train_stats
+
+    def _after_train_step(self, cur_epoch, iters):
+        """Called by the task after the optimizer step that completes `iters` steps of the epoch."""
+        if self.ckpt_every_n_iters > 0 and iters % self.ckpt_every_n_iters == 0:
+            self._save_iter_checkpoint(cur_epoch, iters)
 
     @torch.no_grad()
     def eval_epoch(self, split_name, cur_epoch, skip_reload=False):
@@ -519,17 +630,57 @@ class RunnerBase:
                 # map-style dataset are concatenated together
                 # setup distributed sampler
 
-                if self.use_distributed:
+                vis_processor = getattr(dataset, "vis_processor", None)
+                image_transform = None
+                if getattr(vis_processor, "device_preprocess", False):
+                    # the workers only decode the images, they are resized and normalized on the gpu
+                    collate_fn = RawImageCollater(collate_fn)
+                    image_transform = vis_processor.batch_transform
+
+                if is_train:
+                    if self.length_grouped and hasattr(dataset, "approx_length"):
+                        lengths = get_sample_lengths(
+                            dataset, os.path.join(registry.get_path("cache_root"), "sample_lengths")
+                        )
+                        batch_sampler = LengthGroupedBatchSampler(
+                            lengths,
+                            batch_size=bsz,
+                            num_replicas=get_world_size(),
+                            rank=get_rank(),
+                            group_size=self.length_group_size,
+                            seed=self.config.run_cfg.seed,
+                        )
+                    else:
+                        # seeded shuffling also on a single process, resumable within an epoch
+                        # (see IterLoader.load_state_dict)
+                        sampler = DistributedSampler(
+                            dataset,
+                            shuffle=True,
+                            num_replicas=get_world_size(),
+                            rank=get_rank(),
+                            seed=self.config.run_cfg.seed,
+                        )
+                        batch_sampler = ResumableBatchSampler(sampler, bsz, drop_last=True)
+
+                    loader = DataLoader(
+                        dataset,
+                        batch_sampler=batch_sampler,
+                        num_workers=num_workers,
+                        pin_memory=True,
+                        collate_fn=collate_fn,
+                    )
+                    loader = PrefetchLoader(loader, image_transform, depth=self.prefetch_depth)
+                    return IterLoader(loader, use_distributed=self.use_distributed)
+
+                if self.use_distributed and self.use_dist_eval_sampler:
                     sampler = DistributedSampler(
                         dataset,
-                        shuffle=is_train,
+                        shuffle=False,
                         num_replicas=get_world_size(),
                         rank=get_rank(),
                     )
-                    if not self.use_dist_eval_sampler:
-                        # e.g. retrieval evaluation
-                        sampler = sampler if is_train else None
                 else:
+                    # e.g. retrieval evaluation
                     sampler = None
 
                 loader = DataLoader(
@@ -538,14 +689,11 @@ class RunnerBase:
                     num_workers=num_workers,
                     pin_memory=True,
                     sampler=sampler,
-                    shuffle=sampler is None and is_train,
+                    shuffle=False,
                     collate_fn=collate_fn,
-                    drop_last=True if is_train else False,
+                    drop_last=False,
                 )
-                loader = PrefetchLoader(loader)
-
-                if is_train:
-                    loader = IterLoader(loader, use_distributed=self.use_distributed)
+                loader = PrefetchLoader(loader, image_transform, depth=self.prefetch_depth)
 
             return loader
 
@@ -563,6 +711,7 @@ class RunnerBase:
                         for i, d in enumerate(dataset)
                     ],
                     ratios=dataset_ratios,
+                    seed=self.config.run_cfg.seed,
                 )
             else:
                 loader = _create_loader(dataset, num_workers, bsz, is_train, collate_fn)
@@ -571,33 +720,94 @@ class RunnerBase:
 
         return loaders
 
-    @main_process
-    def _save_checkpoint(self, cur_epoch, is_best=False):
+    def _consolidate_optimizer_state(self):
+        """
+        Gather the optimizer state partitions of ZeRO on the main process (a collective call), so
+        that its state_dict() is the full state. Loading the full state works for any world size,
+        each rank then keeps its own partition.
+        """
+        if self.zero_optimizer:
+            self.optimizer.consolidate_state_dict(to=0)
+
+    def _checkpoint_state(self, cur_epoch):
         """
-        Save the checkpoint at the current epoch.
+        Return the trainable parameters, saved as safetensors, and the rest of the training state.
+        The frozen weights are not saved, they are loaded from the pretrained models.
         """
         model_no_ddp = self.unwrap_dist_model(self.model)
-        param_grad_dic = {
-            k: v.requires_grad for (k, v) in model_no_ddp.named_parameters()
-        }
-        state_dict = model_no_ddp.state_dict()
-        for k in list(state_dict.keys()):
-            if k in param_grad_dic.keys() and not param_grad_dic[k]:
-                # delete parameters that do not require gradient
-                del state_dict[k]
+        weights = {k: v for k, v in model_no_ddp.named_parameters() if v.requires_grad}
         save_obj = {
-            "model": state_dict,
             "optimizer": self.optimizer.state_dict(),
             "config": self.config.to_dict(),
             "scaler": self.scaler.state_dict() if self.scaler else None,
             "epoch": cur_epoch,
         }
-        save_to = os.path.join(
-            self.output_dir,
-            "checkpoint_{}.pth".format("best" if is_best else cur_epoch),
-        )
-        logging.info("Saving checkpoint at epoch {} to {}.".format(cur_epoch, save_to))
-        torch.save(save_obj, save_to)
+        if hasattr(self.train_loader, "state_dict"):
+            save_obj["train_loader"] = self.train_loader.state_dict()
+        return weights, save_obj
+
+    def _checkpoint_files(self, name, cur_epoch, iters=None):
+        """
+        The files of checkpoint `name` and their metadata: the weights in <name>_<step>.safetensors,
+        then <name>.pth, which refers to it. Both record the step, checked by load_model_state, and
+        the .pth is written last, so it never refers to the weights of another step.
+        """
+        weights, save_obj = self._checkpoint_state(cur_epoch)
+        step = "e{}".format(cur_epoch) if iters is None else "e{}_i{}".format(cur_epoch, iters)
+        save_obj["step"] = step
+        save_obj["model_file"] = "{}_{}.safetensors".format(name, step)
+        if iters is not None:
+            save_obj["iters"] = iters
+        files = {
+            os.path.join(self.output_dir, save_obj["model_file"]): weights,
+            os.path.join(self.output_dir, name + ".pth"): save_obj,
+        }
+        return files, {"step": step}
+
+    def _weight_files(self, name):
+        """The weight files of checkpoint `name` in the output directory, of any step."""
+        return [os.path.join(self.output_dir, f) for f in os.listdir(self.output_dir)
+                if f.startswith(name + "_e") and f.endswith(".safetensors")]
+
+    @main_process
+    def _save_checkpoint(self, cur_epoch, is_best=False):
+        """
+        Save the checkpoint at the current epoch, in the background. The weights of the previous
+        save under the same name are deleted once it is written, and with keep_last_checkpoints,
+        so are the older epoch checkpoints.
+        """
+        self.checkpoint_writer.wait()  # the files of the previous save are in place
+        name = "checkpoint_{}".format("best" if is_best else cur_epoch)
+        files, metadata = self._checkpoint_files(name, cur_epoch)
+        remove = [path for path in self._weight_files(name) if path not in files]
+        if not is_best and self.keep_last_checkpoints > 0:
+            epochs = sorted(
+                int(f[len("checkpoint_"):-len(".pth")]) for f in os.listdir(self.output_dir)
+                if f.startswith("checkpoint_") and f.endswith(".pth") and f[len("checkpoint_"):-len(".pth")].isdigit()
+            )
+            epochs = [epoch for epoch in epochs if epoch != cur_epoch] + [cur_epoch]
+            for epoch in epochs[:-self.keep_last_checkpoints]:
+                old_name = "checkpoint_{}".format(epoch)
+                remove += [os.path.join(self.output_dir, old_name + ".pth")] + self._weight_files(old_name)
+        logging.info("Saving checkpoint at epoch {} to {}.".format(cur_epoch, os.path.join(self.output_dir, name)))
+        self.checkpoint_writer.save(files, remove, metadata)
+
+    def _save_iter_checkpoint(self, cur_epoch, iters):
+        """
+        Save the checkpoint after `iters` steps of the current epoch to checkpoint_latest, in the
+        background. Every rank also saves its rng states, which differ between ranks.
+        """
+        rng_state = {"epoch": cur_epoch, "iters": iters, "rng": get_rng_state()}
+        torch.save(rng_state, os.path.join(self.output_dir, "rng_state_rank{}.pth".format(get_rank())))
+        self._consolidate_optimizer_state()
+
+        if is_main_process():
+            self.checkpoint_writer.wait()  # the files of the previous save are in place
+            files, metadata = self._checkpoint_files("checkpoint_latest", cur_epoch, iters)
+            remove = [path for path in self._weight_files("checkpoint_latest") if path not in files]
+            logging.info("Saving checkpoint at epoch {}, step {} to {}.".format(
+                cur_epoch, iters, os.path.join(self.output_dir, "checkpoint_latest")))
+            self.checkpoint_writer.save(files, remove, metadata)
 
     def _reload_best_model(self, model):
         """
@@ -606,9 +816,10 @@ class RunnerBase:
         checkpoint_path = os.path.join(self.output_dir, "checkpoint_best.pth")
 
         logging.info("Loading checkpoint from {}.".format(checkpoint_path))
-        checkpoint = torch.load(checkpoint_path, map_location="cpu")
+        self.checkpoint_writer.wait()
+        state_dict = load_model_state(checkpoint_path)
         try:
-            model.load_state_dict(checkpoint["model"])
+            model.load_state_dict(state_dict)
         except RuntimeError as e:
             logging.warning(
                 """
@@ -616,7 +827,7 @@ class RunnerBase:
                 Trying to load the model with strict=False.
                 """
             )
-            model.load_state_dict(checkpoint["model"], strict=False)
+            model.load_state_dict(state_dict, strict=False)
         return model
 
     def _load_checkpoint(self, url_or_filename):
@@ -627,20 +838,33 @@ class RunnerBase:
             cached_file = download_cached_file(
                 url_or_filename, check_hash=False, progress=True
             )
-            checkpoint = torch.load(cached_file, map_location=self.device)
         elif os.path.isfile(url_or_filename):
-            checkpoint = torch.load(url_or_filename, map_location=self.device)
+            cached_file = url_or_filename
         else:
             raise RuntimeError("checkpoint url or path is invalid")
+        checkpoint = torch.load(cached_file, map_location=self.device)
 
-        state_dict = checkpoint["model"]
+        state_dict = load_model_state(cached_file, checkpoint)
         message = self.unwrap_dist_model(self.model).load_state_dict(state_dict,strict=False)
 
         self.optimizer.load_state_dict(checkpoint["optimizer"])
         if self.scaler and "scaler" in checkpoint:
             self.scaler.load_state_dict(checkpoint["scaler"])
 
-        self.start_epoch = checkpoint["epoch"] + 1
+        if 0 < checkpoint.get("iters", 0) < self.lr_scheduler.iters_per_epoch:
+            # iteration checkpoint, continue the epoch
+            self.start_epoch = checkpoint["epoch"]
+            self.start_iters = checkpoint["iters"]
+        else:
+            self.start_epoch = checkpoint["epoch"] + 1
+        if "train_loader" in checkpoint and hasattr(self.train_loader, "load_state_dict"):
+            self.train_loader.load_state_dict(checkpoint["train_loader"])
+
+        rng_path = os.path.join(os.path.dirname(url_or_filename), "rng_state_rank{}.pth".format(get_rank()))
+        if self.start_iters > 0 and os.path.isfile(rng_path):
+            rng_state = torch.load(rng_path)
+            if (rng_state["epoch"], rng_state["iters"]) == (checkpoint["epoch"], checkpoint["iters"]):
+                set_rng_state(rng_state["rng"])
         print("resume the checkpoint")
         logging.info("Resume checkpoint from {}".format(url_or_filename))
 
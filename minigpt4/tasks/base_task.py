@@ -5,15 +5,18 @@
  For full license text, see the LICENSE_Lavis file in the repo root or https://opensource.org/licenses/BSD-3-Clause
 """
 
+import contextlib
 import logging
 import os
 
 import torch
 import torch.distributed as dist
 from minigpt4.common.dist_utils import get_rank, get_world_size, is_main_process, is_dist_avail_and_initialized
-from minigpt4.common.logger import MetricLogger, SmoothedValue
+from minigpt4.common.logger import DeviceMetrics, MetricLogger, SmoothedValue
 from minigpt4.common.registry import registry
 from minigpt4.datasets.data_utils import prepare_sample
+from minigpt4.datasets.datasets.feature_store import PrecomputedFeatureDataset
+from minigpt4.datasets.datasets.image_io import image_cache
 import wandb
 
 class BaseTask:
@@ -22,6 +25,7 @@ class BaseTask:
 
         self.inst_id_key = "instance_id"
         self.cfg = ""
+        self.step_stats = {}
 
     @classmethod
     def setup_task(cls, **kwargs):
@@ -52,12 +56,19 @@ class BaseTask:
 
         assert len(datasets_config) > 0, "At least one dataset has to be specified."
 
+        # decoded images kept per dataloader worker, for images shared by several samples
+        image_cache.max_size = cfg.run_cfg.get("image_cache_size", 0)
+
         for name in datasets_config:
             dataset_config = datasets_config[name]
 
             builder = registry.get_builder_class(name)(dataset_config)
             dataset = builder.build_datasets()
 
+            if 'feature_store' in dataset_config:
+                # image features precomputed by extract_features.py
+                dataset['train'] = PrecomputedFeatureDataset(dataset['train'], dataset_config.feature_store)
+
             dataset['train'].name = name
             if 'sample_ratio' in dataset_config:
                 dataset['train'].sample_ratio = dataset_config.sample_ratio
@@ -67,8 +78,10 @@ class BaseTask:
         return datasets
 
     def train_step(self, model, samples):
-        loss = model(samples)["loss"]
-        return loss
+        outputs = model(samples)
+        # extra scalars returned by the model (e.g. padding ratios of packed batches) are logged
+        self.step_stats = {k: v for k, v in outputs.items() if k != "loss"}
+        return outputs["loss"]
 
     def valid_step(self, model, samples):
         raise NotImplementedError
@@ -112,6 +125,8 @@ class BaseTask:
         cuda_enabled=False,
         log_freq=50,
         accum_grad_iters=1,
+        start_step=0,
+        step_callback=None,
     ):
         return self._train_inner_loop(
             epoch=epoch,
@@ -124,6 +139,8 @@ class BaseTask:
             log_freq=log_freq,
             cuda_enabled=cuda_enabled,
             accum_grad_iters=accum_grad_iters,
+            start_step=start_step,
+            step_callback=step_callback,
         )
 
     def train_iters(
@@ -139,6 +156,8 @@ class BaseTask:
         cuda_enabled=False,
         log_freq=50,
         accum_grad_iters=1,
+        start_step=0,
+        step_callback=None,
     ):
         return self._train_inner_loop(
             epoch=epoch,
@@ -152,6 +171,8 @@ class BaseTask:
             log_freq=log_freq,
             cuda_enabled=cuda_enabled,
             accum_grad_iters=accum_grad_iters,
+            start_step=start_step,
+            step_callback=step_callback,
         )
 
     def _train_inner_loop(
@@ -167,12 +188,17 @@ class BaseTask:
         log_freq=50,
         cuda_enabled=False,
         accum_grad_iters=1,
+        start_step=0,
+        step_callback=None,
     ):
         """
         An inner training loop compatible with both epoch-based and iter-based training.
 
         When using epoch-based, training stops after one epoch; when using iter-based,
         training stops after #iters_per_epoch iterations.
+
+        A resumed epoch starts at `start_step`. `step_callback(num_steps_done)` is called after
+        every optimizer step, e.g. to save a checkpoint.
         """
         use_amp = scaler is not None
 
@@ -183,6 +209,8 @@ class BaseTask:
         metric_logger = MetricLogger(delimiter="  ")
         metric_logger.add_meter("lr", SmoothedValue(window_size=1, fmt="{value:.6f}"))
         metric_logger.add_meter("loss", SmoothedValue(window_size=1, fmt="{value:.4f}"))
+        # the step metrics stay on the device until they are logged, every log_freq steps
+        device_metrics = DeviceMetrics()
 
         # if iter-based runner, schedule lr based on inner epoch.
         logging.info(
@@ -199,7 +227,7 @@ class BaseTask:
             inner_epoch = start_iters // iters_per_epoch
             header = header + "; inner epoch [{}]".format(inner_epoch)
 
-        for i in metric_logger.log_every(range(iters_per_epoch), log_freq, header):
+        for i in metric_logger.log_every(range(start_step, iters_per_epoch), log_freq, header):
             # if using iter-based runner, we stop after iters_per_epoch iterations.
             if i >= iters_per_epoch:
                 break
@@ -217,33 +245,48 @@ class BaseTask:
 
             lr_scheduler.step(cur_epoch=inner_epoch, cur_step=i)
 
-            with torch.cuda.amp.autocast(enabled=use_amp):
-                loss = self.train_step(model=model, samples=samples)
+            # DDP only all-reduces the gradients of the micro-step before the optimizer step
+            sync_grads = (i + 1) % accum_grad_iters == 0
+            no_sync = model.no_sync() if not sync_grads and hasattr(model, "no_sync") else contextlib.nullcontext()
+            with no_sync:
+                with torch.cuda.amp.autocast(enabled=use_amp):
+                    loss = self.train_step(model=model, samples=samples)
 
-            # after_train_step()
-            if use_amp:
-                scaler.scale(loss).backward()
-            else:
-                loss.backward()
+                # after_train_step()
+                if use_amp:
+                    scaler.scale(loss).backward()
+                else:
+                    loss.backward()
 
             # update gradients every accum_grad_iters iterations
-            if (i + 1) % accum_grad_iters == 0:
+            if sync_grads:
                 if use_amp:
                     scaler.step(optimizer)
                     scaler.update()                     
                 else:    
                     optimizer.step()
                 optimizer.zero_grad()
+                if step_callback is not None:
+                    step_callback(i + 1)
+            device_metrics.update(loss=loss, **self.step_stats)
+
+            # same steps as the printing of metric_logger.log_every
+            if (i - start_step) % log_freq == 0 or i == iters_per_epoch - 1:
+                averages = device_metrics.flush()
+                metric_logger.update_averages(averages)
+                metric_logger.update(lr=optimizer.param_groups[0]["lr"])
                 # if self.cfg.wandb_log:
                 if self.cfg.run_cfg.wandb_log:
-                    wandb.log({"epoch": inner_epoch, "loss": loss})
-            metric_logger.update(loss=loss.item())
-            metric_logger.update(lr=optimizer.param_groups[0]["lr"])
+                    wandb.log({"epoch": inner_epoch, **{k: v for k, (v, _) in averages.items()}})
 
         # after train_epoch()
         # gather the stats from all processes
         metric_logger.synchronize_between_processes()
         logging.info("Averaged stats: " + str(metric_logger.global_avg()))
+        if hasattr(data_loader, "prefetch_metrics"):
+            logging.info("Data prefetch: " + str(data_loader.prefetch_metrics()))
+        if hasattr(data_loader, "mixture_metrics"):
+            logging.info("Dataset mixture: " + str(data_loader.mixture_metrics()))
         return {
             k: "{:.3f}".format(meter.global_avg)
             for k, meter in metric_logger.meters.items()
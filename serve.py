@@ -0,0 +1,74 @@
+import argparse
+import logging
+
+from minigpt4.common.config import Config
+from minigpt4.common.registry import registry
+from minigpt4.conversation.conversation import CONV_VISION_Vicuna0, CONV_VISION_LLama2, CONV_VISION_minigptv2
+from minigpt4.conversation.serving import ContinuousBatchingEngine, make_http_server
+
+# imports modules for registration
+from minigpt4.datasets.builders import *
+from minigpt4.models import *
+from minigpt4.processors import *
+from minigpt4.runners import *
+from minigpt4.tasks import *
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serve")
+    parser.add_argument("--cfg-path", required=True, help="path to configuration file.")
+    parser.add_argument("--gpu-id", type=int, default=0, help="specify the gpu to load the model.")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="address of the http endpoint.")
+    parser.add_argument("--port", type=int, default=8000, help="port of the http endpoint.")
+    parser.add_argument("--max-batch-size", type=int, default=8, help="number of requests decoded together.")
+    parser.add_argument("--max-seq-len", type=int, default=2048, help="kv cache length per request.")
+    parser.add_argument(
+        "--options",
+        nargs="+",
+        help="override some settings in the used config, the key-value pair "
+        "in xxx=yyy format will be merged into config file (deprecate), "
+        "change to --cfg-options instead.",
+    )
+    args = parser.parse_args()
+    return args
+
+
+conv_dict = {'pretrain_vicuna0': CONV_VISION_Vicuna0,
+             'pretrain_llama2': CONV_VISION_LLama2}
+
+logging.basicConfig(level=logging.INFO)
+
+print('Initializing Engine')
+args = parse_args()
+cfg = Config(args)
+
+model_config = cfg.model_cfg
+model_config.device_8bit = args.gpu_id
+model_cls = registry.get_model_class(model_config.arch)
+model = model_cls.from_config(model_config).to('cuda:{}'.format(args.gpu_id))
+model = model.eval()
+
+if model_config.arch == 'minigpt_v2':
+    conv_template = CONV_VISION_minigptv2
+    stop_words_ids = [[2]]
+else:
+    conv_template = conv_dict[model_config.model_type]
+    stop_words_ids = [[835], [2277, 29937]]
+
+vis_processor_cfg = cfg.datasets_cfg.cc_sbu_align.vis_processor.train
+vis_processor = registry.get_processor_class(vis_processor_cfg.name).from_config(vis_processor_cfg)
+
+engine = ContinuousBatchingEngine(
+    model,
+    max_batch_size=args.max_batch_size,
+    max_seq_len=args.max_seq_len,
+    stop_words_ids=stop_words_ids,
+).start()
+
+server = make_http_server(engine, vis_processor, conv_template, host=args.host, port=args.port)
+print('Serving on http://{}:{}/generate'.format(args.host, args.port))
+try:
+    server.serve_forever()
+finally:
+    server.server_close()
+    engine.stop()
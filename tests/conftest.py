@@ -0,0 +1,79 @@
+import pytest
+import torch
+import torch.nn as nn
+from transformers import LlamaConfig, PreTrainedTokenizer
+
+from minigpt4.models.minigpt_base import MiniGPTBase
+from minigpt4.models.modeling_llama import LlamaForCausalLM
+
+
+class CharTokenizer(PreTrainedTokenizer):
+    """A character level tokenizer with the special tokens of the LLaMA tokenizer and a pad token."""
+
+    SPECIAL_TOKENS = ["<unk>", "<s>", "</s>", "<pad>"]
+    model_input_names = ["input_ids", "attention_mask"]
+
+    def __init__(self, **kwargs):
+        self._vocab = {token: i for i, token in enumerate(self.SPECIAL_TOKENS + [chr(c) for c in range(32, 127)])}
+        self._ids = {i: token for token, i in self._vocab.items()}
+        super().__init__(unk_token="<unk>", bos_token="<s>", eos_token="</s>", pad_token="<pad>", **kwargs)
+        self.sanitize_special_tokens()  # the special tokens are not split in the texts
+
+    @property
+    def vocab_size(self):
+        return len(self._vocab)
+
+    def get_vocab(self):
+        return dict(self._vocab)
+
+    def _tokenize(self, text):
+        return list(text)
+
+    def _convert_token_to_id(self, token):
+        return self._vocab.get(token, 0)
+
+    def _convert_id_to_token(self, index):
+        return self._ids.get(index, "<unk>")
+
+    def convert_tokens_to_string(self, tokens):
+        return "".join(tokens)
+
+    def build_inputs_with_special_tokens(self, token_ids_0, token_ids_1=None):
+        # bos only, as the LLaMA tokenizer
+        return [self.bos_token_id] + token_ids_0 + (token_ids_1 or [])
+
+
+class TinyMiniGPT(MiniGPTBase):
+    """
+    MiniGPTBase on a tiny random LLaMA and a character level tokenizer. The images are given as
+    their frozen features, [batch, num_patches, feat_dim], which llama_proj maps to llama embeddings.
+    """
+
+    def __init__(self, max_context_len=3800, max_txt_len=32, feat_dim=16):
+        nn.Module.__init__(self)
+        torch.manual_seed(0)
+        self.llama_tokenizer = CharTokenizer()
+        config = LlamaConfig(vocab_size=self.llama_tokenizer.vocab_size, hidden_size=32, intermediate_size=64,
+                             num_hidden_layers=2, num_attention_heads=4, max_position_embeddings=256,
+                             pad_token_id=self.llama_tokenizer.pad_token_id,
+                             initializer_range=0.2)  # large enough for the outputs to depend on the positions
+        self.llama_model = LlamaForCausalLM(config).eval()
+        self.llama_proj = nn.Linear(feat_dim, config.hidden_size)
+        self.feat_dim = feat_dim
+
+        self.max_txt_len = max_txt_len
+        self.max_context_len = max_context_len
+        self.end_sym = "\n"
+        self.prompt_template = ""
+        self.prompt_list = []
+        self.img_embed_cache = None
+        self.pack_sequences = False
+        self.pack_length = 0
+
+    def encode_frozen(self, image):
+        return image
+
+
+@pytest.fixture
+def tiny_minigpt():
+    return TinyMiniGPT().eval()
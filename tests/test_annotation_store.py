@@ -0,0 +1,49 @@
+import json
+
+from minigpt4.common import dist_utils
+from minigpt4.datasets.datasets.annotation_store import AnnotationList, AnnotationStore, load_annotations
+
+
+RECORDS = [
+    {"id": 1, "score": 0.5, "mixed": 3, "caption": "a cat", "boxes": [[1, 2, 3, 4]], "extra": None},
+    {"id": 2, "score": 1.0, "mixed": 2.5, "caption": "ünïcode", "boxes": []},
+    {"id": 3, "score": -2.25, "mixed": 10 ** 20, "caption": "", "boxes": [[0.5, 1, 2, 3]], "flag": True},
+]
+
+
+def test_round_trip(tmp_path):
+    AnnotationStore.convert(RECORDS, str(tmp_path))
+    store = AnnotationStore(str(tmp_path))
+
+    assert len(store) == len(RECORDS)
+    assert list(store) == RECORDS
+    assert store[-1] == RECORDS[-1]
+    # the ints of a column mixing ints and floats stay ints
+    assert [type(record["mixed"]) for record in store] == [int, float, int]
+    assert dict(store.columns)["id"] == "int"
+    assert dict(store.columns)["score"] == "float"
+    assert dict(store.columns)["mixed"] == "json"
+
+
+def test_open_and_select(tmp_path):
+    ann_path = tmp_path / "ann.json"
+    ann_path.write_text(json.dumps({"annotations": RECORDS}))
+
+    annotations = load_annotations(str(ann_path))
+    assert list(annotations) == RECORDS
+
+    annotations = AnnotationList.open([str(ann_path), str(ann_path)]).select([4, 0])
+    annotations.instance_id_key = "instance_id"
+    assert [record["id"] for record in annotations] == [2, 1]
+    assert [record["instance_id"] for record in annotations] == ["4", "0"]
+
+
+def test_open_on_other_rank_without_store(tmp_path, monkeypatch):
+    # a process of another node, where its local main process did not convert the store
+    monkeypatch.setattr(dist_utils, "is_dist_avail_and_initialized", lambda: True)
+    monkeypatch.setattr(dist_utils, "get_local_rank", lambda: 1)
+    monkeypatch.setattr(dist_utils.dist, "barrier", lambda: None)
+
+    ann_path = tmp_path / "ann.json"
+    ann_path.write_text(json.dumps(RECORDS))
+    assert list(load_annotations(str(ann_path))) == RECORDS
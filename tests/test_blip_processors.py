@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+from minigpt4.datasets.datasets.dataloader_utils import RawImageCollater
+from minigpt4.processors.blip_processors import Blip2ImageEvalProcessor, Blip2ImageTrainProcessor
+
+
+def random_image(width, height, seed):
+    # smooth content with some detail, as photos are
+    rng = np.random.RandomState(seed)
+    coarse = rng.randint(0, 256, (height // 8 + 1, width // 8 + 1, 3), dtype=np.uint8)
+    image = np.asarray(Image.fromarray(coarse).resize((width, height), Image.BILINEAR), dtype=np.int16)
+    image = image + rng.randint(-20, 21, image.shape)
+    return Image.fromarray(image.clip(0, 255).astype(np.uint8))
+
+
+@pytest.mark.parametrize("processor_cls", [Blip2ImageTrainProcessor, Blip2ImageEvalProcessor])
+def test_batch_transform_matches_pil(processor_cls):
+    images = [random_image(w, h, seed) for seed, (w, h) in enumerate([(320, 240), (97, 500), (320, 240), (224, 224)])]
+    expected = torch.stack([processor_cls(image_size=224)(image) for image in images])
+
+    processor = processor_cls(image_size=224, device_preprocess=True)
+    batch = RawImageCollater()([{"image": processor(image), "index": i} for i, image in enumerate(images)])
+    output = processor.batch_transform(batch["image"])
+
+    assert output.shape == expected.shape
+    # a few uint8 levels at most, in normalized units
+    assert (output - expected).abs().max().item() < 4 / 255 / min(processor.std)
+
+
+def test_device_preprocess_is_ignored_outside_training():
+    from minigpt4.conversation.conversation import CONV_VISION_minigptv2, Chat
+    from minigpt4.conversation.serving import make_http_server
+
+    processor = Blip2ImageEvalProcessor(image_size=224, device_preprocess=True)
+    Chat(model=None, vis_processor=processor, device="cpu")
+    assert processor(random_image(64, 48, seed=0)).dtype == torch.float
+
+    processor = Blip2ImageEvalProcessor(image_size=224, device_preprocess=True)
+    server = make_http_server(engine=None, vis_processor=processor, conv_template=CONV_VISION_minigptv2, port=0)
+    server.server_close()
+    assert processor(random_image(64, 48, seed=0)).dtype == torch.float
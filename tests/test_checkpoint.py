@@ -0,0 +1,111 @@
+import os
+
+import pytest
+import torch
+
+from minigpt4.common import dist_utils
+from minigpt4.common.checkpoint import AsyncCheckpointWriter, load_cached_safetensors, load_model_state
+from minigpt4.runners.runner_base import RunnerBase
+
+
+class TinyRunner(RunnerBase):
+    """The checkpoint saving of RunnerBase, on a fixed state."""
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.checkpoint_writer = AsyncCheckpointWriter()
+        self.weight = torch.zeros(4)
+
+    def _checkpoint_state(self, cur_epoch):
+        return {"weight": self.weight.clone()}, {"epoch": cur_epoch}
+
+    def _consolidate_optimizer_state(self):
+        pass
+
+
+def test_iter_checkpoints_pair_pth_and_weights(tmp_path):
+    runner = TinyRunner(str(tmp_path))
+    for iters in [10, 20]:
+        runner.weight += 1
+        runner._save_iter_checkpoint(cur_epoch=0, iters=iters)
+    runner.checkpoint_writer.wait()
+
+    assert sorted(f for f in os.listdir(tmp_path) if f.startswith("checkpoint_latest")) == [
+        "checkpoint_latest.pth", "checkpoint_latest_e0_i20.safetensors"]
+    checkpoint = torch.load(os.path.join(tmp_path, "checkpoint_latest.pth"))
+    assert checkpoint["iters"] == 20
+    state_dict = load_model_state(os.path.join(tmp_path, "checkpoint_latest.pth"))
+    assert torch.equal(state_dict["weight"], torch.full([4], 2.))
+
+
+def test_epoch_checkpoints_keep_last(tmp_path):
+    runner = TinyRunner(str(tmp_path))
+    runner.config = type("Config", (), {"run_cfg": {"keep_last_checkpoints": 2}})()
+    for epoch in range(3):
+        runner._save_checkpoint(epoch)
+        runner._save_checkpoint(epoch, is_best=True)
+    runner.checkpoint_writer.wait()
+
+    assert sorted(os.listdir(tmp_path)) == [
+        "checkpoint_1.pth", "checkpoint_1_e1.safetensors",
+        "checkpoint_2.pth", "checkpoint_2_e2.safetensors",
+        "checkpoint_best.pth", "checkpoint_best_e2.safetensors",
+    ]
+
+
+def test_mismatched_weights_are_rejected(tmp_path):
+    runner = TinyRunner(str(tmp_path))
+    runner._save_iter_checkpoint(cur_epoch=0, iters=10)
+    runner.checkpoint_writer.wait()
+
+    # a .pth of another step referring to the same weights file, e.g. after a preempted save
+    path = os.path.join(tmp_path, "checkpoint_latest.pth")
+    checkpoint = torch.load(path)
+    checkpoint["step"] = "e0_i20"
+    torch.save(checkpoint, path)
+    with pytest.raises(AssertionError):
+        load_model_state(path)
+
+
+def test_cached_safetensors_follow_the_source(tmp_path):
+    path = os.path.join(tmp_path, "pretrained.pth")
+    cache_dir = os.path.join(tmp_path, "cache")
+    torch.save({"model": {"weight": torch.ones(3)}}, path)
+    assert torch.equal(load_cached_safetensors(path, cache_dir)["weight"], torch.ones(3))
+
+    torch.save({"model": {"weight": torch.zeros(3), "bias": torch.zeros(1)}}, path)
+    os.utime(path, (0, 0))  # the mtime may not change within the test
+    assert torch.equal(load_cached_safetensors(path, cache_dir)["weight"], torch.zeros(3))
+    assert len(os.listdir(cache_dir)) == 2
+
+
+def test_cached_safetensors_missing_on_other_rank(tmp_path, monkeypatch):
+    # a process of another node, whose cache root its local main process did not fill
+    monkeypatch.setattr(dist_utils, "is_dist_avail_and_initialized", lambda: True)
+    monkeypatch.setattr(dist_utils, "get_local_rank", lambda: 1)
+    monkeypatch.setattr(dist_utils.dist, "barrier", lambda: None)
+
+    path = os.path.join(tmp_path, "pretrained.pth")
+    torch.save({"model": {"weight": torch.ones(3)}}, path)
+    assert torch.equal(load_cached_safetensors(path, os.path.join(tmp_path, "cache"))["weight"], torch.ones(3))
+
+
+def test_failed_save_is_raised_and_keeps_old_files(tmp_path, monkeypatch):
+    writer = AsyncCheckpointWriter()
+    old_path = os.path.join(tmp_path, "checkpoint_0.pth")
+    writer.save({old_path: {"epoch": 0}})
+    writer.wait()
+
+    def disk_full(obj, path):
+        with open(path, "wb") as f:
+            f.write(b"partial")
+        raise OSError(28, "No space left on device")
+
+    monkeypatch.setattr(torch, "save", disk_full)
+    writer.save({os.path.join(tmp_path, "checkpoint_1.pth"): {"epoch": 1}}, remove=[old_path])
+    with pytest.raises(OSError):
+        writer.wait()
+
+    # the older checkpoint is not removed, and the partial file is cleaned up
+    assert sorted(os.listdir(tmp_path)) == ["checkpoint_0.pth"]
+    writer.wait()  # raised once
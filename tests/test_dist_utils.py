@@ -0,0 +1,37 @@
+import pytest
+
+from minigpt4.common import dist_utils
+
+
+@pytest.fixture
+def fake_rank(monkeypatch):
+    """A distributed run seen from a process of the given local rank, logging the barriers."""
+    events = []
+
+    def set_rank(local_rank):
+        monkeypatch.setattr(dist_utils, "is_dist_avail_and_initialized", lambda: True)
+        monkeypatch.setattr(dist_utils, "get_local_rank", lambda: local_rank)
+        monkeypatch.setattr(dist_utils.dist, "barrier", lambda: events.append("barrier"))
+        return events
+
+    return set_rank
+
+
+def test_prepare_once_on_the_local_main_process(fake_rank):
+    events = fake_rank(0)
+    dist_utils.prepare_once(lambda: "prepare" in events, lambda: events.append("prepare"))
+    assert events == ["prepare", "barrier"]
+
+
+def test_prepare_once_waits_on_other_processes(fake_rank):
+    # the file written by the local main process during the barrier
+    events = fake_rank(1)
+    dist_utils.prepare_once(lambda: "barrier" in events, lambda: events.append("prepare"))
+    assert events == ["barrier"]
+
+
+def test_prepare_once_falls_back_when_still_missing(fake_rank):
+    # e.g. a cache directory of its own on a node whose local main process prepared another one
+    events = fake_rank(1)
+    dist_utils.prepare_once(lambda: "prepare" in events, lambda: events.append("prepare"))
+    assert events == ["barrier", "prepare"]
@@ -0,0 +1,61 @@
+from functools import partial
+
+import pytest
+import torch
+import torch.nn as nn
+
+from minigpt4.models.eva_vit import ATTN_BACKENDS, VisionTransformer
+
+
+def tiny_vit(attn_backend, use_rel_pos_bias=False, qk_scale=None):
+    return VisionTransformer(
+        img_size=56,
+        patch_size=14,
+        embed_dim=32,
+        depth=2,
+        num_heads=4,
+        mlp_ratio=2.,
+        qkv_bias=True,
+        qk_scale=qk_scale,
+        norm_layer=partial(nn.LayerNorm, eps=1e-6),
+        use_rel_pos_bias=use_rel_pos_bias,
+        use_mean_pooling=False,
+        attn_backend=attn_backend,
+    ).eval()
+
+
+def random_state_dict(model):
+    torch.manual_seed(0)
+    # the biases and the relative position tables are zero-initialized
+    return {k: torch.randn_like(v) if v.is_floating_point() else v for k, v in model.state_dict().items()}
+
+
+@pytest.mark.parametrize("use_rel_pos_bias", [False, True])
+@torch.no_grad()
+def test_attention_backends_match_eager(use_rel_pos_bias):
+    reference = tiny_vit("eager", use_rel_pos_bias, qk_scale=0.3)
+    state_dict = random_state_dict(reference)
+    reference.load_state_dict(state_dict)
+    image = torch.randn(2, 3, 56, 56)
+    expected = reference(image)
+
+    for backend in ATTN_BACKENDS:
+        model = tiny_vit(backend, use_rel_pos_bias, qk_scale=0.3)
+        model.load_state_dict(state_dict)
+        for block in model.blocks:
+            block.attn.attn_chunk_size = 5  # several chunks of the 17 tokens
+        assert torch.allclose(model(image), expected, atol=1e-4), backend
+
+
+@pytest.mark.parametrize("use_rel_pos_bias", [False, True])
+@torch.no_grad()
+def test_sdpa_attention_matches_eager(use_rel_pos_bias):
+    # forward only takes the sdpa path on cuda, compare the attention itself on any device
+    model = tiny_vit("sdpa", use_rel_pos_bias, qk_scale=0.3)
+    model.load_state_dict(random_state_dict(model))
+    attn = model.blocks[0].attn
+    q, k, v = torch.randn(3, 2, 4, 17, 8).unbind(0)
+
+    expected = attn.eager_attention(q, k, v)
+    output = attn.sdpa_attention(q, k, v, attn.attention_bias(dtype=q.dtype))
+    assert torch.allclose(output, expected, atol=1e-5)
@@ -0,0 +1,62 @@
+import types
+
+import torch
+from transformers import StoppingCriteriaList
+
+from minigpt4.conversation.conversation import Chat
+from minigpt4.models.generation_utils import sample_next_tokens
+
+
+def greedy_kwargs(inputs_embeds, max_new_tokens):
+    return dict(
+        inputs_embeds=inputs_embeds,
+        max_new_tokens=max_new_tokens,
+        stopping_criteria=StoppingCriteriaList([]),
+        do_sample=False,
+        min_length=1,
+        top_p=0.9,
+        repetition_penalty=1.0,
+        temperature=1.0,
+    )
+
+
+def hf_generate(model, inputs_embeds, max_new_tokens):
+    output = model.llama_model.generate(
+        **greedy_kwargs(inputs_embeds, max_new_tokens),
+        eos_token_id=model.llama_tokenizer.eos_token_id,
+        pad_token_id=0,
+    )
+    # with inputs_embeds, generate() starts the output with bos
+    assert output[0, 0].item() == model.llama_model.config.bos_token_id
+    return output[:, 1:]
+
+
+@torch.no_grad()
+def test_cached_generate_matches_generate(tiny_minigpt):
+    model = tiny_minigpt
+    model.llama_tokenizer = types.SimpleNamespace(eos_token_id=None)
+    inputs_embeds = model.embed_tokens(torch.tensor([[1, 5, 9, 13, 17]]))
+
+    # take as eos a token the greedy decoding reaches after a few steps
+    reference = hf_generate(model, inputs_embeds, max_new_tokens=20)[0].tolist()
+    eos_pos = next(i for i, token in enumerate(reference) if i >= 2 and token not in reference[:i])
+    model.llama_tokenizer.eos_token_id = reference[eos_pos]
+
+    chat = Chat(model, vis_processor=None, device="cpu")
+    conv = types.SimpleNamespace(kv_cache=None)
+    output = chat.cached_generate(conv, [], token_ids=None, past_key_values=None,
+                                  **greedy_kwargs(inputs_embeds, max_new_tokens=20))
+    expected = hf_generate(model, inputs_embeds, max_new_tokens=20)
+
+    assert output.tolist() == expected.tolist()
+    assert output[0, -1].item() == model.llama_tokenizer.eos_token_id
+    assert output.shape[1] == eos_pos + 1
+
+
+def test_sampling_keeps_top_k():
+    torch.manual_seed(0)
+    logits = torch.randn(4, 100)
+    allowed = torch.topk(logits, 5, dim=-1).indices
+    for _ in range(20):
+        tokens = sample_next_tokens(logits, do_sample=True, top_k=5)
+        assert (allowed == tokens[:, None]).any(dim=-1).all()
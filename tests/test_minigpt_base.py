@@ -0,0 +1,159 @@
+import torch
+
+
+def loop_prompt_wrap(model, img_embeds, prompts, lengths=None):
+    """The per-sample loop prompt_wrap replaced, for multi-modal prompts."""
+    emb_lists = []
+    for idx, (each_img_embed, each_prompt) in enumerate(zip(img_embeds, prompts)):
+        pn = each_img_embed.shape[-2]
+        if lengths is not None:
+            each_img_embed = each_img_embed.reshape(-1, each_img_embed.shape[-1])
+            each_img_embed = each_img_embed[:lengths[idx] * pn]
+        p_segs = each_prompt.split('<ImageHere>')
+        interleave_emb = []
+        for idx, seg in enumerate(p_segs[:-1]):
+            p_tokens = model.llama_tokenizer(seg, return_tensors="pt", add_special_tokens=False)
+            p_embed = model.embed_tokens(p_tokens.input_ids.long())  # float when the segment is empty
+            interleave_emb.append(torch.cat([p_embed, each_img_embed[None][:, idx * pn:(idx + 1) * pn]], dim=1))
+        wrapped_emb = torch.cat(interleave_emb, dim=1)
+        p_tokens = model.llama_tokenizer(p_segs[-1], return_tensors="pt", add_special_tokens=False)
+        p_embed = model.embed_tokens(p_tokens.input_ids.long())  # float when the segment is empty
+        wrapped_emb = torch.cat([wrapped_emb, p_embed], dim=1)
+        emb_lists.append(wrapped_emb)
+
+    emb_lens = [emb.shape[1] for emb in emb_lists]
+    pad_emb = model.embed_tokens(torch.tensor(model.llama_tokenizer.pad_token_id))
+
+    max_length = max(emb_lens) if max(emb_lens) < model.max_context_len else model.max_context_len
+    wrapped_embs = pad_emb.expand(len(emb_lens), max_length, -1).clone()
+    wrapped_atts = torch.zeros([len(emb_lens), max_length], dtype=torch.int)
+
+    for i, emb in enumerate(emb_lists):
+        length = emb_lens[i] if emb_lens[i] < model.max_context_len else model.max_context_len
+        wrapped_embs[i, :length] = emb[:, :length]
+        wrapped_atts[i, :length] = 1
+    return wrapped_embs, wrapped_atts
+
+
+def loop_concat_emb_input_output(input_embs, input_atts, output_embs, output_atts):
+    """The per-sample loop concat_emb_input_output replaced."""
+    input_lens, cat_embs, cat_atts = [], [], []
+    for i in range(input_embs.size(0)):
+        input_len = input_atts[i].sum()
+        input_lens.append(input_len)
+        cat_embs.append(torch.cat([input_embs[i][:input_len], output_embs[i], input_embs[i][input_len:]]))
+        cat_atts.append(torch.cat([input_atts[i][:input_len], output_atts[i], input_atts[i][input_len:]]))
+    return torch.stack(cat_embs), torch.stack(cat_atts), torch.stack(input_lens)
+
+
+PROMPTS = [
+    "<Img><ImageHere></Img> describe it",
+    "<ImageHere>",
+    "[INST] <Img><ImageHere></Img> a much longer question about the image? [/INST]",
+]
+
+
+@torch.no_grad()
+def test_prompt_wrap_matches_loop(tiny_minigpt):
+    img_embeds = torch.randn(3, 4, 32)
+    for max_context_len in [3800, 20]:  # with and without truncation
+        tiny_minigpt.max_context_len = max_context_len
+        embs, atts = tiny_minigpt.prompt_wrap(img_embeds, None, PROMPTS)
+        expected_embs, expected_atts = loop_prompt_wrap(tiny_minigpt, img_embeds, PROMPTS)
+        assert torch.equal(atts, expected_atts)
+        assert torch.allclose(embs, expected_embs)
+
+
+@torch.no_grad()
+def test_prompt_wrap_multi_image_matches_loop(tiny_minigpt):
+    # image trains of up to 3 images, some of them padding
+    prompts = ["<ImageHere><ImageHere><ImageHere> what happens?", "first <ImageHere> then <ImageHere><ImageHere>"]
+    img_embeds = torch.randn(2, 3, 4, 32)
+    lengths = [3, 1]
+    embs, atts = tiny_minigpt.prompt_wrap(img_embeds, None, prompts, lengths)
+    expected_embs, expected_atts = loop_prompt_wrap(tiny_minigpt, img_embeds, prompts, lengths)
+    assert torch.equal(atts, expected_atts)
+    assert torch.allclose(embs, expected_embs)
+
+
+def test_concat_emb_input_output_matches_loop(tiny_minigpt):
+    torch.manual_seed(0)
+    input_atts = torch.tensor([[1, 1, 1, 0, 0], [1, 1, 1, 1, 1], [1, 0, 0, 0, 0]], dtype=torch.int)
+    output_atts = torch.tensor([[1, 1, 0], [1, 0, 0], [1, 1, 1]], dtype=torch.int)
+    input_embs, output_embs = torch.randn(3, 5, 8), torch.randn(3, 3, 8)
+
+    embs, atts, input_lens = tiny_minigpt.concat_emb_input_output(input_embs, input_atts, output_embs, output_atts)
+    expected_embs, expected_atts, expected_lens = loop_concat_emb_input_output(
+        input_embs, input_atts, output_embs, output_atts)
+    assert torch.equal(embs, expected_embs)
+    assert torch.equal(atts, expected_atts)
+    assert torch.equal(input_lens, expected_lens)
+
+
+@torch.no_grad()
+def test_multi_select_matches_forward(tiny_minigpt):
+    images = torch.randn(2, 4, 16)
+    texts = ["<Img><ImageHere></Img> what is it?", "<Img><ImageHere></Img> and here, what color is the car?"]
+    answers = [["a cat", "red"], ["a dog on a sofa", "blue"], ["cat", "a red and white car"], ["bird", "green"]]
+
+    # the loss of every candidate with a full forward pass
+    losses = torch.stack([
+        tiny_minigpt({"image": images, "instruction_input": texts, "answer": answer}, reduction="none")["loss"]
+        for answer in answers
+    ], dim=1)
+    expected = torch.argsort(losses, dim=-1).tolist()
+
+    assert tiny_minigpt.multi_select(images, texts, answers) == expected
+    assert tiny_minigpt.multi_select(images, texts, answers, num_cand_per_pass=3) == expected
+
+    # the candidates past num_cand are ranked last
+    losses[0, 2:] = 9999
+    assert tiny_minigpt.multi_select(images, texts, answers, num_cand=[2, 4]) == torch.argsort(losses, dim=-1).tolist()
+
+
+def packing_samples():
+    return {
+        "image": torch.randn(4, 4, 16),
+        "instruction_input": ["<Img><ImageHere></Img> what is it?", "<Img><ImageHere></Img> describe the scene",
+                              "<Img><ImageHere></Img> hi", "<Img><ImageHere></Img> where is it?"],
+        "answer": ["a cat", "a long description of a busy street", "hello", "in a park"],
+    }
+
+
+def test_packed_loss_matches_unpacked(tiny_minigpt):
+    tiny_minigpt.train()
+    samples = packing_samples()
+
+    expected = tiny_minigpt(samples)
+    expected["loss"].backward()
+    expected_grads = {n: p.grad.clone() for n, p in tiny_minigpt.named_parameters()}
+    tiny_minigpt.zero_grad()
+
+    tiny_minigpt.pack_sequences, tiny_minigpt.pack_length = True, 80
+    output = tiny_minigpt(samples)
+    output["loss"].backward()
+
+    assert output["packed_pad_ratio"] < output["pad_ratio"]  # several samples share a row
+    assert torch.equal(output["num_tokens"], expected["num_tokens"])
+    assert torch.allclose(output["loss"], expected["loss"], atol=1e-5)
+    for name, param in tiny_minigpt.named_parameters():
+        assert torch.allclose(param.grad, expected_grads[name], atol=1e-5), name
+
+
+def test_pack_batch_masks_and_positions(tiny_minigpt):
+    attention_mask = torch.tensor([[1, 1, 1, 0], [1, 1, 0, 0], [1, 1, 1, 1]])
+    inputs_embeds = torch.randn(3, 4, 32)
+    targets = torch.arange(12).view(3, 4)
+    tiny_minigpt.pack_length = 6
+
+    embeds, mask, position_ids, packed_targets, _ = tiny_minigpt.pack_batch(inputs_embeds, attention_mask, targets)
+
+    # first fit by decreasing length: [sample 2, sample 1], [sample 0]
+    assert position_ids.tolist() == [[0, 1, 2, 3, 0, 1], [0, 1, 2, 0, 0, 0]]
+    assert packed_targets.tolist() == [[8, 9, 10, 11, 4, 5], [0, 1, 2, -100, -100, -100]]
+    assert torch.equal(embeds[0, 4:], inputs_embeds[1, :2])
+    assert not embeds[1, 3:].any()
+    segments = torch.tensor([[1, 1, 1, 1, 2, 2], [1, 1, 1, 0, 0, 0]])
+    allowed = (segments[:, :, None] == segments[:, None, :]) & torch.ones(6, 6).tril().bool() & (segments > 0)[:, None]
+    assert mask.shape == (2, 1, 6, 6)
+    assert torch.equal(mask[:, 0] == 0, allowed)
@@ -0,0 +1,48 @@
+import pytest
+import torch
+from transformers import LlamaConfig
+
+from minigpt4.models.modeling_llama import LlamaForCausalLM
+
+
+def tiny_llama():
+    torch.manual_seed(0)
+    config = LlamaConfig(vocab_size=50, hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+                         num_attention_heads=4, max_position_embeddings=64)
+    return LlamaForCausalLM(config)
+
+
+def loss_and_grads(model, input_ids, labels, reduction, loss_chunk_size):
+    model.zero_grad()
+    model.config.loss_chunk_size = loss_chunk_size
+    loss = model(input_ids=input_ids, labels=labels, reduction=reduction, return_dict=True).loss
+    loss.sum().backward()
+    return loss.detach(), {n: p.grad.clone() for n, p in model.named_parameters()}
+
+
+@pytest.mark.parametrize("reduction", ["mean", "none"])
+def test_chunked_loss_matches_full_logits(reduction):
+    model = tiny_llama()
+    input_ids = torch.randint(0, 50, (3, 12))
+    labels = input_ids.clone()
+    labels[:, :4] = -100  # the prompt
+    labels[1, 9:] = -100  # padding
+
+    expected, expected_grads = loss_and_grads(model, input_ids, labels, reduction, loss_chunk_size=0)
+    loss, grads = loss_and_grads(model, input_ids, labels, reduction, loss_chunk_size=16)  # 4 chunks of the vocab
+
+    assert loss.shape == expected.shape
+    assert torch.allclose(loss, expected, atol=1e-5)
+    for name, grad in grads.items():
+        assert torch.allclose(grad, expected_grads[name], atol=1e-5), name
+
+
+@torch.no_grad()
+def test_4d_attention_mask_matches_2d():
+    model = tiny_llama().eval()
+    input_ids = torch.randint(0, 50, (1, 10))
+    expected = model(input_ids=input_ids).logits
+
+    causal = torch.ones(10, 10).tril().bool()
+    mask = torch.zeros(1, 1, 10, 10).masked_fill(~causal, torch.finfo(torch.float).min)
+    assert torch.allclose(model(input_ids=input_ids, attention_mask=mask).logits, expected, atol=1e-5)
@@ -0,0 +1,32 @@
+import pytest
+import torch
+
+
+TEXTS = ["[INST] <Img><ImageHere></Img> what is it? [/INST]", "[INST] <Img><ImageHere></Img> describe [/INST]"]
+
+
+@pytest.mark.parametrize("with_image", [False, True])
+@torch.no_grad()
+def test_prefix_generation_matches_full(tiny_minigpt, with_image):
+    images = torch.randn(1, 4, 16).expand(2, -1, -1)  # the same image, as with an image prefix cache
+    prefix_cache = tiny_minigpt.build_prefix_cache("[INST] <Img>", images[:1] if with_image else None)
+
+    expected = tiny_minigpt.generate(images, TEXTS, max_new_tokens=12)
+    assert tiny_minigpt.generate(None if with_image else images, TEXTS, max_new_tokens=12,
+                                 prefix_cache=prefix_cache) == expected
+    assert any(expected)
+
+    # an answer ends at any of the stop words, with or without the prefix cache
+    stop_id = tiny_minigpt.llama_tokenizer.convert_tokens_to_ids(expected[0][len(expected[0]) // 2])
+    expected = tiny_minigpt.generate(images, TEXTS, max_new_tokens=12, stop_words_ids=[2, stop_id])
+    assert tiny_minigpt.generate(images, TEXTS, max_new_tokens=12, stop_words_ids=[2, stop_id],
+                                 prefix_cache=prefix_cache) == expected
+
+
+@torch.no_grad()
+def test_prefix_cache_is_not_used_with_beam_search(tiny_minigpt, caplog):
+    images = torch.randn(2, 4, 16)
+    prefix_cache = tiny_minigpt.build_prefix_cache("[INST] <Img>")
+    expected = tiny_minigpt.generate(images, TEXTS, max_new_tokens=8, num_beams=2)
+    assert tiny_minigpt.generate(images, TEXTS, max_new_tokens=8, num_beams=2, prefix_cache=prefix_cache) == expected
+    assert "not used with beam search" in caplog.text
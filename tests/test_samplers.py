@@ -0,0 +1,92 @@
+import random
+
+import pytest
+from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
+
+from minigpt4.datasets.datasets import dataloader_utils
+from minigpt4.datasets.datasets.dataloader_utils import (
+    IterLoader,
+    LengthGroupedBatchSampler,
+    MultiIterLoader,
+    ResumableBatchSampler,
+)
+
+
+LENGTHS = [random.Random(0).randint(1, 100) for _ in range(103)]
+
+
+def length_grouped_batches(rank, epoch, num_replicas=4, seed=0):
+    sampler = LengthGroupedBatchSampler(LENGTHS, batch_size=3, num_replicas=num_replicas, rank=rank,
+                                        group_size=2, seed=seed)
+    sampler.set_epoch(epoch)
+    return list(sampler)
+
+
+def resumable_batches(rank, epoch, num_replicas=4, seed=0):
+    sampler = DistributedSampler(range(len(LENGTHS)), num_replicas=num_replicas, rank=rank, seed=seed)
+    batch_sampler = ResumableBatchSampler(sampler, batch_size=3, drop_last=True)
+    batch_sampler.set_epoch(epoch)
+    return list(batch_sampler)
+
+
+@pytest.mark.parametrize("batches_of", [length_grouped_batches, resumable_batches])
+def test_batches_are_a_permutation_across_ranks(batches_of):
+    for epoch in range(3):
+        ranks = [batches_of(rank, epoch) for rank in range(4)]
+        # the same number of full batches on every rank, as the ranks step together
+        assert len({len(batches) for batches in ranks}) == 1
+        assert all(len(batch) == 3 for batches in ranks for batch in batches)
+        indices = [i for batches in ranks for batch in batches for i in batch]
+        assert len(set(indices)) == len(indices)
+        assert set(indices) <= set(range(len(LENGTHS)))
+        assert len(indices) >= len(LENGTHS) - 4 * 3  # at most one incomplete global batch is dropped
+
+        # rebuilt samplers give the same batches for a seed and epoch, and others for the next epoch
+        assert ranks == [batches_of(rank, epoch) for rank in range(4)]
+        assert ranks != [batches_of(rank, epoch + 1) for rank in range(4)]
+        assert ranks != [batches_of(rank, epoch, seed=1) for rank in range(4)]
+
+
+def test_length_grouped_batches_are_similar_in_length():
+    # with a single group, every global batch is a run of the indices sorted by length
+    sampler = LengthGroupedBatchSampler(LENGTHS, batch_size=2, num_replicas=2, group_size=len(LENGTHS))
+    sorted_lengths = sorted(LENGTHS, reverse=True)
+    ranks = []
+    for rank in range(2):
+        sampler.rank = rank
+        ranks.append(list(sampler))
+    for batches in zip(*ranks):
+        lengths = sorted((LENGTHS[i] for batch in batches for i in batch), reverse=True)
+        start = sorted_lengths.index(lengths[0])
+        assert lengths == sorted_lengths[start:start + 4]
+
+
+def make_loader(batch_sampler):
+    return IterLoader(DataLoader(range(len(LENGTHS)), batch_sampler=batch_sampler, collate_fn=list))
+
+
+def make_loaders(rank):
+    return MultiIterLoader([
+        make_loader(LengthGroupedBatchSampler(LENGTHS, batch_size=3, num_replicas=2, rank=rank, group_size=2)),
+        make_loader(ResumableBatchSampler(DistributedSampler(range(len(LENGTHS)), num_replicas=2, rank=rank),
+                                          batch_size=4, drop_last=True)),
+    ], ratios=[2, 1])
+
+
+@pytest.mark.parametrize("resume_step", [5, 50])  # in the first epoch, and in a later one
+def test_resume_from_state_dict(resume_step, monkeypatch):
+    monkeypatch.setattr(dataloader_utils.time, "sleep", lambda seconds: None)
+    for rank in range(2):
+        loader = make_loaders(rank)
+        steps = [next(loader) for _ in range(resume_step)]
+        state_dict = loader.state_dict()
+        expected = [next(loader) for _ in range(60)]
+
+        resumed = make_loaders(rank)
+        resumed.load_state_dict(state_dict)
+        assert [next(resumed) for _ in range(60)] == expected
+        # the state continues the sequence of a run from the beginning
+        fresh = make_loaders(rank)
+        assert [next(fresh) for _ in range(resume_step)] == steps
+        assert [it.epoch for it in resumed.loaders] == [it.epoch for it in loader.loaders]
@@ -0,0 +1,48 @@
+import pytest
+import torch
+
+from minigpt4.conversation.serving import ContinuousBatchingEngine
+
+
+def make_requests():
+    torch.manual_seed(1)
+    image = torch.randn(4, 16)
+    return [
+        dict(prompt="Human: hi Assistant:", max_new_tokens=5),
+        dict(prompt="Human: <Img><ImageHere></Img> what is in the image? Assistant:", images=image[None],
+             max_new_tokens=12),
+        dict(prompt="Human: a longer question, without any image at all Assistant:", max_new_tokens=3),
+        dict(prompt="Human: <Img><ImageHere></Img> Assistant:", images=image[None], max_new_tokens=9),
+        dict(prompt="Human: why? Assistant:", max_new_tokens=7, repetition_penalty=1.2),
+    ]
+
+
+def sequential_outputs(model):
+    engine = ContinuousBatchingEngine(model, max_batch_size=1, max_seq_len=128)
+    outputs = []
+    for kwargs in make_requests():
+        request = engine.submit(**kwargs)
+        engine.run_until_idle()
+        outputs.append((request.output_ids, request.wait()))
+    return outputs
+
+
+@pytest.mark.parametrize("threaded", [False, True])
+def test_concurrent_requests_match_sequential(tiny_minigpt, threaded):
+    expected = sequential_outputs(tiny_minigpt)
+    assert len({len(output_ids) for output_ids, _ in expected}) > 1  # the requests finish at different steps
+
+    # fewer slots than requests, so finished slots are reused while the others keep decoding
+    engine = ContinuousBatchingEngine(tiny_minigpt, max_batch_size=3, max_seq_len=128)
+    if threaded:
+        engine.start()
+    requests = [engine.submit(**kwargs) for kwargs in make_requests()]
+    if threaded:
+        texts = [request.wait(timeout=60) for request in requests]
+        engine.stop()
+    else:
+        engine.run_until_idle()
+        texts = [request.wait() for request in requests]
+
+    assert [(request.output_ids, text) for request, text in zip(requests, texts)] == expected
+    assert engine.num_active() == 0